@@ -9,9 +9,10 @@ __version__ = "20.10"
 __all__ = [
     "MemoryStorage",
     "Segmenter",
-    "CSVStorage"
+    "CSVStorage",
+    "CachedStorage",
 ]
 
 from eleve.segment import Segmenter
-from eleve.memory import MemoryStorage, CSVStorage
+from eleve.memory import MemoryStorage, CSVStorage, CachedStorage
 from eleve import preprocessing as preprocessing
@@ -0,0 +1,133 @@
+# distutils: language = c++
+""" :mod:`eleve.cython_segment`
+================================
+
+Segmentation kernels used by :class:`eleve.segment.Segmenter`. They work on
+autonomy lattices (see :func:`eleve.memory.MemoryStorage.autonomy_lattice`):
+``lattice[i, j - 1]`` is the autonomy of the n-gram of length ``j`` starting
+at token ``i``.
+"""
+from libc.math cimport isnan, INFINITY
+from libcpp.vector cimport vector
+from libcpp.utility cimport pair
+from libcpp.algorithm cimport push_heap as std_push_heap, pop_heap as std_pop_heap, sort as std_sort
+cimport cython
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def viterbi(const double[:, ::1] lattice):
+    """ Best segmentation of a sentence, the one that maximizes the sum of the
+    autonomies of the words, weighted by their lengths (an undefined autonomy
+    counts as -100).
+
+    :param lattice: The autonomy lattice of the sentence.
+    :returns: The boundaries of the words: word ``k`` is ``sentence[bounds[k]:bounds[k + 1]]``.
+    """
+    cdef Py_ssize_t n = lattice.shape[0]
+    cdef Py_ssize_t order = lattice.shape[1]
+    cdef vector[double] best_score = vector[double](n + 1, -INFINITY)
+    # start of the last word of the best segmentation ending at each position
+    cdef vector[Py_ssize_t] back = vector[Py_ssize_t](n + 1, 0)
+    cdef Py_ssize_t i, j
+    cdef double a, score
+    best_score[0] = 0
+    with nogil:
+        for i in range(1, n + 1):
+            for j in range(1, min(order, i) + 1):
+                a = lattice[i - j, j - 1]
+                if isnan(a):
+                    a = -100.0
+                score = best_score[i - j] + a * j
+                if score > best_score[i]:
+                    best_score[i] = score
+                    back[i] = i - j
+    bounds = []
+    i = n
+    while i > 0:
+        bounds.append(i)
+        i = back[i]
+    bounds.append(0)
+    bounds.reverse()
+    return bounds
+
+
+cdef struct path_entry:
+    # one of the best segmentations ending at a position
+    double score
+    Py_ssize_t back_pos     # where its last word starts
+    Py_ssize_t back_rank    # rank, at back_pos, of the segmentation it extends
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def viterbi_nbest(const double[:, ::1] lattice, Py_ssize_t nbest):
+    """ ``nbest`` best segmentations of a sentence. The score of a word is its
+    autonomy weighted by its length, or -100 if its autonomy is undefined.
+
+    At each position, candidates are numbered in the order they are built
+    (by length of the last word, then by rank of the segmentation they
+    extend), and the ``nbest`` greatest (score, number) are kept in a bounded
+    heap: ties are broken as a stable sort would.
+
+    :param lattice: The autonomy lattice of the sentence.
+    :param nbest: The number of segmentations.
+    :returns: A list of couples (score, bounds), from the worst to the best
+      segmentation (see :func:`viterbi` for ``bounds``).
+    """
+    cdef Py_ssize_t n = lattice.shape[0]
+    cdef Py_ssize_t order = lattice.shape[1]
+    # segmentations kept at position i are entries[start[i]:start[i + 1]], by increasing score
+    cdef vector[path_entry] entries
+    cdef vector[Py_ssize_t] start
+    cdef vector[path_entry] candidates
+    # (-score, -number) of the best candidates: the top is the worst one
+    cdef vector[pair[double, Py_ssize_t]] heap
+    cdef pair[double, Py_ssize_t] key
+    cdef Py_ssize_t i, j, r, k, pos, rank
+    cdef double a
+    cdef path_entry entry
+    if nbest < 1:
+        raise ValueError("nbest should be larger or equal to 1")
+    entries.push_back(path_entry(0.0, -1, -1))
+    start.push_back(0)
+    start.push_back(1)
+    with nogil:
+        for i in range(1, n + 1):
+            candidates.clear()
+            heap.clear()
+            for j in range(1, min(order, i) + 1):
+                a = lattice[i - j, j - 1]
+                if isnan(a):
+                    a = -100.0
+                else:
+                    a = a * j
+                for r in range(start[i - j + 1] - start[i - j]):
+                    entry.score = entries[start[i - j] + r].score + a
+                    entry.back_pos = i - j
+                    entry.back_rank = r
+                    key.first = -entry.score
+                    key.second = -<Py_ssize_t> candidates.size()
+                    candidates.push_back(entry)
+                    heap.push_back(key)
+                    std_push_heap(heap.begin(), heap.end())
+                    if <Py_ssize_t> heap.size() > nbest:
+                        std_pop_heap(heap.begin(), heap.end())
+                        heap.pop_back()
+            # from the worst to the best
+            std_sort(heap.begin(), heap.end())
+            for k in range(<Py_ssize_t> heap.size() - 1, -1, -1):
+                entries.push_back(candidates[-heap[k].second])
+            start.push_back(entries.size())
+    results = []
+    for rank in range(start[n + 1] - start[n]):
+        entry = entries[start[n] + rank]
+        score = entry.score
+        bounds = [n]
+        while entry.back_pos >= 0:
+            pos = entry.back_pos
+            bounds.append(pos)
+            entry = entries[start[pos] + entry.back_rank]
+        bounds.reverse()
+        results.append((score, bounds))
+    return results
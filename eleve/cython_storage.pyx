@@ -1,270 +1,1126 @@
 # distutils: language = c++
 import math
 import logging
+import itertools
 
-from libc.math cimport log2
+from libc.math cimport log2, isnan, NAN
 from libcpp.unordered_map cimport unordered_map
 from libcpp.set cimport set as cset
 from libcpp.vector cimport vector
 from libcpp.utility cimport pair
+from libcpp.algorithm cimport (reverse as std_reverse, sort as std_sort,
+                               push_heap as std_push_heap, pop_heap as std_pop_heap)
+from libc.stdint cimport int32_t, int64_t, uint32_t, uint64_t, UINT32_MAX
 
 from libc.stdlib cimport malloc, free
+from libc.string cimport memcpy, memmove
+cimport cython
 from cython.operator import postincrement, dereference
 
 import pickle
+import struct
+import array
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 NaN = float("nan")
 
+cdef struct node_stats:
+    # running sums over the children of a node, kept up to date by incremental
+    # tries in a table beside the nodes
+    int64_t total       # sum of the children counts
+    double clogc        # sum of c * log2(c) over the children that are not breaks
+    uint32_t n_inner    # number of children that have children themselves
+    uint32_t n_zero     # among them, number of children with a zero entropy
+    double h_sum        # sum of the entropies of these children
+    double h_sq_sum     # sum of their squared entropies
+
+
 cdef struct node:
-    int count
+    # 24 bytes: the autonomy is computed from the entropies at query time
+    int64_t count
     float entropy
-    unordered_map[int, node*] *children
-
-
-cdef node* createNode():
-    cdef node* r = <node*> malloc(sizeof(node))
-    r.count = 0
-    r.children = new unordered_map[int, node*]()
-    return r
-
-
-cdef void freeNodeRec(node* n):
-    cdef node *c
-    cdef unordered_map[int,node*].iterator it = n.children.begin()
-    while it != n.children.end():
-        freeNodeRec(dereference(it).second)
-        it = n.children.erase(it)
-    free(n.children)
-    free(n)
-
-cdef void updateEntropy(node* n, cset[int] breaks):
-    cdef float entropy = 0.0
-    cdef float total = 0 #n.count
-    cdef float c
-    cdef int token
-    cdef node* child
-    cdef unordered_map[int,node*].iterator it = n.children.begin()
-    while it != n.children.end():
-        total += dereference(it).second.count
-        postincrement(it)
-    it = n.children.begin()
-    while it != n.children.end():
-        token = dereference(it).first
-        child = dereference(it).second
-        c = child.count
-        if breaks.count(token) > 0:
+    uint32_t n_children
+    child_block *children   # NULL for a leaf
+
+ctypedef node* node_ptr
+
+
+cdef struct child_block:
+    # children of a node: the header is followed by ``capacity`` node
+    # pointers, then ``capacity`` tokens, sorted by token
+    uint32_t capacity
+    # token -> child, only for nodes with more than HASHED_FANOUT children
+    unordered_map[int32_t, node*] *index
+
+
+cdef struct ngram_stats:
+    # what the queries of a storage give about an n-gram
+    int64_t count
+    double entropy
+    double ev           # entropy variation
+    double autonomy
+
+
+cdef packed struct node_record:
+    # one node of a checkpoint, written in DFS pre-order
+    int32_t token
+    uint32_t n_children
+    int64_t count
+    float entropy
+
+cdef enum:
+    # number of node records written or read at once
+    RECORDS_PER_CHUNK = 4096
+    # number of nodes allocated at once by a trie
+    NODES_PER_CHUNK = 4096
+    # number of sentences encoded at once by add_sentences
+    SENTENCES_PER_BATCH = 10000
+    # above this number of children, they are also indexed by a hash map
+    HASHED_FANOUT = 64
+    # initial number of slots of the hash table of a HashTrie
+    HASH_MIN_CAPACITY = 16
+    # one-character tokens below this code point are encoded by a table (the
+    # BMP and the ideographic planes), the others by the dict of a Vocabulary
+    CHAR_TABLE_LIMIT = 0x30000
+
+
+cdef inline node** childNodes(child_block* b) noexcept nogil:
+    return <node**> (<char*> b + sizeof(child_block))
+
+
+cdef inline int32_t* childTokens(child_block* b) noexcept nogil:
+    return <int32_t*> (<char*> b + sizeof(child_block) + b.capacity * sizeof(node*))
+
+
+cdef inline node* childAt(node* n, uint32_t i) noexcept nogil:
+    return childNodes(n.children)[i]
+
+
+cdef inline int32_t tokenAt(node* n, uint32_t i) noexcept nogil:
+    return childTokens(n.children)[i]
+
+
+cdef inline uint32_t lowerBound(const int32_t* tokens, uint32_t size, int32_t token) noexcept nogil:
+    cdef uint32_t lo = 0
+    cdef uint32_t mid
+    while lo < size:
+        mid = (lo + size) >> 1
+        if tokens[mid] < token:
+            lo = mid + 1
+        else:
+            size = mid
+    return lo
+
+
+cdef node* findChild(node* n, int32_t token) noexcept nogil:
+    """ Child of ``n`` for ``token``, NULL if there is none.
+    """
+    cdef child_block* b = n.children
+    cdef int32_t* tokens
+    cdef uint32_t i
+    cdef unordered_map[int32_t, node*].iterator it
+    if b == NULL:
+        return NULL
+    if b.index != NULL:
+        it = b.index.find(token)
+        if it == b.index.end():
+            return NULL
+        return dereference(it).second
+    tokens = childTokens(b)
+    i = lowerBound(tokens, n.n_children, token)
+    if i < n.n_children and tokens[i] == token:
+        return childNodes(b)[i]
+    return NULL
+
+
+cdef int reserveChildren(node* n, uint32_t capacity) except -1 nogil:
+    """ Make room for ``capacity`` children.
+    """
+    cdef child_block* b = n.children
+    cdef child_block* grown
+    if b != NULL and b.capacity >= capacity:
+        return 0
+    grown = <child_block*> malloc(sizeof(child_block) + capacity * (sizeof(node*) + sizeof(int32_t)))
+    if grown == NULL:
+        with gil:
+            raise MemoryError()
+    grown.capacity = capacity
+    grown.index = NULL
+    if b != NULL:
+        memcpy(childNodes(grown), childNodes(b), n.n_children * sizeof(node*))
+        memcpy(childTokens(grown), childTokens(b), n.n_children * sizeof(int32_t))
+        grown.index = b.index
+        free(b)
+    n.children = grown
+    return 0
+
+
+cdef int addChild(node* n, int32_t token, node* child) except -1 nogil:
+    """ Insert a new child (``n`` should not have one for ``token`` yet). The
+    block grows by half its size when full, and gets an index above
+    ``HASHED_FANOUT`` children.
+    """
+    cdef child_block* b
+    cdef uint32_t size = n.n_children
+    cdef uint32_t i
+    cdef int32_t* tokens
+    cdef node** nodes
+    if n.children == NULL or size == n.children.capacity:
+        reserveChildren(n, size + size // 2 + 1)
+    b = n.children
+    tokens = childTokens(b)
+    nodes = childNodes(b)
+    i = lowerBound(tokens, size, token)
+    memmove(tokens + i + 1, tokens + i, (size - i) * sizeof(int32_t))
+    memmove(nodes + i + 1, nodes + i, (size - i) * sizeof(node*))
+    tokens[i] = token
+    nodes[i] = child
+    n.n_children = size + 1
+    if b.index != NULL:
+        dereference(b.index)[token] = child
+    elif n.n_children > HASHED_FANOUT:
+        b.index = new unordered_map[int32_t, node*]()
+        for i in range(n.n_children):
+            dereference(b.index)[tokens[i]] = nodes[i]
+    return 0
+
+
+cdef void freeChildren(node* n) noexcept nogil:
+    """ Free the children block of ``n`` (not the children themselves).
+    """
+    if n.children != NULL:
+        del n.children.index
+        free(n.children)
+        n.children = NULL
+    n.n_children = 0
+
+
+cdef void updateEntropy(node* n, const cset[int]& breaks) noexcept nogil:
+    cdef double entropy = 0.0
+    cdef double total = 0 #n.count
+    cdef double c
+    cdef uint32_t i
+    for i in range(n.n_children):
+        total += childAt(n, i).count
+    for i in range(n.n_children):
+        c = childAt(n, i).count
+        if breaks.count(tokenAt(n, i)) > 0:
             entropy += (c/total) * log2(total)
         else:
             entropy -= (c / total) * log2(c / total)
-        postincrement(it)
     n.entropy = entropy
 
-cdef int pruneNodeHappax(node* n):
-    cdef int sum = 0
-    cdef node* child
-    cdef unordered_map[int,node*].iterator it = n.children.begin()
-    while it != n.children.end():
-        child = dereference(it).second
-        if child.count == 1:
-            freeNodeRec(child)
-            it = n.children.erase(it)
-            sum += 1
+
+cdef struct welford:
+    # running mean and sum of squared differences of the entropy variations of a depth
+    double mean
+    double m2
+    int64_t count
+
+
+cdef struct stats_frame:
+    node* n
+    float parent_entropy
+    size_t depth
+
+
+cdef void updateStats(node* start, float parent_entropy, size_t depth,
+                      const cset[int]& breaks, vector[welford]& acc) noexcept nogil:
+    """ Update the entropy of every node below ``start`` (at ``depth``), and
+    accumulate the entropy variations of each depth in ``acc``. ``acc[d]``
+    gives data for depth ``d + 1``.
+
+    The traversal uses an explicit stack rather than recursion.
+    """
+    cdef vector[stats_frame] stack
+    cdef stats_frame frame
+    cdef node* n
+    cdef double ev, old_mean
+    cdef welford* w
+    cdef uint32_t i
+    stack.push_back(stats_frame(start, parent_entropy, depth))
+    while not stack.empty():
+        frame = stack.back()
+        stack.pop_back()
+        n = frame.n
+        # extend normalization vector if needed
+        while acc.size() < frame.depth:
+            acc.push_back(welford(0.0, 0.0, 0))
+        # if leaf nothing else should be done
+        if n.n_children == 0:
+            continue
+        updateEntropy(n, breaks)
+        # update entropy variation mean and std if possible (not NaN)
+        if frame.depth > 0 and not isnan(n.entropy) and (n.entropy != 0 or frame.parent_entropy != 0):
+            ev = <double> n.entropy - <double> frame.parent_entropy
+            w = &acc[frame.depth - 1]
+            old_mean = w.mean
+            w.count += 1
+            w.mean += (ev - old_mean) / w.count
+            w.m2 += (ev - old_mean) * (ev - w.mean)
+        for i in range(n.n_children):
+            stack.push_back(stats_frame(childAt(n, i), n.entropy, frame.depth + 1))
+
+
+cdef inline double nodeAutonomy(float entropy, float parent_entropy, size_t depth,
+                                const double* mean, const double* stdev, size_t max_depth) noexcept nogil:
+    """ Normalized entropy variation (z-score) of a node at ``depth``, NaN if
+    it is not defined.
+    """
+    cdef double ev
+    if depth == 0 or depth > max_depth or isnan(entropy) or (entropy == 0 and parent_entropy == 0):
+        return NAN
+    if stdev[depth - 1] == 0:
+        return NAN
+    # in double precision, as query_ev
+    ev = <double> entropy - <double> parent_entropy
+    return (ev - mean[depth - 1]) / stdev[depth - 1]
+
+
+cdef inline double clogc(int64_t c) noexcept nogil:
+    if c <= 0:
+        return 0.0
+    return c * log2(<double> c)
+
+
+cdef float statsEntropy(node* n, const node_stats* stats, const cset[int]& breaks) noexcept nogil:
+    """ Entropy of a node computed from its running sums: with T the sum of
+    the children counts, H = log2(T) - sum(c * log2(c)) / T (breaks are not in
+    the sum, as each of their occurrences counts as a distinct token).
+    """
+    cdef double total = stats.total
+    if n.n_children == 1 and breaks.count(tokenAt(n, 0)) == 0:
+        return 0.0
+    return log2(total) - stats.clogc / total
+
+
+cdef void updateChildEntropy(node_stats* stats, float entropy, int sign) noexcept nogil:
+    """ Add (sign=1) or remove (sign=-1) the entropy of an inner child to the
+    sums of its parent.
+    """
+    stats.h_sum += sign * <double> entropy
+    stats.h_sq_sum += sign * <double> entropy * entropy
+    if entropy == 0:
+        if sign > 0:
+            stats.n_zero += 1
         else:
-            sum += pruneNodeHappax(child)
-            if child.count == 0:
-                freeNodeRec(child)
-                it = n.children.erase(it)
-            else:
-                postincrement(it)
-    n.count -= sum
-    return sum
+            stats.n_zero -= 1
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef node* walkPath(node* n, const int* codes, size_t length, node** parent) noexcept nogil:
+    """ Node of the n-gram ``codes`` below ``n`` (NULL if it does not exist),
+    and its parent in ``parent`` (``n`` itself for an empty n-gram).
+    """
+    cdef node* child
+    cdef size_t i
+    parent[0] = n
+    for i in range(length):
+        child = findChild(n, codes[i])
+        if child == NULL:
+            return NULL
+        parent[0] = n
+        n = child
+    return n
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void walkMany(node* root, const int32_t[:, ::1] ids, const Py_ssize_t[::1] lengths,
+                   const Py_ssize_t[::1] order, node** nodes, node** parents) noexcept nogil:
+    """ Look up the n-grams ``ids[r, :lengths[r]]``, in the given order, and set
+    their nodes and the nodes of their parents (NULL if they do not exist).
 
-cdef int pruneNode(node* n,int qnt):
-    cdef int sum = 0
+    Each walk starts again from the prefix it shares with the previous n-gram.
+    """
+    cdef vector[node*] path
+    cdef Py_ssize_t k, r, d, length
+    cdef Py_ssize_t prev = -1
     cdef node* child
-    cdef unordered_map[int,node*].iterator it = n.children.begin()
-    while it != n.children.end():
-        child = dereference(it).second
-        child.count -= qnt
-        if child.count <= 0:
-            freeNodeRec(child)
-            it = n.children.erase(it)
-            sum += 1
+    path.push_back(root)
+    for k in range(order.shape[0]):
+        r = order[k]
+        length = lengths[r]
+        d = 0
+        if prev >= 0:
+            while d + 1 < <Py_ssize_t> path.size() and d < length and ids[r, d] == ids[prev, d]:
+                d += 1
+        path.resize(d + 1)
+        while d < length:
+            child = findChild(path[d], ids[r, d])
+            if child == NULL:
+                break
+            path.push_back(child)
+            d += 1
+        if d < length:
+            nodes[r] = NULL
+            parents[r] = NULL
+        else:
+            nodes[r] = path[length]
+            parents[r] = path[length - 1] if length > 0 else root
+        prev = r
+
+
+cdef class Vocabulary:
+    """ Ids of the tokens, shared by the tries of a storage so that each token
+    is stored, and each n-gram encoded, only once.
+
+    Ids are given from 0, in order of first appearance. Only training adds
+    tokens: lookups encode unknown tokens as -1, an id that no trie contains.
+
+    A ``str`` can be given wherever a list of tokens is expected, its
+    characters being the tokens: the ids of one-character tokens are also
+    kept in a table indexed by code point, so strings are encoded without
+    building a string, or looking up a dict, for each character.
+    """
+    # token -> id
+    cdef readonly dict codes
+    # id -> token
+    cdef readonly list tokens
+    # code point -> id of the one-character token, -1 if unknown
+    cdef vector[int32_t] char_ids
+
+    def __init__(self, tokens=()):
+        """ Constructor
+
+        :param tokens: The tokens of ids 0, 1, 2...
+        """
+        self.codes = {}
+        self.tokens = []
+        for tok in tokens:
+            self.encode(tok)
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def __contains__(self, tok):
+        return tok in self.codes
+
+    cpdef int encode(self, tok) except -1:
+        """ Id of ``tok``, that is added if it is new.
+        """
+        cdef size_t c
+        code = self.codes.get(tok)
+        if code is None:
+            code = len(self.tokens)
+            self.codes[tok] = code
+            self.tokens.append(tok)
+            if isinstance(tok, str) and len(tok) == 1:
+                c = ord(tok)
+                if c < CHAR_TABLE_LIMIT:
+                    if c >= self.char_ids.size():
+                        self.char_ids.resize(c + 1, -1)
+                    self.char_ids[c] = code
+        return code
+
+    cdef inline int _char_id(self, Py_UCS4 c) except -2:
+        """ Id of the token made of the character ``c``, -1 if it is unknown.
+        """
+        if c < self.char_ids.size():
+            return self.char_ids[c]
+        if c < CHAR_TABLE_LIMIT:
+            return -1
+        # a Py_UCS4 converts to a one-character str
+        return self.codes.get(<str> c, -1)
+
+    cdef int _lookup_into(self, ngram, vector[int]& out) except -1:
+        """ Append the ids of the tokens of ``ngram`` to ``out``, -1 for the unknown ones.
+        """
+        cdef dict codes = self.codes
+        cdef Py_UCS4 c
+        if type(ngram) is str:
+            for c in <str> ngram:
+                out.push_back(self._char_id(c))
         else:
-            pruneNode(child, qnt)
-            postincrement(it)
-    return sum
+            for tok in ngram:
+                out.push_back(codes.get(tok, -1))
+        return 0
+
+    cdef int _encode_into(self, sentence, vector[int]& out) except -1:
+        """ Append the ids of the tokens of ``sentence`` to ``out``, adding the new ones.
+        """
+        cdef Py_UCS4 c
+        cdef int code
+        if type(sentence) is str:
+            for c in <str> sentence:
+                code = self._char_id(c)
+                if code < 0:
+                    code = self.encode(<str> c)
+                out.push_back(code)
+        else:
+            for tok in sentence:
+                out.push_back(self.encode(tok))
+        return 0
+
+    def lookup(self, ngram):
+        """ Ids of the tokens of ``ngram``, -1 for the unknown ones.
+
+        :param ngram: A list of tokens, or a ``str`` (a token per character).
+        :returns: A list of ints.
+        """
+        cdef vector[int] codes
+        self._lookup_into(ngram, codes)
+        return codes
+
+    def encode_ngrams(self, ngrams):
+        """ Ids of many n-grams, see :func:`encode_ngrams`.
+        """
+        return encode_ngrams(self, ngrams)
 
+    def encode_sentences(self, sentences, sentence_start=None, sentence_end=None):
+        """ Encode sentences one after the other, adding their new tokens.
+
+        :param sentences: An iterable of sentences (lists of tokens, or ``str``).
+        :param sentence_start: If not None, token added at the beginning of each sentence.
+        :param sentence_end: If not None, token added at the end of each sentence.
+        :returns: A couple of ``array.array``: the ids, and the offsets of the
+          sentences (sentence ``i`` is ``ids[offsets[i]:offsets[i + 1]]``).
+          Empty sentences stay empty.
+        """
+        cdef vector[int] codes
+        cdef vector[int64_t] offsets
+        cdef int start_code = -1
+        cdef int end_code = -1
+        if sentence_start is not None:
+            start_code = self.encode(sentence_start)
+        if sentence_end is not None:
+            end_code = self.encode(sentence_end)
+        offsets.push_back(0)
+        for sentence in sentences:
+            if sentence:
+                if start_code >= 0:
+                    codes.push_back(start_code)
+                self._encode_into(sentence, codes)
+                if end_code >= 0:
+                    codes.push_back(end_code)
+            offsets.push_back(codes.size())
+        ids = array.array("i")
+        ids.frombytes((<char*> codes.data())[:codes.size() * sizeof(int)])
+        starts = array.array("q")
+        starts.frombytes((<char*> offsets.data())[:offsets.size() * sizeof(int64_t)])
+        return ids, starts
 
 
-cdef void updateEntropyRec(node* n, cset[int] breaks):
-    cdef unordered_map[int,node*].iterator it = n.children.begin()
-    updateEntropy(n, breaks)
-    while it != n.children.end():
-        child = dereference(it).second
-        updateEntropyRec(child, breaks)
-        postincrement(it)
+cdef add_sentences(trie, Vocabulary vocabulary, sentences, freqs, int ngram_length,
+                   sentence_start, sentence_end, bint reverse):
+    """ Encode sentences by batches, and give them to ``trie.add_encoded_sentences``.
+    """
+    if ngram_length <= 0:
+        raise ValueError("ngram_length should be larger or equal to 1")
+    if freqs is None:
+        freqs = itertools.repeat(1)
+    pairs = zip(sentences, freqs)
+    while True:
+        batch = list(itertools.islice(pairs, SENTENCES_PER_BATCH))
+        if not batch:
+            break
+        batch_sentences, batch_freqs = zip(*batch)
+        if min(batch_freqs) <= 0:
+            raise ValueError("freq should be larger or equal to 1")
+        ids, offsets = vocabulary.encode_sentences(batch_sentences, sentence_start, sentence_end)
+        trie.add_encoded_sentences(ids, offsets, batch_freqs, ngram_length, reverse)
 
 
+cdef Vocabulary checkpoint_vocabulary(list tokens, Vocabulary vocabulary, vector[int32_t]& remap):
+    """ Vocabulary of a trie loaded from a checkpoint whose tokens are
+    ``tokens``: ``vocabulary`` if given (the tokens are added to it, and if
+    their ids change ``remap`` maps the old ids to the new ones), a new one
+    otherwise.
+    """
+    cdef size_t i
+    remap.clear()
+    if vocabulary is None:
+        return Vocabulary(tokens)
+    for i, tok in enumerate(tokens):
+        remap.push_back(vocabulary.encode(tok))
+    for i in range(remap.size()):
+        if remap[i] != <int32_t> i:
+            return vocabulary
+    remap.clear()
+    return vocabulary
+
 
 cdef class CythonTrie:
+    """ Trie of n-gram counts.
+
+    Concurrency: the queries can be run from many threads at once. They
+    all walk the trie without the GIL, on tokens encoded beforehand; the
+    batch ones (``query_*_many``, :func:`autonomy_lattice`) also release it
+    for the whole batch. The modifications (``add_*``, :func:`prune`,
+    :func:`update_stats`) must not run at the same time as anything else,
+    it is up to the caller to exclude them (with a read/write lock for
+    instance). The only modification made by a query, the update of the
+    statistics of a dirty trie, is done under a lock by the first query.
+    """
     cdef node *root;
     cdef cset[int] breaks;
     cdef dict vbe
     cdef list normalization
+    cdef vector[double] norm_mean
+    cdef vector[double] norm_stdev
     cdef bint dirty
-    cdef dict encoder
+    # token ids, shared with the other trie of a storage
+    cdef readonly Vocabulary vocabulary
+    cdef readonly bint incremental
+    # incremented at each modification
+    cdef readonly size_t generation
+    # incremental mode: per depth sums of the entropy variations, and max depth
+    cdef vector[int64_t] ev_count
+    cdef vector[double] ev_sum
+    cdef vector[double] ev_sq_sum
+    cdef size_t depth
+    # incremental mode: running sums of the inner nodes
+    cdef unordered_map[node_ptr, node_stats] sums
+    # taken by the queries that update the statistics of a dirty trie
+    cdef object stats_lock
+    # nodes are allocated by chunks, that are only freed with the trie (or by
+    # clear); the nodes of pruned subtrees are reused
+    cdef vector[node*] chunks
+    cdef size_t chunk_used      # number of nodes used in the last chunk
+    cdef vector[node*] free_nodes
 
-    __slots__ = ["root", "vbe", "normalization", "dirty", "encoder"]
+    __slots__ = ["root", "vbe", "normalization", "dirty"]
 
-    def __init__(self, terminals=frozenset()):
-        self.root = createNode()
+    def __init__(self, terminals=frozenset(), incremental=False, Vocabulary vocabulary=None):
+        """ Constructor
+
+        :param terminals: Tokens that are counted as distinct in the entropy computation.
+        :param incremental: If True, entropies and normalization are kept up to
+          date at each insertion (a little slower), so that queries never need
+          a full :func:`update_stats`.
+        :param vocabulary: The :class:`Vocabulary` of the trie, a new one by default.
+        """
+        self.root = self._new_node()
         self.vbe = {}
         self.normalization = []
         #self.terminals = frozenset(terminals)
-        self.encoder = {}
+        self.vocabulary = vocabulary if vocabulary is not None else Vocabulary()
         self.dirty = True
+        self.incremental = incremental
+        self.depth = 0
+        self.stats_lock = threading.Lock()
         self.fill_breaks(terminals)
 
+    def __dealloc__(self):
+        self._release_nodes()
+
+    cdef node* _new_node(self) except NULL nogil:
+        cdef node* n
+        cdef node* chunk
+        if not self.free_nodes.empty():
+            n = self.free_nodes.back()
+            self.free_nodes.pop_back()
+        else:
+            if self.chunks.empty() or self.chunk_used == NODES_PER_CHUNK:
+                chunk = <node*> malloc(NODES_PER_CHUNK * sizeof(node))
+                if chunk == NULL:
+                    with gil:
+                        raise MemoryError()
+                self.chunks.push_back(chunk)
+                self.chunk_used = 0
+            n = self.chunks.back() + self.chunk_used
+            self.chunk_used += 1
+        n.count = 0
+        n.entropy = NAN
+        n.n_children = 0
+        n.children = NULL
+        return n
+
+    cdef void _free_subtree(self, node* n) noexcept nogil:
+        """ Give ``n`` and all the nodes below it back, to be reused.
+        """
+        cdef vector[node*] stack
+        cdef uint32_t i
+        stack.push_back(n)
+        while not stack.empty():
+            n = stack.back()
+            stack.pop_back()
+            for i in range(n.n_children):
+                stack.push_back(childAt(n, i))
+            freeChildren(n)
+            self.sums.erase(n)
+            self.free_nodes.push_back(n)
+
+    cdef void _release_nodes(self) noexcept nogil:
+        """ Free all the nodes, chunk by chunk, without walking the trie.
+        """
+        cdef size_t i, j, used
+        cdef node* n
+        for i in range(self.chunks.size()):
+            used = NODES_PER_CHUNK if i + 1 < self.chunks.size() else self.chunk_used
+            for j in range(used):
+                n = self.chunks[i] + j
+                # the nodes given back have nothing left to free
+                freeChildren(n)
+            free(self.chunks[i])
+        self.chunks.clear()
+        self.sums.clear()
+        self.chunks.shrink_to_fit()
+        self.free_nodes.clear()
+        self.free_nodes.shrink_to_fit()
+        self.chunk_used = 0
+        self.root = NULL
+
+    def clear(self):
+        """ Remove all the n-grams. The vocabulary is kept.
+        """
+        self._release_nodes()
+        self.root = self._new_node()
+        self._set_normalization([])
+        self.ev_count.clear()
+        self.ev_sum.clear()
+        self.ev_sq_sum.clear()
+        self.depth = 0
+        self.dirty = True
+        self.generation += 1
+
     cdef fill_breaks(self, terminals):
         for t in terminals:
             self.breaks.insert(self.encode_token(t))
 
 
     cdef _get_voc_rec(self, node* n, prefix, decoder, acc):
-        cdef unordered_map[int,node*].iterator it = n.children.begin()
-        cdef node *child
-        while it != n.children.end():
-            token = dereference(it).first
-            child = dereference(it).second
-            count = child.count
-            ngram = prefix + [decoder[token]]
+        cdef uint32_t i
+        for i in range(n.n_children):
+            ngram = prefix + [decoder[tokenAt(n, i)]]
             acc.append(ngram)
-            acc = self._get_voc_rec(child, ngram, decoder, acc)
-            postincrement(it)
+            acc = self._get_voc_rec(childAt(n, i), ngram, decoder, acc)
         return acc
 
     def get_voc(self):
-        decoder = {v:k for k,v in self.encoder.items()}
-        return self._get_voc_rec(self.root, [], decoder, [])
+        return self._get_voc_rec(self.root, [], self.vocabulary.tokens, [])
+
+    cdef void _prune(self, node* n, int64_t qnt) noexcept:
+        cdef node* child
+        cdef uint32_t i
+        cdef uint32_t kept = 0
+        for i in range(n.n_children):
+            child = childAt(n, i)
+            child.count -= qnt
+            if child.count <= 0:
+                self._free_subtree(child)
+                if n.children.index != NULL:
+                    n.children.index.erase(tokenAt(n, i))
+            else:
+                self._prune(child, qnt)
+                # the children left are moved to the front, still sorted
+                childNodes(n.children)[kept] = child
+                childTokens(n.children)[kept] = tokenAt(n, i)
+                kept += 1
+        if kept == 0:
+            # a leaf now, its entropy is no longer defined
+            freeChildren(n)
+            n.entropy = NAN
+            return
+        n.n_children = kept
+        if n.children.index != NULL and kept <= HASHED_FANOUT:
+            del n.children.index
+            n.children.index = NULL
 
     def prune(self, qnt=1):
-        pruneNode(self.root, qnt)
+        self._prune(self.root, qnt)
         self.dirty = True
+        self.generation += 1
+        if self.incremental:
+            self._rebuild_stats()
 
+    cdef int _merge(self, node* src, const vector[int32_t]& remap) except -1 nogil:
+        """ Add the counts of the trie of root ``src`` to this one, walking
+        both at once, with token ids mapped by ``remap`` if it is not empty.
+        """
+        cdef vector[pair[node_ptr, node_ptr]] stack
+        cdef node* dst
+        cdef node* child
+        cdef uint32_t i
+        cdef int32_t token
+        self.root.count += src.count
+        stack.push_back(pair[node_ptr, node_ptr](self.root, src))
+        while not stack.empty():
+            dst = stack.back().first
+            src = stack.back().second
+            stack.pop_back()
+            if dst.n_children == 0 and src.n_children > 0:
+                reserveChildren(dst, src.n_children)
+            for i in range(src.n_children):
+                token = tokenAt(src, i) if remap.empty() else remap[tokenAt(src, i)]
+                child = findChild(dst, token)
+                if child == NULL:
+                    child = self._new_node()
+                    addChild(dst, token, child)
+                child.count += childAt(src, i).count
+                stack.push_back(pair[node_ptr, node_ptr](child, childAt(src, i)))
+        return 0
 
-    cdef _update_stats_rec(self, parent_entropy, depth, node* currentNode):
-        """ Recurively update both entropy and normalization vector
+    def merge(self, CythonTrie other):
+        """ Add the counts of all the n-grams of ``other`` to this trie, as
+        if its n-grams had been added here too. Both tries are walked at
+        once; the tokens of ``other`` are added to the vocabulary of this
+        trie when they are missing, and its token ids are mapped to the ids
+        of this one.
         """
-        # extend normalization vector if needed
-        cdef unordered_map[int,node*].iterator it
-        cdef node *child
+        cdef vector[int32_t] remap
+        checkpoint_vocabulary(other.vocabulary.tokens, self.vocabulary, remap)
+        with nogil:
+            self._merge(other.root, remap)
+        self.dirty = True
+        self.generation += 1
+        if self.incremental:
+            self._rebuild_stats()
 
-        while len(self.normalization) < depth:
-            self.normalization.append((0.0, 0.0, 0))
-        # if MemoryLeaf nothing else should be done
-        if currentNode.children.size() == 0:
-            return
-        updateEntropy(currentNode, self.breaks)
-        #node.update_entropy(self.terminals)
-        # update entropy variation mean and std if possible (not NaN)
-        if (
-            depth > 0
-            and not math.isnan(currentNode.entropy)
-            and (currentNode.entropy or parent_entropy)
-        ):
-            ev = currentNode.entropy - parent_entropy
-            mean, stdev, count = self.normalization[depth - 1]
-            old_mean = mean
-            count += 1
-            mean += (ev - old_mean) / count
-            stdev += (ev - old_mean) * (ev - mean)
-            self.normalization[depth - 1] = mean, stdev, count
-        # recurifs calls
-        it = currentNode.children.begin()
-        while it != currentNode.children.end():
-            child = dereference(it).second
-            self._update_stats_rec(currentNode.entropy, depth + 1, child)
-            postincrement(it)
 
-    def update_stats(self):
+    def update_stats(self, n_jobs=1):
+        """ Update the entropies and the normalization.
+
+        :param n_jobs: number of threads used. The subtrees of the root are
+          split between them, and processed without the GIL.
+        """
         if not self.dirty:
             return
-        self.normalization = []
-        self._update_stats_rec(NaN, 0, self.root)
-        for pseudo_depth, (mean, _stdev, count) in enumerate(self.normalization):
-            stdev = math.sqrt(_stdev / (count or 1))
-            self.normalization[pseudo_depth] = (mean, stdev)
+        if self.incremental:
+            self._finalize_incremental_stats()
+            self.dirty = False
+            return
+        cdef vector[welford] acc
+        if n_jobs > 1:
+            run_stats_jobs(self._stats_jobs(n_jobs), n_jobs)
+            return
+        with nogil:
+            updateStats(self.root, NAN, 0, self.breaks, acc)
+        self._set_normalization(welford_normalization(acc))
         self.dirty = False
 
-    cdef _rec_add_ngram(self, node* n, ngram, int freq):
+    cdef _set_normalization(self, list normalization):
+        self.normalization = normalization
+        self.norm_mean.clear()
+        self.norm_stdev.clear()
+        for mean, stdev in normalization:
+            self.norm_mean.push_back(mean)
+            self.norm_stdev.push_back(stdev)
+
+    def _stats_jobs(self, n_jobs):
+        """ Split the statistics update in (at most) ``n_jobs`` independent jobs.
+
+        :returns: a list of :class:`_StatsJob` to give to :func:`run_stats_jobs`,
+          or None if there is nothing to do in parallel.
+        """
+        cdef vector[pair[int64_t, node_ptr]] children
+        cdef pair[int64_t, node_ptr] child
+        cdef _StatsJob job
+        cdef size_t i
+        if not self.dirty or self.incremental:
+            return None
+        if self.root.n_children == 0:
+            self._set_normalization([])
+            self.dirty = False
+            return []
+        updateEntropy(self.root, self.breaks)
+        # biggest subtrees first, each one to the least loaded job
+        for i in range(self.root.n_children):
+            child.second = childAt(self.root, i)
+            child.first = -child.second.count
+            children.push_back(child)
+        std_sort(children.begin(), children.end())
+        jobs = []
+        for i in range(min(n_jobs, children.size())):
+            job = _StatsJob.__new__(_StatsJob)
+            job.trie = self
+            job.parent_entropy = self.root.entropy
+            jobs.append(job)
+        for i in range(children.size()):
+            job = min(jobs, key=_StatsJob.load)
+            job.nodes.push_back(children[i].second)
+            job.weight -= children[i].first
+        return jobs
+
+    def _merge_stats_jobs(self, jobs):
+        """ Merge the accumulators of the jobs (run) given by :func:`_stats_jobs`
+        into the normalization.
+        """
+        cdef vector[welford] acc
+        cdef _StatsJob job
+        cdef size_t d
+        cdef double delta
+        cdef welford a, b
+        for job in jobs:
+            while acc.size() < job.acc.size():
+                acc.push_back(welford(0.0, 0.0, 0))
+            # parallel combination of Welford accumulators
+            for d in range(job.acc.size()):
+                a = acc[d]
+                b = job.acc[d]
+                if b.count == 0:
+                    continue
+                delta = b.mean - a.mean
+                acc[d].count = a.count + b.count
+                acc[d].mean = a.mean + delta * b.count / acc[d].count
+                acc[d].m2 = a.m2 + b.m2 + delta * delta * a.count * b.count / acc[d].count
+        self._set_normalization(welford_normalization(acc))
+
+    cdef int _add_encoded(self, const int* tokens, size_t length, int freq) except -1:
+        """ Add an already encoded n-gram, walking down from the root.
+        """
+        cdef node* n = self.root
+        cdef node* child
+        cdef size_t i
+        if self.incremental:
+            return self._add_encoded_incremental(tokens, length, freq)
+        n.count += freq
+        for i in range(length):
+            child = findChild(n, tokens[i])
+            if child == NULL:
+                child = self._new_node()
+                addChild(n, tokens[i], child)
+            child.count += freq
+            n = child
+        self.dirty = True
+        self.generation += 1
+        return 0
+
+    cdef int _add_encoded_incremental(self, const int* tokens, size_t length, int freq) except -1:
+        """ Add an already encoded n-gram, and update the entropies and the
+        sums of entropy variations of the nodes on its path only.
+
+        The entropy variations of the children of a node are removed from the
+        per depth sums before the node changes, and added back after.
+        """
+        cdef vector[node*] path
+        cdef vector[node_stats*] path_sums
+        cdef vector[float] old_entropy
+        cdef vector[bint] was_inner
+        cdef node* n = self.root
         cdef node* child
+        cdef size_t i, old_size
+        cdef int64_t c
+        # existing part of the path
+        path.push_back(n)
+        for i in range(length):
+            n = findChild(n, tokens[i])
+            if n == NULL:
+                break
+            path.push_back(n)
+        old_size = path.size()
+        for i in range(old_size):
+            old_entropy.push_back(path[i].entropy)
+            was_inner.push_back(path[i].n_children > 0)
+            if i < length:
+                self._contribute(path[i], i, -1)
+        # counts and running sums
+        n = self.root
         n.count += freq
-        if len(ngram) > 0 :
-            head = ngram[0]
-            tail = ngram[1:]
-            if n.children.count(head) == 0:
-                child = createNode()
-                dereference(n.children)[head] = child
+        for i in range(length):
+            child = findChild(n, tokens[i])
+            if child == NULL:
+                child = self._new_node()
+                addChild(n, tokens[i], child)
+                path.push_back(child)
+            c = child.count
+            # zero-initialized when it is new
+            path_sums.push_back(&self.sums[n])
+            path_sums.back().total += freq
+            if self.breaks.count(tokens[i]) == 0:
+                path_sums.back().clogc += clogc(c + freq) - clogc(c)
+            child.count += freq
+            n = child
+        # entropies, then their sums in the parents
+        for i in range(length):
+            path[i].entropy = statsEntropy(path[i], path_sums[i], self.breaks)
+        for i in range(1, length):
+            if i < old_size and was_inner[i]:
+                updateChildEntropy(path_sums[i - 1], old_entropy[i], -1)
             else:
-                child = n.children.at(head)
-            self._rec_add_ngram(child, tail, freq)
+                path_sums[i - 1].n_inner += 1
+            updateChildEntropy(path_sums[i - 1], path[i].entropy, 1)
+        for i in range(length):
+            self._contribute(path[i], i, 1)
+        if length > self.depth:
+            self.depth = length
+        self.dirty = True
+        self.generation += 1
+        return 0
+
+    cdef void _contribute(self, node* n, size_t depth, int sign) noexcept:
+        """ Add (sign=1) or remove (sign=-1) the entropy variations of the
+        inner children of ``n`` to the sums of depth ``depth + 1``.
+        """
+        cdef unordered_map[node_ptr, node_stats].iterator it = self.sums.find(n)
+        cdef node_stats* stats
+        cdef double h = n.entropy
+        cdef int64_t k
+        cdef double s, sq
+        if it == self.sums.end() or dereference(it).second.n_inner == 0:
+            return
+        stats = &dereference(it).second
+        # as in _update_stats_rec, variations between two zero entropies are ignored
+        if h == 0:
+            k = stats.n_inner - stats.n_zero
+            s = stats.h_sum
+            sq = stats.h_sq_sum
+        else:
+            k = stats.n_inner
+            s = stats.h_sum - k * h
+            sq = stats.h_sq_sum - 2 * h * stats.h_sum + k * h * h
+        while self.ev_count.size() <= depth:
+            self.ev_count.push_back(0)
+            self.ev_sum.push_back(0.0)
+            self.ev_sq_sum.push_back(0.0)
+        self.ev_count[depth] += sign * k
+        self.ev_sum[depth] += sign * s
+        self.ev_sq_sum[depth] += sign * sq
+
+    cdef int _rebuild_stats(self) except -1:
+        """ Recompute all the running sums of an incremental trie.
+        """
+        self.ev_count.clear()
+        self.ev_sum.clear()
+        self.ev_sq_sum.clear()
+        self.depth = 0
+        self._rebuild_stats_rec(self.root, 0)
+        self.dirty = True
+        return 0
 
+    cdef int _rebuild_stats_rec(self, node* n, size_t depth) except -1:
+        cdef uint32_t i
+        cdef node* child
+        cdef node_stats* stats
+        if depth > self.depth:
+            self.depth = depth
+        if n.n_children == 0:
+            self.sums.erase(n)
+            n.entropy = NAN
+            return 0
+        stats = &self.sums[n]
+        stats[0] = node_stats(0, 0.0, 0, 0, 0.0, 0.0)
+        for i in range(n.n_children):
+            child = childAt(n, i)
+            self._rebuild_stats_rec(child, depth + 1)
+            stats.total += child.count
+            if self.breaks.count(tokenAt(n, i)) == 0:
+                stats.clogc += clogc(child.count)
+            if child.n_children > 0:
+                stats.n_inner += 1
+                updateChildEntropy(stats, child.entropy, 1)
+        n.entropy = statsEntropy(n, stats, self.breaks)
+        self._contribute(n, depth, 1)
+        return 0
+
+    cdef _finalize_incremental_stats(self):
+        """ Compute the normalization from the per depth sums, O(depth).
+        """
+        cdef size_t d
+        cdef double mean, var
+        normalization = []
+        for d in range(self.depth):
+            if d >= self.ev_count.size() or self.ev_count[d] <= 0:
+                normalization.append((0.0, 0.0))
+                continue
+            mean = self.ev_sum[d] / self.ev_count[d]
+            var = self.ev_sq_sum[d] / self.ev_count[d] - mean * mean
+            # rounding errors of the sums, where the variance is zero
+            if var <= 1e-10 * self.ev_sq_sum[d] / self.ev_count[d]:
+                var = 0.0
+            normalization.append((mean, math.sqrt(var)))
+        self._set_normalization(normalization)
+
+    cdef int _add_sentence_encoded(self, vector[int]& tokens, size_t ngram_length, int freq) except -1:
+        """ Add every n-gram of an encoded sentence (same n-grams as
+        :func:`eleve.memory.extract_ngrams`).
+        """
+        cdef size_t i
+        cdef size_t size = tokens.size()
+        for i in range(size - 1):
+            self._add_encoded(tokens.data() + i, min(ngram_length, size - i), freq)
+        return 0
+
+    cdef int _encode(self, tok) except -1:
+        return self.vocabulary.encode(tok)
 
     def encode_token(self, tok):
-        if tok in self.encoder:
-            return self.encoder[tok]
-        else:
-            code = len(self.encoder)
-            self.encoder[tok] = code
-            return code
+        return self._encode(tok)
 
     # todo: encode ngram into a C array or C++ vector
     def encode_ngram(self, ngram):
-        encoded = []
-        return [self.encode_token(tok) for tok in ngram]
+        return [self._encode(tok) for tok in ngram]
 
     def add_ngram(self, ngram, freq=1):
-        self._rec_add_ngram(self.root, self.encode_ngram(ngram), freq)
+        cdef vector[int] tokens
+        for tok in ngram:
+            tokens.push_back(self._encode(tok))
+        self._add_encoded(tokens.data(), tokens.size(), freq)
 
+    def add_sentences(self, sentences, freqs=None, int ngram_length=5,
+                      sentence_start=None, sentence_end=None, bint reverse=False):
+        """ Add all the n-grams of many sentences at once.
 
-    cdef node* _lookup(self, ngram, node* current_node):
-        if len(ngram) == 0:
-            return current_node
-        else:
-            head = ngram[0]
-            tail = ngram[1:]
-            if current_node.children.count(head) == 0:
-                return NULL
-            else:
-                return self._lookup(tail, current_node.children.at(head))
+        Sentences are encoded by batches, then their n-grams are inserted
+        without going back to Python.
 
-    cdef (node*, node*) _lookup2(self, ngram):
-        cdef node* n;
-        cdef node* last_node;
-        n = self.root
-        last_node = n
-        while ngram:
-            last_node = n
-            if n.children.count(ngram[0]) == 0:
-                return (NULL, NULL)
-            n = n.children.at(ngram[0])
-            ngram = ngram[1:]
-        return (last_node, n)
+        :param sentences: An iterable of sentences (lists of tokens).
+        :param freqs: An iterable of frequencies, one per sentence. One by default.
+        :param ngram_length: The length of n-grams that are stored.
+        :param sentence_start: If not None, token added at the beginning of each sentence.
+        :param sentence_end: If not None, token added at the end of each sentence.
+        :param reverse: If True, sentences are added right-to-left (for backward tries).
+        """
+        add_sentences(self, self.vocabulary, sentences, freqs, ngram_length,
+                      sentence_start, sentence_end, reverse)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def add_encoded_sentences(self, const int[::1] ids, const int64_t[::1] offsets, freqs=None,
+                              int ngram_length=5, bint reverse=False):
+        """ Add all the n-grams of sentences encoded by :func:`Vocabulary.encode_sentences`.
+
+        :param freqs: A sequence of frequencies, one per sentence. One by default.
+        """
+        cdef vector[int] tokens
+        cdef Py_ssize_t k
+        cdef int freq = 1
+        if ngram_length <= 0:
+            raise ValueError("ngram_length should be larger or equal to 1")
+        for k in range(offsets.shape[0] - 1):
+            if freqs is not None:
+                freq = freqs[k]
+            if freq <= 0:
+                raise ValueError("freq should be larger or equal to 1")
+            if offsets[k + 1] == offsets[k]:
+                continue
+            tokens.assign(&ids[offsets[k]], &ids[0] + offsets[k + 1])
+            if reverse:
+                std_reverse(tokens.begin(), tokens.end())
+            self._add_sentence_encoded(tokens, ngram_length, freq)
+
+    cdef void _encode_query(self, ngram, vector[int]& codes):
+        """ Encode ``ngram`` in ``codes`` without modifying the vocabulary:
+        unknown tokens are encoded as -1, which is never in the trie.
+        """
+        codes.clear()
+        self.vocabulary._lookup_into(ngram, codes)
+
+    cdef node* _lookup(self, ngram, node** parent):
+        """ Node of ``ngram`` (NULL if it does not exist), and its parent in ``parent``.
+        The n-gram is encoded first, then walked without the GIL.
+        """
+        cdef vector[int] codes
+        cdef node* n
+        self._encode_query(ngram, codes)
+        with nogil:
+            n = walkPath(self.root, codes.data(), codes.size(), parent)
+        return n
 
     def query_count(self, ngram):
-        cdef node *n;
-        ngram = self.encode_ngram(ngram)
-        n = self._lookup(ngram, self.root)
+        cdef node* parent
+        cdef node* n = self._lookup(ngram, &parent)
         if n:
             return n.count
         else:
             return 0
 
     def query_entropy(self, ngram):
-        cdef node *n;
-        ngram = self.encode_ngram(ngram)
-        n = self._lookup(ngram, self.root)
+        cdef node* parent
+        cdef node* n = self._lookup(ngram, &parent)
         if n:
             return n.entropy
         else:
@@ -276,26 +1132,183 @@ cdef class CythonTrie:
         :param ngram: A list of tokens.
         :returns: A float, that can be NaN if it is not defined.
         """
-        cdef node *n;
-        cdef node *last_node;
-        ngram = self.encode_ngram(ngram)
+        cdef node* n
+        cdef node* parent
         self._check_dirty()
         if not ngram:
             return float("nan")
-        last_node, n = self._lookup2(ngram)
-        if (not last_node) or (not n):
+        n = self._lookup(ngram, &parent)
+        if not n:
             return float("nan")
-        if not math.isnan(n.entropy) and (
-                n.entropy != 0 or last_node.entropy != 0
+        if not isnan(n.entropy) and (
+                n.entropy != 0 or parent.entropy != 0
         ):
-            return n.entropy - last_node.entropy
+            return <double> n.entropy - <double> parent.entropy
         return float("nan")
 
+    def freeze(self):
+        """ Build a read-only, compact copy of the trie (see :class:`FrozenTrie`).
+
+        Statistics are updated first if needed.
+        """
+        cdef vector[node*] nodes
+        cdef vector[int32_t] tokens
+        cdef vector[uint32_t] child_start
+        cdef node* n
+        cdef size_t i, j
+        cdef FrozenTrie frozen
+        self.update_stats()
+        # level-order traversal, children sorted by token
+        nodes.push_back(self.root)
+        tokens.push_back(-1)
+        child_start.push_back(1)
+        i = 0
+        while i < nodes.size():
+            n = nodes[i]
+            for j in range(n.n_children):
+                tokens.push_back(tokenAt(n, j))
+                nodes.push_back(childAt(n, j))
+            child_start.push_back(nodes.size())
+            i += 1
+        checkLevelSize(nodes.size())
+        frozen = FrozenTrie.__new__(FrozenTrie)
+        frozen._allocate(nodes.size(), len(self.normalization))
+        for i in range(nodes.size()):
+            frozen.counts[i] = nodes[i].count
+            frozen.entropies[i] = nodes[i].entropy
+            frozen.tokens[i] = tokens[i]
+            frozen.child_start[i] = child_start[i]
+        frozen.child_start[nodes.size()] = child_start[nodes.size()]
+        for i, (mean, stdev) in enumerate(self.normalization):
+            frozen.norm_mean[i] = mean
+            frozen.norm_stdev[i] = stdev
+        frozen.vocabulary = self.vocabulary
+        return frozen
+
+    def save(self, f):
+        """ Save the whole trie (including its statistics) to a binary file
+        object. Nodes are streamed, in bounded memory.
+        """
+        cdef vector[node*] stack
+        cdef vector[int32_t] tokens
+        cdef vector[node_record] records
+        cdef node_record record
+        cdef node* n
+        cdef uint32_t i
+        write_checkpoint_state(f, {
+            "tokens": self.vocabulary.tokens,
+            "breaks": [b for b in self.breaks],
+            "normalization": self.normalization,
+            "dirty": self.dirty,
+            "incremental": self.incremental,
+        }, self._count_nodes())
+        stack.push_back(self.root)
+        tokens.push_back(-1)
+        while not stack.empty():
+            n = stack.back()
+            record.token = tokens.back()
+            stack.pop_back()
+            tokens.pop_back()
+            record.n_children = n.n_children
+            record.count = n.count
+            record.entropy = n.entropy
+            records.push_back(record)
+            if records.size() == RECORDS_PER_CHUNK:
+                f.write((<char*> records.data())[:records.size() * sizeof(node_record)])
+                records.clear()
+            # pushed backwards, so that children are written sorted
+            for i in range(n.n_children, 0, -1):
+                tokens.push_back(tokenAt(n, i - 1))
+                stack.push_back(childAt(n, i - 1))
+        f.write((<char*> records.data())[:records.size() * sizeof(node_record)])
+
+    @staticmethod
+    def load(f, Vocabulary vocabulary=None):
+        """ Load a trie saved with :func:`save` from a binary file object.
+
+        :param vocabulary: If given, the :class:`Vocabulary` of the loaded trie
+          (its tokens are added to it), a new one otherwise.
+        """
+        cdef vector[int32_t] remap
+        state, n_nodes = read_checkpoint_state(f)
+        cdef CythonTrie trie = CythonTrie(
+            vocabulary=checkpoint_vocabulary(state["tokens"], vocabulary, remap))
+        for b in state["breaks"]:
+            trie.breaks.insert(b if remap.empty() else remap[b])
+        trie._set_normalization(state["normalization"])
+        trie.dirty = state["dirty"]
+        trie.incremental = state.get("incremental", False)
+        trie._read_nodes(f, n_nodes, remap)
+        if trie.incremental:
+            trie._rebuild_stats()
+        return trie
+
+    def __reduce__(self):
+        f = io.BytesIO()
+        self.save(f)
+        return (_load_trie, (f.getvalue(),))
+
+    cdef size_t _count_nodes(self):
+        cdef vector[node*] stack
+        cdef node* n
+        cdef size_t count = 0
+        cdef uint32_t i
+        stack.push_back(self.root)
+        while not stack.empty():
+            n = stack.back()
+            stack.pop_back()
+            count += 1
+            for i in range(n.n_children):
+                stack.push_back(childAt(n, i))
+        return count
+
+    cdef _read_nodes(self, f, size_t n_nodes, const vector[int32_t]& remap):
+        """ Rebuild the nodes from the DFS pre-order records written by :func:`save`,
+        with token ids mapped by ``remap`` if it is not empty.
+        """
+        # parents whose children are still being read, and how many are left
+        cdef vector[node*] parents
+        cdef vector[uint32_t] remaining
+        cdef const node_record* records
+        cdef const char* data
+        cdef size_t i, size
+        cdef node* n
+        while n_nodes:
+            size = min(n_nodes, RECORDS_PER_CHUNK)
+            chunk = f.read(size * sizeof(node_record))
+            if len(chunk) != size * sizeof(node_record):
+                raise ValueError("Truncated trie checkpoint")
+            data = chunk
+            records = <const node_record*> data
+            for i in range(size):
+                if parents.empty():
+                    n = self.root
+                else:
+                    n = self._new_node()
+                    addChild(parents.back(), records[i].token if remap.empty() else remap[records[i].token], n)
+                    remaining[remaining.size() - 1] -= 1
+                n.count = records[i].count
+                n.entropy = records[i].entropy
+                if records[i].n_children:
+                    reserveChildren(n, records[i].n_children)
+                    parents.push_back(n)
+                    remaining.push_back(records[i].n_children)
+                while not parents.empty() and remaining.back() == 0:
+                    parents.pop_back()
+                    remaining.pop_back()
+            n_nodes -= size
+
     def _check_dirty(self):
-        if self.dirty:
-            logging.warning(
-                "Updating the tree statistics (update_stats method), as we query it while dirty. This is a slow operation."
-            )
+        if not self.dirty:
+            return
+        with self.stats_lock:
+            if not self.dirty:
+                # updated by another thread in the meantime
+                return
+            if not self.incremental:
+                logging.warning(
+                    "Updating the tree statistics (update_stats method), as we query it while dirty. This is a slow operation."
+                )
             self.update_stats()
 
     def query_autonomy(self, ngram, z_score=True):
@@ -305,7 +1318,14 @@ cdef class CythonTrie:
                 :param z_score: If True, compute the z_score ((value - mean) / stdev). If False, just substract the mean.
                 :returns: A float, that can be NaN if it is not defined.
                 """
+        cdef node* n
+        cdef node* parent
         self._check_dirty()
+        if z_score:
+            n = self._lookup(ngram, &parent)
+            if n == NULL:
+                return float("nan")
+            return self._autonomy(n, parent, len(ngram))
         try:
             mean, stdev = self.normalization[len(ngram) - 1]
         except IndexError:
@@ -320,3 +1340,2108 @@ cdef class CythonTrie:
             except ZeroDivisionError:
                 return float("nan")
         return nev
+
+    cdef void _stats(self, const int* codes, size_t length, ngram_stats* out) noexcept:
+        """ Count, entropy, entropy variation and autonomy of an encoded
+        n-gram, once statistics are up to date.
+        """
+        cdef node* parent
+        cdef node* n = walkPath(self.root, codes, length, &parent)
+        self._node_stats(n, parent, length, out)
+
+    cdef void _node_stats(self, node* n, node* parent, size_t length, ngram_stats* out) noexcept:
+        """ Same as :func:`_stats`, for the n-gram of ``length`` tokens that
+        ends at ``n`` (NULL if it does not exist), a child of ``parent``.
+        """
+        out[0] = ngram_stats(0, NAN, NAN, NAN)
+        if n == NULL:
+            return
+        out.count = n.count
+        out.entropy = n.entropy
+        if length > 0 and not isnan(n.entropy) and (n.entropy != 0 or parent.entropy != 0):
+            out.ev = <double> n.entropy - <double> parent.entropy
+        out.autonomy = self._autonomy(n, parent, length)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def query_count_many(self, ngrams, lengths=None):
+        """ Query the counts of many n-grams at once (see :func:`query_autonomy_many`).
+
+        :returns: A numpy array of integers.
+        """
+        import numpy
+        ids, lengths, order = batch_arrays(self.vocabulary, ngrams, lengths)
+        cdef const int32_t[:, ::1] ids_view = ids
+        cdef const Py_ssize_t[::1] lengths_view = lengths
+        cdef const Py_ssize_t[::1] order_view = order
+        cdef vector[node_ptr] nodes = vector[node_ptr](len(lengths))
+        cdef vector[node_ptr] parents = vector[node_ptr](len(lengths))
+        counts = numpy.zeros(len(lengths), dtype=numpy.int64)
+        cdef int64_t[::1] out = counts
+        cdef Py_ssize_t r
+        with nogil:
+            walkMany(self.root, ids_view, lengths_view, order_view, nodes.data(), parents.data())
+            for r in range(out.shape[0]):
+                if nodes[r] != NULL:
+                    out[r] = nodes[r].count
+        return counts
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def query_autonomy_many(self, ngrams, lengths=None):
+        """ Query the autonomies of many n-grams at once. The n-grams are
+        looked up in lexicographic order, each walk starting again from the
+        prefix it shares with the previous n-gram.
+
+        :param ngrams: A list of n-grams, or a 2-D array of token ids (see
+          :func:`encode_ngrams`), padded on the right.
+        :param lengths: If ``ngrams`` is an array of ids, the length of each n-gram.
+        :returns: A numpy array of floats, that can be NaN if not defined.
+        """
+        import numpy
+        ids, lengths, order = batch_arrays(self.vocabulary, ngrams, lengths)
+        cdef const int32_t[:, ::1] ids_view = ids
+        cdef const Py_ssize_t[::1] lengths_view = lengths
+        cdef const Py_ssize_t[::1] order_view = order
+        cdef vector[node_ptr] nodes = vector[node_ptr](len(lengths))
+        cdef vector[node_ptr] parents = vector[node_ptr](len(lengths))
+        autonomies = numpy.empty(len(lengths), dtype=numpy.float64)
+        cdef double[::1] out = autonomies
+        cdef Py_ssize_t r
+        self._check_dirty()
+        with nogil:
+            walkMany(self.root, ids_view, lengths_view, order_view, nodes.data(), parents.data())
+            for r in range(out.shape[0]):
+                if nodes[r] == NULL:
+                    out[r] = NAN
+                else:
+                    out[r] = self._autonomy(nodes[r], parents[r], lengths_view[r])
+        return autonomies
+
+    cdef inline double _autonomy(self, node* n, node* parent, size_t depth) noexcept nogil:
+        """ Autonomy of a node, once statistics are up to date.
+        """
+        return nodeAutonomy(n.entropy, parent.entropy, depth,
+                            self.norm_mean.data(), self.norm_stdev.data(), self.norm_mean.size())
+
+    def autonomy_lattice(self, sentence, size_t max_len, bint backward=False):
+        """ Autonomies of all the n-grams of a sentence, up to ``max_len``
+        tokens. There is one walk from the root for each start of n-gram (each
+        end for a backward trie), that stops as soon as the n-gram is unknown.
+
+        :param sentence: A list of tokens, or a ``str`` (a token per character).
+        :param max_len: The maximum length of the n-grams.
+        :param backward: If True, the trie is a backward one: n-grams are looked up right to left.
+        :returns: A numpy array ``A`` of shape ``(len(sentence), max_len)``,
+          ``A[i, j - 1]`` being the autonomy of ``sentence[i:i + j]`` (NaN if not defined).
+        """
+        import numpy
+        cdef vector[int] codes
+        self.vocabulary._lookup_into(sentence, codes)
+        lattice = numpy.full((codes.size(), max_len), NaN)
+        cdef double[:, ::1] out = lattice
+        self._check_dirty()
+        with nogil:
+            self._lattice(codes.data(), codes.size(), max_len, backward, out)
+        return lattice
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef void _lattice(self, const int* codes, size_t length, size_t max_len, bint backward,
+                       double[:, ::1] out) noexcept nogil:
+        """ Fill ``out`` (filled with NaN) with the autonomy lattice of an
+        encoded sentence, see :func:`autonomy_lattice`.
+        """
+        cdef size_t i, j, start
+        cdef node* n
+        cdef node* parent
+        cdef node* child
+        for i in range(length):
+            n = self.root
+            for j in range(1, max_len + 1):
+                # n-gram of length j starting (or ending, if backward) at i
+                if backward:
+                    if j > i + 1:
+                        break
+                    start = i + 1 - j
+                    child = findChild(n, codes[start])
+                else:
+                    if i + j > length:
+                        break
+                    start = i
+                    child = findChild(n, codes[i + j - 1])
+                if child == NULL:
+                    break
+                parent = n
+                n = child
+                out[start, j - 1] = self._autonomy(n, parent, j)
+
+    def encode_ngrams(self, ngrams):
+        """ Encode n-grams for :func:`query_autonomy_many` or :func:`query_count_many`.
+        Unknown tokens are encoded as -1 (and are not added to the vocabulary).
+
+        :returns: A couple with a 2-D numpy array of token ids, padded with -1,
+          and a numpy array with the length of each n-gram.
+        """
+        return encode_ngrams(self.vocabulary, ngrams)
+
+
+cdef class _StatsJob:
+    """ Statistics update of some subtrees of the root of a trie, see
+    :func:`CythonTrie._stats_jobs`.
+    """
+    cdef CythonTrie trie
+    cdef vector[node*] nodes
+    cdef int64_t weight
+    cdef float parent_entropy
+    cdef vector[welford] acc
+
+    def load(self):
+        return self.weight
+
+    def run(self):
+        cdef size_t i
+        with nogil:
+            for i in range(self.nodes.size()):
+                updateStats(self.nodes[i], self.parent_entropy, 1, self.trie.breaks, self.acc)
+
+
+def run_stats_jobs(jobs, n_jobs):
+    """ Run statistics jobs (of one or many tries) with ``n_jobs`` threads:
+    entropies first, then normalization of each trie.
+    """
+    cdef _StatsJob job
+    cdef CythonTrie trie
+    tries = {}
+    for job in jobs:
+        tries.setdefault(job.trie, []).append(job)
+    with ThreadPoolExecutor(n_jobs) as pool:
+        list(pool.map(_StatsJob.run, jobs))
+    for trie, trie_jobs in tries.items():
+        trie._merge_stats_jobs(trie_jobs)
+        trie.dirty = False
+
+
+cdef list welford_normalization(vector[welford]& acc):
+    """ (mean, stdev) of each depth from the accumulators of :func:`updateStats`.
+    """
+    return [(acc[d].mean, math.sqrt(acc[d].m2 / (acc[d].count or 1))) for d in range(acc.size())]
+
+
+cdef int checkLevelSize(size_t n_nodes) except -1:
+    """ Raise an ``OverflowError`` if ``n_nodes`` nodes do not fit in a trie
+    stored in level order: the ``child_start`` offsets are 32 bits.
+    """
+    if n_nodes > UINT32_MAX:
+        raise OverflowError("A trie stored in level order can not have more than 2 ** 32 - 1 nodes")
+    return 0
+
+
+cdef inline int64_t levelChild(const uint32_t* child_start, const int32_t* tokens,
+                               int64_t parent, int32_t token) noexcept nogil:
+    """ Index of the child of ``parent`` for ``token`` in a trie stored in
+    level order (see :class:`FrozenTrie`), -1 if there is none.
+    """
+    cdef int64_t lo = child_start[parent]
+    cdef int64_t hi = child_start[parent + 1]
+    cdef int64_t mid
+    # binary search, then linear scan on small ranges
+    while hi - lo > 8:
+        mid = (lo + hi) // 2
+        if tokens[mid] <= token:
+            lo = mid
+        else:
+            hi = mid
+    while lo < hi:
+        if tokens[lo] == token:
+            return lo
+        lo += 1
+    return -1
+
+
+cdef class FrozenTrie:
+    """ Read-only trie, built by :func:`CythonTrie.freeze`.
+
+    Nodes are stored in level order in flat arrays: the children of node ``i``
+    are the nodes ``child_start[i]`` to ``child_start[i + 1] - 1``, sorted by
+    token. The root is node 0. All the arrays live in one contiguous buffer.
+    """
+    cdef object _buffer
+    cdef size_t _offset
+    cdef size_t n_nodes
+    cdef size_t depth
+    cdef int64_t* counts
+    cdef double* norm_mean
+    cdef double* norm_stdev
+    cdef uint32_t* child_start
+    cdef int32_t* tokens
+    cdef float* entropies
+    cdef readonly Vocabulary vocabulary
+
+    dirty = False
+    generation = 0
+
+    cdef _allocate(self, size_t n_nodes, size_t depth):
+        self._bind(bytearray(frozen_size(n_nodes, depth)), 0, n_nodes, depth)
+
+    cdef _bind(self, buffer, size_t offset, size_t n_nodes, size_t depth):
+        """ Point the arrays into ``buffer``, starting at ``offset``.
+        """
+        cdef const unsigned char[::1] view = buffer
+        cdef char* p = <char*> &view[offset]
+        self._buffer = buffer
+        self._offset = offset
+        self.n_nodes = n_nodes
+        self.depth = depth
+        # 8 bytes aligned arrays first
+        self.counts = <int64_t*> p
+        p += sizeof(int64_t) * n_nodes
+        self.norm_mean = <double*> p
+        p += sizeof(double) * depth
+        self.norm_stdev = <double*> p
+        p += sizeof(double) * depth
+        self.child_start = <uint32_t*> p
+        p += sizeof(uint32_t) * (n_nodes + 1)
+        self.tokens = <int32_t*> p
+        p += sizeof(int32_t) * n_nodes
+        self.entropies = <float*> p
+
+    @property
+    def nbytes(self):
+        """ Size of the node arrays, in bytes.
+        """
+        return frozen_size(self.n_nodes, self.depth)
+
+    @property
+    def normalization(self):
+        return [(self.norm_mean[i], self.norm_stdev[i]) for i in range(self.depth)]
+
+    def max_depth(self):
+        return self.depth
+
+    def update_stats(self):
+        pass
+
+    def write(self, f):
+        """ Write the trie to a binary file object, in the format read by
+        :func:`from_buffer`. Tokens should be strings.
+        """
+        offsets, vocabulary = pack_tokens(self.vocabulary.tokens)
+        f.write(_TRIE_HEADER.pack(self.n_nodes, self.depth, len(offsets) - 1, len(vocabulary)))
+        f.write(memoryview(self._buffer)[self._offset : self._offset + self.nbytes])
+        f.write(bytes(padding(self.nbytes)))
+        f.write(offsets.tobytes())
+        f.write(vocabulary)
+        f.write(bytes(padding(len(vocabulary))))
+
+    @staticmethod
+    def from_buffer(buffer, size_t offset=0, Vocabulary shared=None):
+        """ Open a trie written by :func:`write`, without copying the node
+        arrays: they are used in place from ``buffer`` (typically a ``mmap``).
+
+        :param shared: A :class:`Vocabulary` to use, if it has the same tokens
+          as the trie (token ids can not be changed in place).
+
+        :returns: a couple with the trie and the offset of the end of the trie in the buffer.
+        """
+        cdef FrozenTrie trie = FrozenTrie.__new__(FrozenTrie)
+        n_nodes, depth, n_tokens, vocabulary_size = _TRIE_HEADER.unpack_from(buffer, offset)
+        offset += _TRIE_HEADER.size
+        trie._bind(buffer, offset, n_nodes, depth)
+        offset += trie.nbytes + padding(trie.nbytes)
+        tokens, offset = unpack_tokens(buffer, offset, n_tokens, vocabulary_size)
+        trie.vocabulary = shared if shared is not None and shared.tokens == tokens else Vocabulary(tokens)
+        return trie, offset
+
+    def freeze(self):
+        return self
+
+    cdef inline int64_t _child(self, int64_t parent, int32_t token) noexcept nogil:
+        """ Index of the child of ``parent`` for ``token``, -1 if there is none.
+        """
+        return levelChild(self.child_start, self.tokens, parent, token)
+
+    cdef int64_t _lookup(self, ngram, int64_t* parent) except -2:
+        """ Index of the node for ``ngram`` (-1 if it does not exist), and of its parent.
+        The n-gram is encoded first, then walked without the GIL.
+        """
+        cdef vector[int] codes
+        cdef int64_t n
+        self.vocabulary._lookup_into(ngram, codes)
+        with nogil:
+            n = self._walk(<const int32_t*> codes.data(), codes.size(), parent)
+        return n
+
+    cdef int64_t _walk(self, const int32_t* codes, size_t length, int64_t* parent) noexcept nogil:
+        """ Same as :func:`_lookup`, on encoded tokens.
+        """
+        cdef int64_t n = 0
+        cdef size_t i
+        parent[0] = 0
+        for i in range(length):
+            parent[0] = n
+            n = self._child(n, codes[i])
+            if n < 0:
+                return -1
+        return n
+
+    def get_voc(self):
+        decoder = self.vocabulary.tokens
+        acc = []
+        stack = [(0, [])]
+        while stack:
+            n, prefix = stack.pop()
+            for i in range(self.child_start[n + 1] - 1, self.child_start[n] - 1, -1):
+                ngram = prefix + [decoder[self.tokens[i]]]
+                stack.append((i, ngram))
+            if n:
+                acc.append(prefix)
+        return acc
+
+    def query_count(self, ngram):
+        cdef int64_t parent
+        cdef int64_t n = self._lookup(ngram, &parent)
+        if n < 0:
+            return 0
+        return self.counts[n]
+
+    def query_entropy(self, ngram):
+        cdef int64_t parent
+        cdef int64_t n = self._lookup(ngram, &parent)
+        if n < 0:
+            return float("nan")
+        return self.entropies[n]
+
+    def query_ev(self, ngram):
+        """ Query for the branching entropy variation.
+
+        :param ngram: A list of tokens.
+        :returns: A float, that can be NaN if it is not defined.
+        """
+        cdef int64_t parent
+        cdef int64_t n
+        if not ngram:
+            return float("nan")
+        n = self._lookup(ngram, &parent)
+        if n < 0:
+            return float("nan")
+        if not math.isnan(self.entropies[n]) and (
+                self.entropies[n] != 0 or self.entropies[parent] != 0
+        ):
+            return <double> self.entropies[n] - <double> self.entropies[parent]
+        return float("nan")
+
+    def query_autonomy(self, ngram, z_score=True):
+        """ Query the autonomy (normalized entropy variation) for the n-gram.
+
+        :param ngram: A list of tokens.
+        :param z_score: If True, compute the z_score ((value - mean) / stdev). If False, just substract the mean.
+        :returns: A float, that can be NaN if it is not defined.
+        """
+        cdef size_t length = len(ngram)
+        cdef int64_t parent
+        cdef int64_t n
+        if z_score:
+            n = self._lookup(ngram, &parent)
+            if n < 0:
+                return float("nan")
+            return nodeAutonomy(self.entropies[n], self.entropies[parent], length,
+                                self.norm_mean, self.norm_stdev, self.depth)
+        if length == 0 or length > self.depth:
+            return float("nan")
+        ev = self.query_ev(ngram)
+        if math.isnan(ev):
+            return float("nan")
+        return ev - self.norm_mean[length - 1]
+
+    cdef void _stats(self, const int* codes, size_t length, ngram_stats* out) noexcept:
+        """ See :func:`CythonTrie._stats`.
+        """
+        cdef int64_t parent
+        cdef int64_t n = self._walk(<const int32_t*> codes, length, &parent)
+        self._node_stats(n, parent, length, out)
+
+    cdef void _node_stats(self, int64_t n, int64_t parent, size_t length, ngram_stats* out) noexcept:
+        """ Same as :func:`_stats`, for the n-gram of ``length`` tokens that
+        ends at node ``n`` (-1 if it does not exist), a child of ``parent``.
+        """
+        out[0] = ngram_stats(0, NAN, NAN, NAN)
+        if n < 0:
+            return
+        out.count = self.counts[n]
+        out.entropy = self.entropies[n]
+        if length > 0 and not isnan(self.entropies[n]) and (
+                self.entropies[n] != 0 or self.entropies[parent] != 0
+        ):
+            out.ev = <double> self.entropies[n] - <double> self.entropies[parent]
+        out.autonomy = nodeAutonomy(self.entropies[n], self.entropies[parent], length,
+                                    self.norm_mean, self.norm_stdev, self.depth)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef void _walk_many(self, const int32_t[:, ::1] ids, const Py_ssize_t[::1] lengths,
+                         const Py_ssize_t[::1] order, int64_t* nodes, int64_t* parents) noexcept nogil:
+        """ Same as :func:`walkMany`, with node indexes (-1 if they do not exist).
+        """
+        cdef vector[int64_t] path
+        cdef Py_ssize_t k, r, d, length
+        cdef Py_ssize_t prev = -1
+        cdef int64_t child
+        path.push_back(0)
+        for k in range(order.shape[0]):
+            r = order[k]
+            length = lengths[r]
+            d = 0
+            if prev >= 0:
+                while d + 1 < <Py_ssize_t> path.size() and d < length and ids[r, d] == ids[prev, d]:
+                    d += 1
+            path.resize(d + 1)
+            while d < length:
+                child = self._child(path[d], ids[r, d])
+                if child < 0:
+                    break
+                path.push_back(child)
+                d += 1
+            if d < length:
+                nodes[r] = -1
+                parents[r] = -1
+            else:
+                nodes[r] = path[length]
+                parents[r] = path[length - 1] if length > 0 else 0
+            prev = r
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def query_count_many(self, ngrams, lengths=None):
+        """ Query the counts of many n-grams at once (see :func:`CythonTrie.query_autonomy_many`).
+
+        :returns: A numpy array of integers.
+        """
+        import numpy
+        ids, lengths, order = batch_arrays(self.vocabulary, ngrams, lengths)
+        cdef const int32_t[:, ::1] ids_view = ids
+        cdef const Py_ssize_t[::1] lengths_view = lengths
+        cdef const Py_ssize_t[::1] order_view = order
+        cdef vector[int64_t] nodes = vector[int64_t](len(lengths))
+        cdef vector[int64_t] parents = vector[int64_t](len(lengths))
+        counts = numpy.zeros(len(lengths), dtype=numpy.int64)
+        cdef int64_t[::1] out = counts
+        cdef Py_ssize_t r
+        with nogil:
+            self._walk_many(ids_view, lengths_view, order_view, nodes.data(), parents.data())
+            for r in range(out.shape[0]):
+                if nodes[r] >= 0:
+                    out[r] = self.counts[nodes[r]]
+        return counts
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def query_autonomy_many(self, ngrams, lengths=None):
+        """ Query the autonomies of many n-grams at once (see :func:`CythonTrie.query_autonomy_many`).
+
+        :returns: A numpy array of floats, that can be NaN if not defined.
+        """
+        import numpy
+        ids, lengths, order = batch_arrays(self.vocabulary, ngrams, lengths)
+        cdef const int32_t[:, ::1] ids_view = ids
+        cdef const Py_ssize_t[::1] lengths_view = lengths
+        cdef const Py_ssize_t[::1] order_view = order
+        cdef vector[int64_t] nodes = vector[int64_t](len(lengths))
+        cdef vector[int64_t] parents = vector[int64_t](len(lengths))
+        autonomies = numpy.empty(len(lengths), dtype=numpy.float64)
+        cdef double[::1] out = autonomies
+        cdef Py_ssize_t r
+        with nogil:
+            self._walk_many(ids_view, lengths_view, order_view, nodes.data(), parents.data())
+            for r in range(out.shape[0]):
+                if nodes[r] < 0:
+                    out[r] = NAN
+                else:
+                    out[r] = nodeAutonomy(self.entropies[nodes[r]], self.entropies[parents[r]], lengths_view[r],
+                                          self.norm_mean, self.norm_stdev, self.depth)
+        return autonomies
+
+    def encode_ngrams(self, ngrams):
+        """ See :func:`CythonTrie.encode_ngrams`.
+        """
+        return encode_ngrams(self.vocabulary, ngrams)
+
+    def autonomy_lattice(self, sentence, size_t max_len, bint backward=False):
+        """ See :func:`CythonTrie.autonomy_lattice`.
+        """
+        import numpy
+        cdef vector[int] codes
+        self.vocabulary._lookup_into(sentence, codes)
+        lattice = numpy.full((codes.size(), max_len), NaN)
+        cdef double[:, ::1] out = lattice
+        with nogil:
+            self._lattice(codes.data(), codes.size(), max_len, backward, out)
+        return lattice
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef void _lattice(self, const int* codes, size_t length, size_t max_len, bint backward,
+                       double[:, ::1] out) noexcept nogil:
+        """ See :func:`CythonTrie._lattice`.
+        """
+        cdef size_t i, j, start
+        cdef int64_t n, parent
+        for i in range(length):
+            n = 0
+            for j in range(1, max_len + 1):
+                if backward:
+                    if j > i + 1:
+                        break
+                    start = i + 1 - j
+                    parent, n = n, self._child(n, codes[start])
+                else:
+                    if i + j > length:
+                        break
+                    start = i
+                    parent, n = n, self._child(n, codes[i + j - 1])
+                if n < 0:
+                    break
+                out[start, j - 1] = nodeAutonomy(self.entropies[n], self.entropies[parent], j,
+                                                 self.norm_mean, self.norm_stdev, self.depth)
+
+
+cdef inline uint64_t linkKey(uint32_t parent, int32_t token) noexcept nogil:
+    return (<uint64_t> parent << 32) | <uint32_t> token
+
+
+cdef inline uint64_t hashKey(uint64_t key) noexcept nogil:
+    # splitmix64 finalizer: consecutive parents and tokens are well spread
+    key += 0x9e3779b97f4a7c15ULL
+    key = (key ^ (key >> 30)) * 0xbf58476d1ce4e5b9ULL
+    key = (key ^ (key >> 27)) * 0x94d049bb133111ebULL
+    return key ^ (key >> 31)
+
+
+cdef class HashTrie:
+    """ Trie of n-gram counts stored in flat arrays, an alternative to
+    :class:`CythonTrie` with the same interface.
+
+    Nodes are numbered, the root being node 0, and their counts and entropies
+    are arrays indexed by node. The links of the whole trie are in one
+    open-addressing hash table (linear probing), that maps
+    ``(parent, token)`` to the child. A node is created after its parent,
+    so its number is always greater. There is no per node allocation: a
+    node takes about 30 bytes, the table included.
+
+    Incremental statistics are not supported, and statistics are updated by
+    one thread. Node numbers are 32 bits: a trie has at most ``2 ** 32``
+    nodes. The concurrency contract is the same as the one of :class:`CythonTrie`.
+    """
+    cdef vector[int64_t] counts
+    cdef vector[float] entropies
+    # hash table: keys are (parent << 32 | token), values the children (0 for a free slot)
+    cdef vector[uint64_t] keys
+    cdef vector[uint32_t] values
+    cdef uint64_t mask
+    cdef cset[int] breaks
+    cdef list normalization
+    cdef vector[double] norm_mean
+    cdef vector[double] norm_stdev
+    cdef bint dirty
+    cdef readonly Vocabulary vocabulary
+    cdef readonly size_t generation
+    cdef object stats_lock
+
+    incremental = False
+
+    def __init__(self, terminals=frozenset(), incremental=False, Vocabulary vocabulary=None):
+        """ Constructor
+
+        :param terminals: Tokens that are counted as distinct in the entropy computation.
+        :param incremental: Should be False, incremental statistics are only
+          provided by :class:`CythonTrie`.
+        :param vocabulary: The :class:`Vocabulary` of the trie, a new one by default.
+        """
+        if incremental:
+            raise ValueError("HashTrie does not support incremental statistics")
+        self.vocabulary = vocabulary if vocabulary is not None else Vocabulary()
+        self.dirty = True
+        self.stats_lock = threading.Lock()
+        self._reset()
+        for t in terminals:
+            self.breaks.insert(self._encode(t))
+
+    cdef void _reset(self) noexcept:
+        self.counts.assign(1, 0)
+        self.entropies.assign(1, NAN)
+        self.keys.assign(HASH_MIN_CAPACITY, 0)
+        self.values.assign(HASH_MIN_CAPACITY, 0)
+        self.mask = HASH_MIN_CAPACITY - 1
+        self._set_normalization([])
+
+    def clear(self):
+        """ Remove all the n-grams. The vocabulary is kept.
+        """
+        self._reset()
+        self.counts.shrink_to_fit()
+        self.entropies.shrink_to_fit()
+        self.keys.shrink_to_fit()
+        self.values.shrink_to_fit()
+        self.dirty = True
+        self.generation += 1
+
+    @property
+    def n_nodes(self):
+        """ Number of nodes, the root included.
+        """
+        return self.counts.size()
+
+    @property
+    def nbytes(self):
+        """ Size of the node arrays and of the hash table, in bytes.
+        """
+        return (self.counts.capacity() * sizeof(int64_t) + self.entropies.capacity() * sizeof(float)
+                + self.keys.capacity() * sizeof(uint64_t) + self.values.capacity() * sizeof(uint32_t))
+
+    cdef inline int64_t _child(self, uint32_t parent, int32_t token) noexcept nogil:
+        """ Child of ``parent`` for ``token``, -1 if there is none.
+        """
+        cdef uint64_t key = linkKey(parent, token)
+        cdef uint64_t slot = hashKey(key) & self.mask
+        while self.values[slot] != 0:
+            if self.keys[slot] == key:
+                return self.values[slot]
+            slot = (slot + 1) & self.mask
+        return -1
+
+    cdef int _check_room(self, size_t n_nodes) except -1 nogil:
+        """ Raise an ``OverflowError`` if ``n_nodes`` more nodes would not fit:
+        node numbers are 32 bits. To be called before :func:`_child_or_new`.
+        """
+        if n_nodes > <size_t> UINT32_MAX + 1 - self.counts.size():
+            with gil:
+                raise OverflowError("A HashTrie can not have more than 2 ** 32 nodes")
+        return 0
+
+    cdef uint32_t _child_or_new(self, uint32_t parent, int32_t token) noexcept nogil:
+        """ Child of ``parent`` for ``token``, created if there is none (see
+        :func:`_check_room`).
+        """
+        cdef uint64_t key = linkKey(parent, token)
+        cdef uint64_t slot = hashKey(key) & self.mask
+        cdef uint32_t child
+        while self.values[slot] != 0:
+            if self.keys[slot] == key:
+                return self.values[slot]
+            slot = (slot + 1) & self.mask
+        child = self.counts.size()
+        self.counts.push_back(0)
+        self.entropies.push_back(NAN)
+        self.keys[slot] = key
+        self.values[slot] = child
+        # at most 70% of the slots are used
+        if 10 * <uint64_t> child > 7 * (self.mask + 1):
+            self._rehash(2 * (self.mask + 1))
+        return child
+
+    cdef void _rehash(self, uint64_t capacity) noexcept nogil:
+        """ Move the links in a new table of ``capacity`` slots (a power of two).
+        """
+        cdef vector[uint64_t] keys
+        cdef vector[uint32_t] values
+        cdef uint64_t i, slot
+        keys.swap(self.keys)
+        values.swap(self.values)
+        self.keys.assign(capacity, 0)
+        self.values.assign(capacity, 0)
+        self.mask = capacity - 1
+        for i in range(values.size()):
+            if values[i] != 0:
+                slot = hashKey(keys[i]) & self.mask
+                while self.values[slot] != 0:
+                    slot = (slot + 1) & self.mask
+                self.keys[slot] = keys[i]
+                self.values[slot] = values[i]
+
+    cdef void _links(self, vector[uint32_t]& parents, vector[int32_t]& tokens) noexcept nogil:
+        """ Parent and token of each node, read from the hash table.
+        """
+        cdef uint64_t i
+        parents.assign(self.counts.size(), 0)
+        tokens.assign(self.counts.size(), -1)
+        for i in range(self.values.size()):
+            if self.values[i] != 0:
+                parents[self.values[i]] = self.keys[i] >> 32
+                tokens[self.values[i]] = <int32_t> (self.keys[i] & 0xffffffffULL)
+
+    cdef void _children(self, vector[uint32_t]& child_start, vector[uint32_t]& children) noexcept nogil:
+        """ Children of each node, sorted by token: the children of node ``i``
+        are ``children[child_start[i]:child_start[i + 1]]``.
+        """
+        cdef vector[pair[uint64_t, uint32_t]] links
+        cdef uint64_t i
+        cdef size_t n_nodes = self.counts.size()
+        for i in range(self.values.size()):
+            if self.values[i] != 0:
+                links.push_back(pair[uint64_t, uint32_t](self.keys[i] ^ 0x80000000ULL, self.values[i]))
+        # the sign bit of tokens is flipped so that they are sorted as signed integers
+        std_sort(links.begin(), links.end())
+        child_start.assign(n_nodes + 1, 0)
+        children.clear()
+        for i in range(links.size()):
+            child_start[(links[i].first >> 32) + 1] += 1
+            children.push_back(links[i].second)
+        for i in range(n_nodes):
+            child_start[i + 1] += child_start[i]
+
+    def get_voc(self):
+        cdef vector[uint32_t] child_start
+        cdef vector[uint32_t] children
+        cdef vector[uint32_t] parents
+        cdef vector[int32_t] tokens
+        cdef uint32_t i
+        decoder = self.vocabulary.tokens
+        self._children(child_start, children)
+        self._links(parents, tokens)
+        acc = []
+        stack = [(0, [])]
+        while stack:
+            n, prefix = stack.pop()
+            for i in range(child_start[n + 1], child_start[n], -1):
+                stack.append((children[i - 1], prefix + [decoder[tokens[children[i - 1]]]]))
+            if n:
+                acc.append(prefix)
+        return acc
+
+    def prune(self, qnt=1):
+        """ Subtract ``qnt`` from the count of every n-gram, and remove the
+        ones whose count is no longer positive (and the n-grams they start).
+        Remaining nodes are renumbered in the same order, and the table is rebuilt.
+        """
+        cdef vector[uint32_t] parents
+        cdef vector[int32_t] tokens
+        cdef vector[int64_t] new_id
+        cdef int64_t q = qnt
+        cdef size_t i, kept = 1
+        cdef uint64_t capacity = HASH_MIN_CAPACITY
+        cdef uint64_t slot, key
+        with nogil:
+            self._links(parents, tokens)
+            new_id.assign(self.counts.size(), -1)
+            new_id[0] = 0
+            for i in range(1, self.counts.size()):
+                self.counts[i] -= q
+                # parents are numbered before their children
+                if self.counts[i] > 0 and new_id[parents[i]] >= 0:
+                    new_id[i] = kept
+                    self.counts[kept] = self.counts[i]
+                    self.entropies[kept] = self.entropies[i]
+                    parents[kept] = new_id[parents[i]]
+                    tokens[kept] = tokens[i]
+                    kept += 1
+            self.counts.resize(kept)
+            self.entropies.resize(kept)
+            while 10 * (kept - 1) > 7 * capacity:
+                capacity *= 2
+            self.keys.assign(capacity, 0)
+            self.values.assign(capacity, 0)
+            self.mask = capacity - 1
+            for i in range(1, kept):
+                key = linkKey(parents[i], tokens[i])
+                slot = hashKey(key) & self.mask
+                while self.values[slot] != 0:
+                    slot = (slot + 1) & self.mask
+                self.keys[slot] = key
+                self.values[slot] = i
+        self.dirty = True
+        self.generation += 1
+
+    def merge(self, HashTrie other):
+        """ Add the counts of all the n-grams of ``other`` to this trie, as
+        if its n-grams had been added here too. The nodes of ``other`` are
+        read in order, so that the parent of each one is already merged; its
+        token ids are mapped to the ids of this trie (missing tokens are
+        added to the vocabulary).
+        """
+        cdef vector[int32_t] remap
+        cdef vector[uint32_t] parents
+        cdef vector[int32_t] tokens
+        cdef vector[uint32_t] merged
+        cdef size_t i
+        checkpoint_vocabulary(other.vocabulary.tokens, self.vocabulary, remap)
+        with nogil:
+            self._check_room(other.counts.size() - 1)
+            other._links(parents, tokens)
+            # node of this trie for each node of other
+            merged.assign(other.counts.size(), 0)
+            self.counts[0] += other.counts[0]
+            for i in range(1, merged.size()):
+                merged[i] = self._child_or_new(merged[parents[i]], tokens[i] if remap.empty() else remap[tokens[i]])
+                self.counts[merged[i]] += other.counts[i]
+        self.dirty = True
+        self.generation += 1
+
+    def update_stats(self, n_jobs=1):
+        """ Update the entropies and the normalization.
+
+        :param n_jobs: ignored, it is only accepted for the interface of
+          :class:`CythonTrie`: the update is a few linear passes over the
+          node arrays, always done by one thread.
+        """
+        cdef vector[uint32_t] parents
+        cdef vector[int32_t] tokens
+        cdef vector[double] total
+        cdef vector[double] entropy
+        cdef vector[uint32_t] depth
+        cdef vector[welford] acc
+        cdef size_t i, n_nodes = self.counts.size()
+        cdef double c, t, ev, old_mean
+        cdef float parent_entropy
+        cdef welford* w
+        if not self.dirty:
+            return
+        with nogil:
+            self._links(parents, tokens)
+            total.assign(n_nodes, 0.0)
+            entropy.assign(n_nodes, NAN)
+            depth.assign(n_nodes, 0)
+            for i in range(1, n_nodes):
+                total[parents[i]] += self.counts[i]
+                entropy[parents[i]] = 0.0
+            for i in range(1, n_nodes):
+                c = self.counts[i]
+                t = total[parents[i]]
+                if self.breaks.count(tokens[i]) > 0:
+                    entropy[parents[i]] += (c / t) * log2(t)
+                else:
+                    entropy[parents[i]] -= (c / t) * log2(c / t)
+            for i in range(n_nodes):
+                self.entropies[i] = entropy[i]
+            # entropy variations of each depth, as in updateStats
+            for i in range(1, n_nodes):
+                depth[i] = depth[parents[i]] + 1
+                while acc.size() < depth[i]:
+                    acc.push_back(welford(0.0, 0.0, 0))
+                parent_entropy = self.entropies[parents[i]]
+                if not isnan(self.entropies[i]) and (self.entropies[i] != 0 or parent_entropy != 0):
+                    ev = <double> self.entropies[i] - <double> parent_entropy
+                    w = &acc[depth[i] - 1]
+                    old_mean = w.mean
+                    w.count += 1
+                    w.mean += (ev - old_mean) / w.count
+                    w.m2 += (ev - old_mean) * (ev - w.mean)
+        self._set_normalization(welford_normalization(acc))
+        self.dirty = False
+
+    def _stats_jobs(self, n_jobs):
+        """ There is nothing to split, see :func:`update_stats`.
+        """
+        return None
+
+    cdef _set_normalization(self, list normalization):
+        self.normalization = normalization
+        self.norm_mean.clear()
+        self.norm_stdev.clear()
+        for mean, stdev in normalization:
+            self.norm_mean.push_back(mean)
+            self.norm_stdev.push_back(stdev)
+
+    def _check_dirty(self):
+        if not self.dirty:
+            return
+        with self.stats_lock:
+            if not self.dirty:
+                # updated by another thread in the meantime
+                return
+            logging.warning(
+                "Updating the tree statistics (update_stats method), as we query it while dirty. This is a slow operation."
+            )
+            self.update_stats()
+
+    cdef int _add_encoded(self, const int* tokens, size_t length, int freq) except -1:
+        """ Add an already encoded n-gram, walking down from the root.
+        """
+        cdef uint32_t n = 0
+        cdef size_t i
+        self._check_room(length)
+        self.counts[0] += freq
+        for i in range(length):
+            n = self._child_or_new(n, tokens[i])
+            self.counts[n] += freq
+        self.dirty = True
+        self.generation += 1
+        return 0
+
+    cdef int _encode(self, tok) except -1:
+        return self.vocabulary.encode(tok)
+
+    def encode_token(self, tok):
+        return self._encode(tok)
+
+    def encode_ngram(self, ngram):
+        return [self._encode(tok) for tok in ngram]
+
+    def add_ngram(self, ngram, freq=1):
+        cdef vector[int] tokens
+        for tok in ngram:
+            tokens.push_back(self._encode(tok))
+        self._add_encoded(tokens.data(), tokens.size(), freq)
+
+    def add_sentences(self, sentences, freqs=None, int ngram_length=5,
+                      sentence_start=None, sentence_end=None, bint reverse=False):
+        """ Add all the n-grams of many sentences at once (see :func:`CythonTrie.add_sentences`).
+        """
+        add_sentences(self, self.vocabulary, sentences, freqs, ngram_length,
+                      sentence_start, sentence_end, reverse)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def add_encoded_sentences(self, const int[::1] ids, const int64_t[::1] offsets, freqs=None,
+                              int ngram_length=5, bint reverse=False):
+        """ See :func:`CythonTrie.add_encoded_sentences`.
+        """
+        cdef vector[int] tokens
+        cdef Py_ssize_t k
+        cdef size_t i
+        cdef int freq = 1
+        if ngram_length <= 0:
+            raise ValueError("ngram_length should be larger or equal to 1")
+        for k in range(offsets.shape[0] - 1):
+            if freqs is not None:
+                freq = freqs[k]
+            if freq <= 0:
+                raise ValueError("freq should be larger or equal to 1")
+            if offsets[k + 1] == offsets[k]:
+                continue
+            tokens.assign(&ids[offsets[k]], &ids[0] + offsets[k + 1])
+            if reverse:
+                std_reverse(tokens.begin(), tokens.end())
+            # same n-grams as eleve.memory.extract_ngrams
+            for i in range(tokens.size() - 1):
+                self._add_encoded(tokens.data() + i, min(<size_t> ngram_length, tokens.size() - i), freq)
+
+    cdef int64_t _walk(self, const int32_t* codes, size_t length, int64_t* parent) noexcept nogil:
+        """ Node of the encoded n-gram (-1 if it does not exist), and its parent.
+        """
+        cdef int64_t n = 0
+        cdef size_t i
+        parent[0] = 0
+        for i in range(length):
+            parent[0] = n
+            n = self._child(n, codes[i])
+            if n < 0:
+                return -1
+        return n
+
+    cdef int64_t _lookup(self, ngram, int64_t* parent) except -2:
+        """ Node of ``ngram`` (-1 if it does not exist), and its parent.
+        The n-gram is encoded first, then walked without the GIL.
+        """
+        cdef vector[int] codes
+        cdef int64_t n
+        self.vocabulary._lookup_into(ngram, codes)
+        with nogil:
+            n = self._walk(<const int32_t*> codes.data(), codes.size(), parent)
+        return n
+
+    cdef inline double _autonomy(self, int64_t n, int64_t parent, size_t depth) noexcept nogil:
+        return nodeAutonomy(self.entropies[n], self.entropies[parent], depth,
+                            self.norm_mean.data(), self.norm_stdev.data(), self.norm_mean.size())
+
+    def query_count(self, ngram):
+        cdef int64_t parent
+        cdef int64_t n = self._lookup(ngram, &parent)
+        if n < 0:
+            return 0
+        return self.counts[n]
+
+    def query_entropy(self, ngram):
+        cdef int64_t parent
+        cdef int64_t n = self._lookup(ngram, &parent)
+        if n < 0:
+            return float("nan")
+        return self.entropies[n]
+
+    def query_ev(self, ngram):
+        """ Query for the branching entropy variation.
+
+        :param ngram: A list of tokens.
+        :returns: A float, that can be NaN if it is not defined.
+        """
+        cdef int64_t parent
+        cdef int64_t n
+        self._check_dirty()
+        if not ngram:
+            return float("nan")
+        n = self._lookup(ngram, &parent)
+        if n < 0:
+            return float("nan")
+        if not isnan(self.entropies[n]) and (
+                self.entropies[n] != 0 or self.entropies[parent] != 0
+        ):
+            return <double> self.entropies[n] - <double> self.entropies[parent]
+        return float("nan")
+
+    def query_autonomy(self, ngram, z_score=True):
+        """ Query the autonomy (normalized entropy variation) for the n-gram.
+
+        :param ngram: A list of tokens.
+        :param z_score: If True, compute the z_score ((value - mean) / stdev). If False, just substract the mean.
+        :returns: A float, that can be NaN if it is not defined.
+        """
+        cdef int64_t parent
+        cdef int64_t n
+        self._check_dirty()
+        if z_score:
+            n = self._lookup(ngram, &parent)
+            if n < 0:
+                return float("nan")
+            return self._autonomy(n, parent, len(ngram))
+        try:
+            mean, stdev = self.normalization[len(ngram) - 1]
+        except IndexError:
+            return float("nan")
+        ev = self.query_ev(ngram)
+        if math.isnan(ev):
+            return float("nan")
+        return ev - mean
+
+    cdef void _stats(self, const int* codes, size_t length, ngram_stats* out) noexcept:
+        """ See :func:`CythonTrie._stats`.
+        """
+        cdef int64_t parent
+        cdef int64_t n = self._walk(<const int32_t*> codes, length, &parent)
+        self._node_stats(n, parent, length, out)
+
+    cdef void _node_stats(self, int64_t n, int64_t parent, size_t length, ngram_stats* out) noexcept:
+        """ Same as :func:`_stats`, for the n-gram of ``length`` tokens that
+        ends at node ``n`` (-1 if it does not exist), a child of ``parent``.
+        """
+        out[0] = ngram_stats(0, NAN, NAN, NAN)
+        if n < 0:
+            return
+        out.count = self.counts[n]
+        out.entropy = self.entropies[n]
+        if length > 0 and not isnan(self.entropies[n]) and (
+                self.entropies[n] != 0 or self.entropies[parent] != 0
+        ):
+            out.ev = <double> self.entropies[n] - <double> self.entropies[parent]
+        out.autonomy = self._autonomy(n, parent, length)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef void _walk_many(self, const int32_t[:, ::1] ids, const Py_ssize_t[::1] lengths,
+                         const Py_ssize_t[::1] order, int64_t* nodes, int64_t* parents) noexcept nogil:
+        """ Same as :func:`walkMany`, with node numbers (-1 if they do not exist).
+        """
+        cdef vector[int64_t] path
+        cdef Py_ssize_t k, r, d, length
+        cdef Py_ssize_t prev = -1
+        cdef int64_t child
+        path.push_back(0)
+        for k in range(order.shape[0]):
+            r = order[k]
+            length = lengths[r]
+            d = 0
+            if prev >= 0:
+                while d + 1 < <Py_ssize_t> path.size() and d < length and ids[r, d] == ids[prev, d]:
+                    d += 1
+            path.resize(d + 1)
+            while d < length:
+                child = self._child(path[d], ids[r, d])
+                if child < 0:
+                    break
+                path.push_back(child)
+                d += 1
+            if d < length:
+                nodes[r] = -1
+                parents[r] = -1
+            else:
+                nodes[r] = path[length]
+                parents[r] = path[length - 1] if length > 0 else 0
+            prev = r
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def query_count_many(self, ngrams, lengths=None):
+        """ Query the counts of many n-grams at once (see :func:`CythonTrie.query_autonomy_many`).
+
+        :returns: A numpy array of integers.
+        """
+        import numpy
+        ids, lengths, order = batch_arrays(self.vocabulary, ngrams, lengths)
+        cdef const int32_t[:, ::1] ids_view = ids
+        cdef const Py_ssize_t[::1] lengths_view = lengths
+        cdef const Py_ssize_t[::1] order_view = order
+        cdef vector[int64_t] nodes = vector[int64_t](len(lengths))
+        cdef vector[int64_t] parents = vector[int64_t](len(lengths))
+        counts = numpy.zeros(len(lengths), dtype=numpy.int64)
+        cdef int64_t[::1] out = counts
+        cdef Py_ssize_t r
+        with nogil:
+            self._walk_many(ids_view, lengths_view, order_view, nodes.data(), parents.data())
+            for r in range(out.shape[0]):
+                if nodes[r] >= 0:
+                    out[r] = self.counts[nodes[r]]
+        return counts
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def query_autonomy_many(self, ngrams, lengths=None):
+        """ Query the autonomies of many n-grams at once (see :func:`CythonTrie.query_autonomy_many`).
+
+        :returns: A numpy array of floats, that can be NaN if not defined.
+        """
+        import numpy
+        ids, lengths, order = batch_arrays(self.vocabulary, ngrams, lengths)
+        cdef const int32_t[:, ::1] ids_view = ids
+        cdef const Py_ssize_t[::1] lengths_view = lengths
+        cdef const Py_ssize_t[::1] order_view = order
+        cdef vector[int64_t] nodes = vector[int64_t](len(lengths))
+        cdef vector[int64_t] parents = vector[int64_t](len(lengths))
+        autonomies = numpy.empty(len(lengths), dtype=numpy.float64)
+        cdef double[::1] out = autonomies
+        cdef Py_ssize_t r
+        self._check_dirty()
+        with nogil:
+            self._walk_many(ids_view, lengths_view, order_view, nodes.data(), parents.data())
+            for r in range(out.shape[0]):
+                if nodes[r] < 0:
+                    out[r] = NAN
+                else:
+                    out[r] = self._autonomy(nodes[r], parents[r], lengths_view[r])
+        return autonomies
+
+    def autonomy_lattice(self, sentence, size_t max_len, bint backward=False):
+        """ See :func:`CythonTrie.autonomy_lattice`.
+        """
+        import numpy
+        cdef vector[int] codes
+        self.vocabulary._lookup_into(sentence, codes)
+        lattice = numpy.full((codes.size(), max_len), NaN)
+        cdef double[:, ::1] out = lattice
+        self._check_dirty()
+        with nogil:
+            self._lattice(codes.data(), codes.size(), max_len, backward, out)
+        return lattice
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef void _lattice(self, const int* codes, size_t length, size_t max_len, bint backward,
+                       double[:, ::1] out) noexcept nogil:
+        """ See :func:`CythonTrie._lattice`.
+        """
+        cdef size_t i, j, start
+        cdef int64_t n, parent
+        for i in range(length):
+            n = 0
+            for j in range(1, max_len + 1):
+                if backward:
+                    if j > i + 1:
+                        break
+                    start = i + 1 - j
+                    parent, n = n, self._child(n, codes[start])
+                else:
+                    if i + j > length:
+                        break
+                    start = i
+                    parent, n = n, self._child(n, codes[i + j - 1])
+                if n < 0:
+                    break
+                out[start, j - 1] = self._autonomy(n, parent, j)
+
+    def encode_ngrams(self, ngrams):
+        """ See :func:`CythonTrie.encode_ngrams`.
+        """
+        return encode_ngrams(self.vocabulary, ngrams)
+
+    def freeze(self):
+        """ Build a read-only, compact copy of the trie (see :class:`FrozenTrie`).
+
+        Statistics are updated first if needed.
+        """
+        cdef vector[uint32_t] child_start
+        cdef vector[uint32_t] children
+        cdef vector[uint32_t] nodes
+        cdef vector[uint32_t] parents
+        cdef vector[int32_t] tokens
+        cdef size_t i, j
+        cdef FrozenTrie frozen
+        self.update_stats()
+        self._children(child_start, children)
+        self._links(parents, tokens)
+        checkLevelSize(self.counts.size())
+        # level-order traversal, children sorted by token
+        frozen = FrozenTrie.__new__(FrozenTrie)
+        frozen._allocate(self.counts.size(), len(self.normalization))
+        nodes.push_back(0)
+        frozen.child_start[0] = 1
+        i = 0
+        while i < nodes.size():
+            for j in range(child_start[nodes[i]], child_start[nodes[i] + 1]):
+                nodes.push_back(children[j])
+            frozen.child_start[i + 1] = nodes.size()
+            frozen.counts[i] = self.counts[nodes[i]]
+            frozen.entropies[i] = self.entropies[nodes[i]]
+            frozen.tokens[i] = tokens[nodes[i]]
+            i += 1
+        for i, (mean, stdev) in enumerate(self.normalization):
+            frozen.norm_mean[i] = mean
+            frozen.norm_stdev[i] = stdev
+        frozen.vocabulary = self.vocabulary
+        return frozen
+
+    def save(self, f):
+        """ Save the whole trie to a binary file object, in the format of
+        :func:`CythonTrie.save`: a checkpoint can be loaded by both classes.
+        """
+        cdef vector[uint32_t] child_start
+        cdef vector[uint32_t] children
+        cdef vector[uint32_t] parents
+        cdef vector[int32_t] tokens
+        cdef vector[uint32_t] stack
+        cdef vector[node_record] records
+        cdef node_record record
+        cdef uint32_t n, i
+        write_checkpoint_state(f, {
+            "tokens": self.vocabulary.tokens,
+            "breaks": [b for b in self.breaks],
+            "normalization": self.normalization,
+            "dirty": self.dirty,
+            "incremental": False,
+        }, self.counts.size())
+        self._children(child_start, children)
+        self._links(parents, tokens)
+        stack.push_back(0)
+        while not stack.empty():
+            n = stack.back()
+            stack.pop_back()
+            record.token = tokens[n]
+            record.n_children = child_start[n + 1] - child_start[n]
+            record.count = self.counts[n]
+            record.entropy = self.entropies[n]
+            records.push_back(record)
+            if records.size() == RECORDS_PER_CHUNK:
+                f.write((<char*> records.data())[:records.size() * sizeof(node_record)])
+                records.clear()
+            # pushed backwards, so that children are written sorted
+            for i in range(child_start[n + 1], child_start[n], -1):
+                stack.push_back(children[i - 1])
+        f.write((<char*> records.data())[:records.size() * sizeof(node_record)])
+
+    @staticmethod
+    def load(f, Vocabulary vocabulary=None):
+        """ Load a trie saved with :func:`save` (or :func:`CythonTrie.save`)
+        from a binary file object.
+
+        :param vocabulary: See :func:`CythonTrie.load`.
+        """
+        cdef HashTrie trie
+        cdef vector[int32_t] remap
+        cdef vector[uint32_t] parents
+        cdef vector[uint32_t] remaining
+        cdef const node_record* records
+        cdef const char* data
+        cdef size_t i, size
+        cdef uint32_t n
+        state, n_nodes = read_checkpoint_state(f)
+        if state.get("incremental", False):
+            raise ValueError("HashTrie does not support incremental statistics")
+        trie = HashTrie(vocabulary=checkpoint_vocabulary(state["tokens"], vocabulary, remap))
+        for b in state["breaks"]:
+            trie.breaks.insert(b if remap.empty() else remap[b])
+        trie._set_normalization(state["normalization"])
+        trie.dirty = state["dirty"]
+        trie._check_room(n_nodes - 1)
+        # nodes are numbered in DFS pre-order, parents before their children
+        while n_nodes:
+            size = min(n_nodes, RECORDS_PER_CHUNK)
+            chunk = f.read(size * sizeof(node_record))
+            if len(chunk) != size * sizeof(node_record):
+                raise ValueError("Truncated trie checkpoint")
+            data = chunk
+            records = <const node_record*> data
+            for i in range(size):
+                if parents.empty():
+                    n = 0
+                else:
+                    n = trie._child_or_new(parents.back(), records[i].token if remap.empty() else remap[records[i].token])
+                    remaining[remaining.size() - 1] -= 1
+                trie.counts[n] = records[i].count
+                trie.entropies[n] = records[i].entropy
+                if records[i].n_children:
+                    parents.push_back(n)
+                    remaining.push_back(records[i].n_children)
+                while not parents.empty() and remaining.back() == 0:
+                    parents.pop_back()
+                    remaining.pop_back()
+            n_nodes -= size
+        return trie
+
+    def __reduce__(self):
+        f = io.BytesIO()
+        self.save(f)
+        return (_load_hash_trie, (f.getvalue(),))
+
+
+cdef class Lexicon:
+    """ Read-only lexicon of n-grams with their autonomy and their count, as
+    dumped by :func:`eleve.memory.CSVStorage.writeCSV`.
+
+    The n-grams are stored in a trie laid out as a :class:`FrozenTrie` (level
+    order, the children of node ``i`` being the nodes ``child_start[i]`` to
+    ``child_start[i + 1] - 1``), with the autonomy of each node rather than
+    its entropy. Prefixes of n-grams that are not in the lexicon are nodes
+    too, with a NaN autonomy and a count of 0, so all the n-grams starting at
+    a position of a sentence are found by one walk from the root.
+    """
+    cdef object _buffer
+    cdef size_t _offset
+    cdef size_t n_nodes
+    cdef size_t depth
+    cdef int64_t* counts
+    cdef double* autonomies
+    cdef uint32_t* child_start
+    cdef int32_t* tokens
+    cdef readonly Vocabulary vocabulary
+
+    cdef _bind(self, buffer, size_t offset, size_t n_nodes, size_t depth):
+        """ Point the arrays into ``buffer``, starting at ``offset``.
+        """
+        cdef const unsigned char[::1] view = buffer
+        cdef char* p = <char*> &view[offset]
+        self._buffer = buffer
+        self._offset = offset
+        self.n_nodes = n_nodes
+        self.depth = depth
+        # 8 bytes aligned arrays first
+        self.counts = <int64_t*> p
+        p += sizeof(int64_t) * n_nodes
+        self.autonomies = <double*> p
+        p += sizeof(double) * n_nodes
+        self.child_start = <uint32_t*> p
+        p += sizeof(uint32_t) * (n_nodes + 1)
+        self.tokens = <int32_t*> p
+
+    @staticmethod
+    def build(entries):
+        """ Build a lexicon.
+
+        :param entries: An iterable of triples (n-gram, autonomy, count), an
+          n-gram being a list (or a tuple) of tokens, or a ``str`` whose
+          characters are the tokens.
+        """
+        cdef Lexicon lexicon = Lexicon.__new__(Lexicon)
+        # the n-grams are first inserted in a hash trie, then laid out in level order
+        cdef HashTrie trie = HashTrie()
+        cdef vector[int] codes
+        cdef vector[double] autonomies
+        cdef vector[int64_t] counts
+        cdef vector[uint32_t] child_start
+        cdef vector[uint32_t] children
+        cdef vector[uint32_t] parents
+        cdef vector[int32_t] tokens
+        cdef vector[uint32_t] nodes
+        cdef uint32_t n
+        cdef size_t i, j, depth = 0
+        for ngram, autonomy, count in entries:
+            codes.clear()
+            trie.vocabulary._encode_into(ngram, codes)
+            trie._check_room(codes.size())
+            n = 0
+            for i in range(codes.size()):
+                n = trie._child_or_new(n, codes[i])
+            depth = max(depth, codes.size())
+            if n >= autonomies.size():
+                autonomies.resize(trie.counts.size(), NAN)
+                counts.resize(trie.counts.size(), 0)
+            autonomies[n] = autonomy
+            counts[n] = count
+        autonomies.resize(trie.counts.size(), NAN)
+        counts.resize(trie.counts.size(), 0)
+        trie._children(child_start, children)
+        trie._links(parents, tokens)
+        checkLevelSize(trie.counts.size())
+        lexicon._bind(bytearray(lexicon_size(trie.counts.size())), 0, trie.counts.size(), depth)
+        lexicon.vocabulary = trie.vocabulary
+        nodes.push_back(0)
+        lexicon.child_start[0] = 1
+        i = 0
+        while i < nodes.size():
+            for j in range(child_start[nodes[i]], child_start[nodes[i] + 1]):
+                nodes.push_back(children[j])
+            lexicon.child_start[i + 1] = nodes.size()
+            lexicon.counts[i] = counts[nodes[i]]
+            lexicon.autonomies[i] = autonomies[nodes[i]]
+            lexicon.tokens[i] = tokens[nodes[i]]
+            i += 1
+        return lexicon
+
+    @property
+    def nbytes(self):
+        """ Size of the node arrays, in bytes.
+        """
+        return lexicon_size(self.n_nodes)
+
+    def max_depth(self):
+        return self.depth
+
+    def write(self, f):
+        """ Write the lexicon to a binary file object, in the format read by
+        :func:`from_buffer`. Tokens should be strings.
+        """
+        offsets, vocabulary = pack_tokens(self.vocabulary.tokens)
+        f.write(_TRIE_HEADER.pack(self.n_nodes, self.depth, len(offsets) - 1, len(vocabulary)))
+        f.write(memoryview(self._buffer)[self._offset : self._offset + self.nbytes])
+        f.write(bytes(padding(self.nbytes)))
+        f.write(offsets.tobytes())
+        f.write(vocabulary)
+        f.write(bytes(padding(len(vocabulary))))
+
+    @staticmethod
+    def from_buffer(buffer, size_t offset=0):
+        """ Open a lexicon written by :func:`write`, using its arrays in place
+        from ``buffer`` (see :func:`FrozenTrie.from_buffer`).
+
+        :returns: a couple with the lexicon and the offset of its end in the buffer.
+        """
+        cdef Lexicon lexicon = Lexicon.__new__(Lexicon)
+        n_nodes, depth, n_tokens, vocabulary_size = _TRIE_HEADER.unpack_from(buffer, offset)
+        offset += _TRIE_HEADER.size
+        lexicon._bind(buffer, offset, n_nodes, depth)
+        offset += lexicon.nbytes + padding(lexicon.nbytes)
+        tokens, offset = unpack_tokens(buffer, offset, n_tokens, vocabulary_size)
+        lexicon.vocabulary = Vocabulary(tokens)
+        return lexicon, offset
+
+    cdef int64_t _lookup(self, ngram) except -2:
+        """ Node of ``ngram``, -1 if it is not in the trie.
+        The n-gram is encoded first, then walked without the GIL.
+        """
+        cdef vector[int] codes
+        cdef int64_t n = 0
+        cdef size_t i
+        self.vocabulary._lookup_into(ngram, codes)
+        with nogil:
+            for i in range(codes.size()):
+                n = levelChild(self.child_start, self.tokens, n, codes[i])
+                if n < 0:
+                    break
+        return n
+
+    def get_voc(self):
+        """ The n-grams of the lexicon (as lists of tokens).
+        """
+        decoder = self.vocabulary.tokens
+        acc = []
+        stack = [(0, [])]
+        while stack:
+            n, prefix = stack.pop()
+            for i in range(self.child_start[n + 1] - 1, self.child_start[n] - 1, -1):
+                stack.append((i, prefix + [decoder[self.tokens[i]]]))
+            if n and (self.counts[n] or not isnan(self.autonomies[n])):
+                acc.append(prefix)
+        return acc
+
+    def query_autonomy(self, ngram):
+        cdef int64_t n = self._lookup(ngram)
+        return NaN if n < 0 else self.autonomies[n]
+
+    def query_count(self, ngram):
+        cdef int64_t n = self._lookup(ngram)
+        return 0 if n < 0 else self.counts[n]
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef void _walk_many(self, const int32_t[:, ::1] ids, const Py_ssize_t[::1] lengths,
+                         int64_t* nodes) noexcept nogil:
+        """ Nodes of encoded n-grams (-1 for the ones that are not in the trie).
+        """
+        cdef Py_ssize_t r, d
+        cdef int64_t n
+        for r in range(lengths.shape[0]):
+            n = 0
+            d = 0
+            while d < lengths[r] and n >= 0:
+                n = levelChild(self.child_start, self.tokens, n, ids[r, d])
+                d += 1
+            nodes[r] = n
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def query_autonomy_many(self, ngrams):
+        """ Query the autonomies of many n-grams at once.
+
+        :returns: A numpy array of floats, that can be NaN if not defined.
+        """
+        import numpy
+        ids, lengths = encode_ngrams(self.vocabulary, ngrams)
+        cdef const int32_t[:, ::1] ids_view = ids
+        cdef const Py_ssize_t[::1] lengths_view = lengths
+        cdef vector[int64_t] nodes = vector[int64_t](len(lengths))
+        autonomies = numpy.empty(len(lengths), dtype=numpy.float64)
+        cdef double[::1] out = autonomies
+        cdef Py_ssize_t r
+        with nogil:
+            self._walk_many(ids_view, lengths_view, nodes.data())
+            for r in range(out.shape[0]):
+                out[r] = NAN if nodes[r] < 0 else self.autonomies[nodes[r]]
+        return autonomies
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def query_count_many(self, ngrams):
+        """ Query the counts of many n-grams at once.
+
+        :returns: A numpy array of integers.
+        """
+        import numpy
+        ids, lengths = encode_ngrams(self.vocabulary, ngrams)
+        cdef const int32_t[:, ::1] ids_view = ids
+        cdef const Py_ssize_t[::1] lengths_view = lengths
+        cdef vector[int64_t] nodes = vector[int64_t](len(lengths))
+        counts = numpy.zeros(len(lengths), dtype=numpy.int64)
+        cdef int64_t[::1] out = counts
+        cdef Py_ssize_t r
+        with nogil:
+            self._walk_many(ids_view, lengths_view, nodes.data())
+            for r in range(out.shape[0]):
+                if nodes[r] >= 0:
+                    out[r] = self.counts[nodes[r]]
+        return counts
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def autonomy_lattice(self, sentence, size_t max_len):
+        """ Autonomies of all the n-grams of a sentence, up to ``max_len``
+        tokens, with one walk from the root for each start of n-gram.
+
+        :param sentence: A list of tokens, or a ``str`` (a token per character).
+        :returns: A numpy array ``A`` of shape ``(len(sentence), max_len)``,
+          ``A[i, j - 1]`` being the autonomy of ``sentence[i:i + j]`` (NaN if not defined).
+        """
+        import numpy
+        cdef vector[int] codes
+        cdef size_t i, j
+        cdef int64_t n
+        self.vocabulary._lookup_into(sentence, codes)
+        lattice = numpy.full((codes.size(), max_len), NaN)
+        cdef double[:, ::1] out = lattice
+        with nogil:
+            for i in range(codes.size()):
+                n = 0
+                j = 0
+                while j < max_len and i + j < codes.size():
+                    n = levelChild(self.child_start, self.tokens, n, codes[i + j])
+                    if n < 0:
+                        break
+                    out[i, j] = self.autonomies[n]
+                    j += 1
+        return lattice
+
+
+def encode_ngrams(Vocabulary vocabulary, ngrams):
+    """ Encode n-grams with ``vocabulary`` in a 2-D numpy array of token ids,
+    padded with -1. Unknown tokens are encoded as -1.
+
+    :returns: A couple with the array of ids and a numpy array with the length of each n-gram.
+    """
+    import numpy
+    cdef Py_ssize_t i
+    cdef size_t j
+    cdef vector[int] codes
+    ngrams = ngrams if isinstance(ngrams, list) else list(ngrams)
+    ids = numpy.full((len(ngrams), max(map(len, ngrams), default=0) or 1), -1, dtype=numpy.int32)
+    lengths = numpy.empty(len(ngrams), dtype=numpy.intp)
+    cdef int32_t[:, ::1] ids_view = ids
+    cdef Py_ssize_t[::1] lengths_view = lengths
+    for i, ngram in enumerate(ngrams):
+        codes.clear()
+        vocabulary._lookup_into(ngram, codes)
+        lengths_view[i] = codes.size()
+        for j in range(codes.size()):
+            ids_view[i, j] = codes[j]
+    return ids, lengths
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def reverse_ngrams(const int32_t[:, ::1] ids, const Py_ssize_t[::1] lengths):
+    """ Reverse the n-grams encoded by :func:`encode_ngrams` (for backward tries).
+
+    :returns: A new 2-D numpy array of token ids, padded with -1.
+    """
+    import numpy
+    cdef Py_ssize_t i, j
+    reversed_ids = numpy.full((ids.shape[0], ids.shape[1]), -1, dtype=numpy.int32)
+    cdef int32_t[:, ::1] out = reversed_ids
+    with nogil:
+        for i in range(ids.shape[0]):
+            for j in range(lengths[i]):
+                out[i, j] = ids[i, lengths[i] - 1 - j]
+    return reversed_ids
+
+
+cdef int trie_stats(trie, const int* codes, size_t length, ngram_stats* out) except -1:
+    """ :func:`CythonTrie._stats` of ``trie``, a :class:`CythonTrie`, a
+    :class:`HashTrie` or a :class:`FrozenTrie`, updating its statistics first if needed.
+    """
+    if type(trie) is CythonTrie:
+        if (<CythonTrie> trie).dirty:
+            trie._check_dirty()
+        (<CythonTrie> trie)._stats(codes, length, out)
+    elif type(trie) is HashTrie:
+        if (<HashTrie> trie).dirty:
+            trie._check_dirty()
+        (<HashTrie> trie)._stats(codes, length, out)
+    elif type(trie) is FrozenTrie:
+        (<FrozenTrie> trie)._stats(codes, length, out)
+    else:
+        raise TypeError("Unsupported trie %r" % (trie,))
+    return 0
+
+
+def query_tries(fwd, bwd, ngram):
+    """ Query an n-gram in a forward trie and in a backward trie at once. The
+    n-gram is encoded once if the tries share their vocabulary.
+
+    :returns: A tuple with the count of the n-gram, and the means over both
+      tries of its entropy, its entropy variation and its autonomy (each can
+      be NaN if it is not defined).
+    """
+    cdef Vocabulary vocabulary = fwd.vocabulary
+    cdef vector[int] fwd_codes
+    cdef vector[int] bwd_codes
+    cdef ngram_stats f, b
+    vocabulary._lookup_into(ngram, fwd_codes)
+    if bwd.vocabulary is vocabulary:
+        bwd_codes = fwd_codes
+    else:
+        (<Vocabulary> bwd.vocabulary)._lookup_into(ngram, bwd_codes)
+    std_reverse(bwd_codes.begin(), bwd_codes.end())
+    trie_stats(fwd, fwd_codes.data(), fwd_codes.size(), &f)
+    trie_stats(bwd, bwd_codes.data(), bwd_codes.size(), &b)
+    return f.count, (f.entropy + b.entropy) / 2, (f.ev + b.ev) / 2, (f.autonomy + b.autonomy) / 2
+
+
+
+cdef int trie_lattice(trie, const int* codes, size_t length, size_t max_len, bint backward,
+                      double[:, ::1] out) except -1:
+    """ :func:`CythonTrie._lattice` of ``trie`` (see :func:`trie_stats`).
+    """
+    if type(trie) is CythonTrie:
+        if (<CythonTrie> trie).dirty:
+            trie._check_dirty()
+        with nogil:
+            (<CythonTrie> trie)._lattice(codes, length, max_len, backward, out)
+    elif type(trie) is HashTrie:
+        if (<HashTrie> trie).dirty:
+            trie._check_dirty()
+        with nogil:
+            (<HashTrie> trie)._lattice(codes, length, max_len, backward, out)
+    elif type(trie) is FrozenTrie:
+        with nogil:
+            (<FrozenTrie> trie)._lattice(codes, length, max_len, backward, out)
+    else:
+        raise TypeError("Unsupported trie %r" % (trie,))
+    return 0
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def lattice_tries(fwd, bwd, sentence, size_t max_len):
+    """ Autonomy lattice of a sentence in a forward trie and in a backward
+    trie at once: the sentence is encoded once if the tries share their
+    vocabulary, and the mean of both lattices is computed in place.
+
+    :returns: A numpy array ``A`` of shape ``(len(sentence), max_len)``,
+      ``A[i, j - 1]`` being the autonomy of ``sentence[i:i + j]`` (NaN if not defined).
+    """
+    import numpy
+    cdef Vocabulary vocabulary = fwd.vocabulary
+    cdef vector[int] fwd_codes
+    cdef vector[int] bwd_codes
+    cdef const int* bwd_data
+    cdef size_t i, j
+    vocabulary._lookup_into(sentence, fwd_codes)
+    bwd_data = fwd_codes.data()
+    if bwd.vocabulary is not vocabulary:
+        (<Vocabulary> bwd.vocabulary)._lookup_into(sentence, bwd_codes)
+        bwd_data = bwd_codes.data()
+    cdef size_t length = fwd_codes.size()
+    lattice = numpy.full((length, max_len), NaN)
+    bwd_lattice = numpy.full((length, max_len), NaN)
+    cdef double[:, ::1] out = lattice
+    cdef double[:, ::1] bwd_out = bwd_lattice
+    trie_lattice(fwd, fwd_codes.data(), length, max_len, False, out)
+    trie_lattice(bwd, bwd_data, length, max_len, True, bwd_out)
+    with nogil:
+        for i in range(length):
+            for j in range(max_len):
+                out[i, j] = (out[i, j] + bwd_out[i, j]) / 2
+    return lattice
+
+
+cdef class _LexiconWalk:
+    """ Depth-first walk of the n-grams of a trie (a :class:`CythonTrie`, a
+    :class:`HashTrie` or a :class:`FrozenTrie`), one at a time: only the
+    current path is kept. See :func:`lexicon_rows`.
+    """
+    cdef object trie
+    # the current n-gram, and its count
+    cdef vector[int] path
+    cdef int64_t count
+    cdef size_t max_length
+    cdef int64_t min_count
+    cdef cset[int] excluded
+    # CythonTrie: stack of nodes
+    cdef bint pointers
+    cdef vector[node*] nodes
+    cdef node* pending_node
+    # HashTrie and FrozenTrie: stack of node indexes, children in CSR arrays
+    cdef vector[uint32_t] indexes
+    cdef uint32_t pending_index
+    cdef vector[uint32_t] child_start_v
+    cdef vector[uint32_t] children_v
+    cdef vector[int32_t] tokens_v
+    cdef const uint32_t* child_start
+    cdef const uint32_t* children
+    cdef const int32_t* tokens
+    cdef const int64_t* counts
+    # position of the next child to visit, for each node of the stack
+    cdef vector[uint32_t] next_child
+    # whether the current n-gram has children to visit
+    cdef bint pending
+
+    def __init__(self, trie, size_t max_length=0, int64_t min_count=1, exclude=()):
+        """
+        :param max_length: The maximum length of the n-grams (0 for no limit).
+        :param min_count: N-grams seen less often, and so their extensions, are skipped.
+        :param exclude: Tokens: n-grams that contain one of them are skipped.
+        """
+        cdef vector[uint32_t] parents
+        cdef Vocabulary vocabulary = trie.vocabulary
+        self.trie = trie
+        self.max_length = max_length
+        self.min_count = min_count
+        for tok in exclude:
+            if tok in vocabulary:
+                self.excluded.insert(vocabulary.codes[tok])
+        self.pointers = type(trie) is CythonTrie
+        if self.pointers:
+            self.nodes.push_back((<CythonTrie> trie).root)
+            self.next_child.push_back(0)
+            return
+        if type(trie) is HashTrie:
+            (<HashTrie> trie)._children(self.child_start_v, self.children_v)
+            (<HashTrie> trie)._links(parents, self.tokens_v)
+            self.child_start = self.child_start_v.data()
+            self.children = self.children_v.data()
+            self.tokens = self.tokens_v.data()
+            self.counts = (<HashTrie> trie).counts.data()
+        elif type(trie) is FrozenTrie:
+            # children are stored in place
+            self.child_start = (<FrozenTrie> trie).child_start
+            self.children = NULL
+            self.tokens = (<FrozenTrie> trie).tokens
+            self.counts = (<FrozenTrie> trie).counts
+        else:
+            raise TypeError("Unsupported trie %r" % (trie,))
+        self.indexes.push_back(0)
+        self.next_child.push_back(self.child_start[0])
+
+    cdef bint next(self) noexcept:
+        """ Move to the next n-gram (in ``path``, with its count in ``count``).
+
+        :returns: False at the end of the walk.
+        """
+        cdef uint32_t i, index
+        cdef int32_t token
+        cdef node* n
+        cdef node* child
+        if self.pending:
+            self.pending = False
+            if self.max_length == 0 or self.path.size() < self.max_length:
+                if self.pointers:
+                    self.nodes.push_back(self.pending_node)
+                    self.next_child.push_back(0)
+                else:
+                    self.indexes.push_back(self.pending_index)
+                    self.next_child.push_back(self.child_start[self.pending_index])
+            else:
+                self.path.pop_back()
+        while not self.next_child.empty():
+            i = self.next_child.back()
+            if self.pointers:
+                n = self.nodes.back()
+                if i == n.n_children:
+                    self.nodes.pop_back()
+                    self.next_child.pop_back()
+                    if not self.path.empty():
+                        self.path.pop_back()
+                    continue
+                child = childAt(n, i)
+                token = tokenAt(n, i)
+                self.count = child.count
+                self.pending_node = child
+            else:
+                if i == self.child_start[self.indexes.back() + 1]:
+                    self.indexes.pop_back()
+                    self.next_child.pop_back()
+                    if not self.path.empty():
+                        self.path.pop_back()
+                    continue
+                index = self.children[i] if self.children != NULL else i
+                token = self.tokens[index]
+                self.count = self.counts[index]
+                self.pending_index = index
+            self.next_child[self.next_child.size() - 1] += 1
+            if self.count < self.min_count or self.excluded.count(token):
+                continue
+            self.path.push_back(token)
+            self.pending = True
+            return True
+        return False
+
+    cdef void stats(self, ngram_stats* out) noexcept:
+        """ Statistics of the current n-gram (see :func:`CythonTrie._stats`),
+        read on the node the walk stands on. They should be up to date.
+        """
+        if self.pointers:
+            (<CythonTrie> self.trie)._node_stats(self.pending_node, self.nodes.back(), self.path.size(), out)
+        elif type(self.trie) is HashTrie:
+            (<HashTrie> self.trie)._node_stats(self.pending_index, self.indexes.back(), self.path.size(), out)
+        else:
+            (<FrozenTrie> self.trie)._node_stats(self.pending_index, self.indexes.back(), self.path.size(), out)
+
+
+cdef int pair_stats(_LexiconWalk walk, bwd, bint shared, vector[int]& bwd_path, ngram_stats* out) except -1:
+    """ Statistics of the current n-gram of ``walk`` (on a forward trie) and
+    of a backward trie (that share their vocabulary if ``shared``), as
+    :func:`query_tries` gives them. The forward ones are read on the node the
+    walk stands on; the reversed n-gram is looked up in the backward trie,
+    one child per token, unless the forward autonomy is not defined (then
+    only the count and the autonomy, NaN, are set). ``bwd_path`` is a buffer.
+    """
+    cdef ngram_stats b
+    walk.stats(out)
+    if isnan(out.autonomy):
+        # so is the mean
+        return 0
+    if shared:
+        bwd_path.assign(walk.path.rbegin(), walk.path.rend())
+    else:
+        bwd_path.clear()
+        (<Vocabulary> bwd.vocabulary)._lookup_into([walk.trie.vocabulary.tokens[code] for code in walk.path], bwd_path)
+        std_reverse(bwd_path.begin(), bwd_path.end())
+    trie_stats(bwd, bwd_path.data(), bwd_path.size(), &b)
+    out.entropy = (out.entropy + b.entropy) / 2
+    out.ev = (out.ev + b.ev) / 2
+    out.autonomy = (out.autonomy + b.autonomy) / 2
+    return 0
+
+
+def lexicon_rows(fwd, bwd, size_t max_length=0, int64_t min_count=1, exclude=()):
+    """ Stream the lexicon of a forward and a backward trie: the forward trie
+    is walked depth-first once, and each of its n-grams is given with its
+    count and its autonomy (the mean over both tries, see :func:`query_tries`).
+    Only the current path is kept in memory. The tries should not be modified
+    while the rows are read.
+
+    :param max_length: The maximum length of the n-grams (0 for no limit).
+    :param min_count: N-grams seen less often, and so their extensions, are skipped.
+    :param exclude: Tokens: n-grams that contain one of them are skipped.
+    :returns: An iterator on triples (n-gram, autonomy, count), an n-gram
+      being a list of tokens, for the n-grams whose autonomy is defined.
+    """
+    cdef list decoder = fwd.vocabulary.tokens
+    cdef bint shared = bwd.vocabulary is fwd.vocabulary
+    cdef vector[int] bwd_path
+    cdef ngram_stats stats
+    cdef _LexiconWalk walk
+    # statistics are updated before the walk
+    trie_stats(fwd, NULL, 0, &stats)
+    trie_stats(bwd, NULL, 0, &stats)
+    walk = _LexiconWalk(fwd, max_length, min_count, exclude)
+    while walk.next():
+        pair_stats(walk, bwd, shared, bwd_path, &stats)
+        if not isnan(stats.autonomy):
+            yield [decoder[code] for code in walk.path], stats.autonomy, stats.count
+
+
+ctypedef pair[pair[double, size_t], size_t] heap_entry
+
+
+def top_autonomous(fwd, bwd, size_t k, int64_t min_count=1, lengths=None, exclude=()):
+    """ The ``k`` most autonomous n-grams of a forward and a backward trie,
+    in one walk of the forward trie: each n-gram is scored from the node the
+    walk stands on, and looked up in the backward trie (see :func:`lexicon_rows`).
+    The best ones are kept in a bounded heap: only ``k`` n-grams are in memory at once.
+
+    :param min_count: N-grams seen less often are skipped.
+    :param lengths: The lengths of the n-grams that are kept (all by default).
+    :param exclude: Tokens: n-grams that contain one of them are skipped.
+    :returns: A list of triples (n-gram, autonomy, count), by decreasing
+      autonomy (then in the order of the walk), an n-gram being a list of tokens.
+    """
+    cdef list decoder = fwd.vocabulary.tokens
+    cdef bint shared = bwd.vocabulary is fwd.vocabulary
+    cdef vector[int] bwd_path
+    cdef ngram_stats stats
+    cdef _LexiconWalk walk
+    cdef vector[bint] wanted
+    cdef size_t max_length = 0
+    cdef size_t length, slot
+    cdef size_t rank = 0
+    # ((-autonomy, rank), slot) of the best n-grams so far: the top is the
+    # worst one, and among equals the last one found
+    cdef vector[heap_entry] heap
+    cdef heap_entry entry
+    # n-gram and count kept in each slot
+    cdef vector[vector[int]] kept
+    cdef vector[int64_t] counts
+    if lengths is not None:
+        lengths = sorted(set(lengths))
+        if not lengths or lengths[0] < 1:
+            raise ValueError("lengths should be at least 1")
+        max_length = lengths[-1]
+        wanted.assign(max_length + 1, False)
+        for length in lengths:
+            wanted[length] = True
+    if k == 0:
+        return []
+    trie_stats(fwd, NULL, 0, &stats)
+    trie_stats(bwd, NULL, 0, &stats)
+    walk = _LexiconWalk(fwd, max_length, min_count, exclude)
+    while walk.next():
+        if not wanted.empty() and not wanted[walk.path.size()]:
+            continue
+        pair_stats(walk, bwd, shared, bwd_path, &stats)
+        if isnan(stats.autonomy):
+            continue
+        entry.first.first = -stats.autonomy
+        entry.first.second = rank
+        rank += 1
+        if heap.size() < k:
+            slot = heap.size()
+            kept.push_back(walk.path)
+            counts.push_back(stats.count)
+        elif entry.first < heap.front().first:
+            slot = heap.front().second
+            std_pop_heap(heap.begin(), heap.end())
+            heap.pop_back()
+            kept[slot] = walk.path
+            counts[slot] = stats.count
+        else:
+            continue
+        entry.second = slot
+        heap.push_back(entry)
+        std_push_heap(heap.begin(), heap.end())
+    std_sort(heap.begin(), heap.end())
+    result = []
+    for entry in heap:
+        slot = entry.second
+        result.append(([decoder[code] for code in kept[slot]], -entry.first.first, counts[slot]))
+    return result
+
+cdef tuple batch_arrays(Vocabulary vocabulary, ngrams, lengths):
+    """ Arrays of ids and lengths of a batch of n-grams (given as is or
+    already encoded), and the order in which to look them up.
+    """
+    import numpy
+    if lengths is None:
+        ids, lengths = encode_ngrams(vocabulary, ngrams)
+    else:
+        ids = numpy.ascontiguousarray(ngrams, dtype=numpy.int32)
+        lengths = numpy.ascontiguousarray(lengths, dtype=numpy.intp)
+        if ids.ndim != 2 or len(ids) != len(lengths):
+            raise ValueError("ngrams should be a 2-D array with one row per length")
+        if len(lengths) and (lengths.min() < 0 or lengths.max() > ids.shape[1]):
+            raise ValueError("lengths should be between 0 and the width of ngrams")
+    # lexicographic order of the rows: n-grams with a common prefix are together
+    order = numpy.lexsort(ids.T[::-1]) if ids.shape[1] else numpy.arange(len(ids))
+    return ids, lengths, numpy.ascontiguousarray(order, dtype=numpy.intp)
+
+
+def _load_trie(data):
+    return CythonTrie.load(io.BytesIO(data))
+
+
+def _load_hash_trie(data):
+    return HashTrie.load(io.BytesIO(data))
+
+
+# magic, version, size of the pickled state, number of nodes
+CHECKPOINT_HEADER = struct.Struct("<8sIQQ")
+CHECKPOINT_MAGIC = b"ELEVECKP"
+CHECKPOINT_VERSION = 1
+
+
+cdef write_checkpoint_state(f, dict state, size_t n_nodes):
+    """ Write the header and the state of a trie checkpoint, before its nodes.
+    """
+    data = pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+    f.write(CHECKPOINT_HEADER.pack(CHECKPOINT_MAGIC, CHECKPOINT_VERSION, len(data), n_nodes))
+    f.write(data)
+
+
+cdef tuple read_checkpoint_state(f):
+    """ Read the header and the state of a trie checkpoint.
+
+    :returns: a couple with the state and the number of node records that follow.
+    """
+    header = f.read(CHECKPOINT_HEADER.size)
+    if len(header) != CHECKPOINT_HEADER.size:
+        raise ValueError("Truncated trie checkpoint")
+    magic, version, state_size, n_nodes = CHECKPOINT_HEADER.unpack(header)
+    if magic != CHECKPOINT_MAGIC:
+        raise ValueError("Not a trie checkpoint")
+    if version != CHECKPOINT_VERSION:
+        raise ValueError("Unsupported trie checkpoint version %d (expected %d)" % (version, CHECKPOINT_VERSION))
+    return pickle.loads(f.read(state_size)), n_nodes
+
+
+# n_nodes, depth, number of tokens, size of the vocabulary
+_TRIE_HEADER = struct.Struct("<QQQQ")
+
+
+cdef size_t padding(size_t size):
+    """ Number of bytes to add to keep 8 bytes alignment.
+    """
+    return -size % 8
+
+
+cdef tuple pack_tokens(list tokens):
+    """ Binary form of a list of str tokens, see :func:`FrozenTrie.write`.
+
+    :returns: a couple with the offsets of the tokens (an ``array.array``, in
+      characters), and their concatenation encoded in UTF-8.
+    """
+    for token in tokens:
+        if not isinstance(token, str):
+            raise TypeError("Only str tokens can be written, got %r" % (token,))
+    offsets = array.array("Q", itertools.accumulate(map(len, tokens), initial=0))
+    return offsets, "".join(tokens).encode("utf8")
+
+
+cdef tuple unpack_tokens(buffer, size_t offset, size_t n_tokens, size_t size):
+    """ Read tokens written after :func:`pack_tokens` (offsets, then the
+    padded concatenation of the tokens).
+
+    :returns: a couple with the list of tokens and the offset of their end in ``buffer``.
+    """
+    offsets = array.array("Q", buffer[offset : offset + 8 * (n_tokens + 1)])
+    offset += 8 * (n_tokens + 1)
+    text = bytes(buffer[offset : offset + size]).decode("utf8")
+    offset += size + padding(size)
+    return [text[offsets[i] : offsets[i + 1]] for i in range(n_tokens)], offset
+
+
+cdef size_t frozen_size(size_t n_nodes, size_t depth):
+    """ Size in bytes of the arrays of a :class:`FrozenTrie`.
+    """
+    return ((sizeof(int64_t) + sizeof(int32_t) + sizeof(float)) * n_nodes
+            + 2 * sizeof(double) * depth
+            + sizeof(uint32_t) * (n_nodes + 1))
+
+
+cdef size_t lexicon_size(size_t n_nodes):
+    """ Size in bytes of the arrays of a :class:`Lexicon`.
+    """
+    return ((sizeof(int64_t) + sizeof(double) + sizeof(int32_t)) * n_nodes
+            + sizeof(uint32_t) * (n_nodes + 1))
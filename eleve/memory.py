@@ -7,10 +7,25 @@ Provide full-python reference implementation of ``eleve`` storage and Trie.
 from __future__ import division
 import math
 import logging
+import io
+import os
+import itertools
+import copy
+import mmap
+import struct
+import heapq
+import functools
+import multiprocessing
+import queue
+import threading
+import time
+from collections import namedtuple, OrderedDict
 
 import pickle
 
-__all__ = ["MemoryTrie", "MemoryStorage"]
+import numpy
+
+__all__ = ["MemoryTrie", "MemoryStorage", "CachedStorage"]
 
 NaN = float("nan")
 
@@ -147,9 +162,7 @@ class MemoryTrie:
                 n = min(minus, node.count)
                 node.count -= minus
             return n
-        n = rec(self.root)
-        print(n)
-        #self.root.count -= n
+        rec(self.root)
 
 
     def _update_stats_rec(self, parent_entropy, depth, node):
@@ -309,7 +322,51 @@ class MemoryTrie:
                 return float("nan")
         return nev
 
-from .cython_storage import CythonTrie
+from .cython_storage import (CythonTrie, HashTrie, FrozenTrie, Lexicon, Vocabulary, query_tries, lattice_tries,
+                             lexicon_rows, top_autonomous, reverse_ngrams, run_stats_jobs)
+
+# magic, version, default_ngram_length
+BINARY_HEADER = struct.Struct("<8sII")
+BINARY_MAGIC = b"ELEVEMAP"
+BINARY_VERSION = 1
+
+# magic, version, default_ngram_length
+CHECKPOINT_HEADER = struct.Struct("<8sII")
+CHECKPOINT_MAGIC = b"ELEVESTO"
+CHECKPOINT_VERSION = 1
+
+TrainingStats = namedtuple("TrainingStats", "lines sentences elapsed read_time preprocess_time wait_time insert_time")
+
+# preprocessing function of a worker process of :func:`MemoryStorage.add_corpus`
+_preprocess = None
+
+
+def _split_line(line):
+    return [line.split()]
+
+
+def _init_preprocess(preprocess):
+    global _preprocess
+    _preprocess = preprocess
+
+
+def _preprocess_chunk(lines, preprocess=None):
+    """ Sentences of a chunk of lines, with the time it took. """
+    start = time.perf_counter()
+    preprocess = preprocess or _preprocess
+    sentences = [sentence for line in lines for sentence in preprocess(line) if sentence]
+    return len(lines), sentences, time.perf_counter() - start
+
+
+def _log_training(stats):
+    def rate(n, seconds):
+        return n / seconds if seconds > 0 else float("inf")
+
+    logging.info("%d lines, %d sentences in %.1fs: reading %.0f lines/s, preprocessing %.0f lines/s per process, "
+                 "insertion %.0f sentences/s, %.1fs waiting for preprocessing",
+                 stats.lines, stats.sentences, stats.elapsed, rate(stats.lines, stats.read_time),
+                 rate(stats.lines, stats.preprocess_time), rate(stats.sentences, stats.insert_time), stats.wait_time)
+
 
 class MemoryStorage:
     """ Full-Python in-memory storage.
@@ -321,31 +378,106 @@ class MemoryStorage:
     sentence_end = "\ue02d"  # in utf8 : b"\xee\x80\xad"
     #  see http://www.fileformat.info/info/unicode/char/e02d/index.htm
 
-    def __init__(self, default_ngram_length=5):
+    # number of sentences given at once to the tries by add_sentences
+    batch_size = 10000
+
+    # trie classes, by name of backend
+    backends = {"trie": CythonTrie, "hash": HashTrie}
+
+    def __init__(self, default_ngram_length=5, incremental=False, backend="trie"):
         """ Storage constructor.
 
         :param default_ngram_length: the default maximum length of n-gram beeing
           stored. May be overriden in :func:`add_sentence`.
+        :param incremental: If True, statistics are kept up to date at each
+          insertion, so that querying while training stays cheap.
+        :param backend: "trie" for tries of nodes (:class:`eleve.cython_storage.CythonTrie`),
+          or "hash" for tries stored in one hash table each
+          (:class:`eleve.cython_storage.HashTrie`, more compact, without
+          incremental statistics).
         """
         assert isinstance(default_ngram_length, int) and default_ngram_length > 0
+        if backend not in self.backends:
+            raise ValueError("Unknown backend %r (should be one of %s)" % (backend, ", ".join(sorted(self.backends))))
         self._default_ngram_length = default_ngram_length
+        self.backend = backend
         terminals = frozenset([self.sentence_start, self.sentence_end])
-        self.bwd = CythonTrie(terminals=terminals) # MemoryTrie(terminals=terminals)
-        self.fwd = CythonTrie(terminals=terminals) # MemoryTrie(terminals=terminals)
+        trie_class = self.backends[backend]
+        # both tries share the token ids, n-grams are encoded once for both
+        vocabulary = Vocabulary()
+        self.bwd = trie_class(terminals=terminals, incremental=incremental, vocabulary=vocabulary) # MemoryTrie(terminals=terminals)
+        self.fwd = trie_class(terminals=terminals, incremental=incremental, vocabulary=vocabulary) # MemoryTrie(terminals=terminals)
         #self.bwd = MemoryTrie(terminals=terminals)
         #self.fwd = MemoryTrie(terminals=terminals)
 
     def get_voc(self):
         return self.fwd.get_voc()
 
+    @property
+    def frozen(self):
+        """ True for a read-only storage (see :func:`freeze` and :func:`open_binary`).
+        """
+        return isinstance(self.fwd, FrozenTrie)
+
+    def _check_trainable(self):
+        if self.frozen:
+            raise TypeError("The storage is frozen (read-only): it can be queried, not modified")
+
+    def iter_lexicon(self, min_count=1, max_length=None):
+        """ Stream the n-grams of the model with their autonomy and their
+        count, walking the tries once (see :func:`eleve.cython_storage.lexicon_rows`).
+        N-grams with an undefined autonomy, or that contain the start or end
+        of sentence tokens, are skipped.
+
+        :param min_count: The minimum count of the n-grams.
+        :param max_length: The maximum length of the n-grams (by default,
+          the longest ones whose autonomy can be defined).
+        :returns: An iterator on triples (n-gram, autonomy, count), an n-gram
+          being a list of tokens.
+        """
+        if max_length is None:
+            max_length = self.default_ngram_length - 1
+        return lexicon_rows(self.fwd, self.bwd, max_length, min_count, (self.sentence_start, self.sentence_end))
+
+    def top_autonomous(self, k, min_count=1, lengths=None):
+        """ The ``k`` most autonomous n-grams of the model, found in one walk
+        of the forward trie and kept in a bounded heap (see
+        :func:`eleve.cython_storage.top_autonomous`). N-grams that contain
+        the start or end of sentence tokens are skipped.
+
+        :param k: The number of n-grams.
+        :param min_count: The minimum count of the n-grams.
+        :param lengths: The lengths of the n-grams (by default, all the
+          lengths whose autonomy can be defined).
+        :returns: A list of triples (n-gram, autonomy, count), by decreasing
+          autonomy, an n-gram being a list of tokens.
+        """
+        if lengths is None:
+            lengths = range(1, self.default_ngram_length)
+        return top_autonomous(self.fwd, self.bwd, k, min_count, lengths, (self.sentence_start, self.sentence_end))
+
     @property
     def default_ngram_length(self):
         return self._default_ngram_length
 
+    @property
+    def vocabulary(self):
+        """ The :class:`eleve.cython_storage.Vocabulary` of the storage.
+        """
+        return self.fwd.vocabulary
+
+    @property
+    def generation(self):
+        """ Number of modifications of the model so far (see :class:`CachedStorage`).
+        """
+        return self.fwd.generation + self.bwd.generation
+
     def add_sentence(self, sentence, freq=1, ngram_length=None):
         """ Add a sentence to the model.
 
-        :param sentence: The sentence to add. Should be a list of tokens.
+        :param sentence: The sentence to add. Should be a list of tokens, or a
+          ``str`` whose characters are the tokens (encoded by code point,
+          without building a list).
         :param freq: The number of times to add this sentence. One by default. May be negative to "remove" a sentence.
         :param ngram_length: The length of n-grams that are stored. If None the
           default value setup in __init__ is used.
@@ -354,31 +486,312 @@ class MemoryStorage:
             raise ValueError("freq should be larger or equal to 1")
         if not sentence:
             return
+        self.add_sentences([sentence], [freq], ngram_length)
+
+    def add_sentences(self, sentences, freqs=None, ngram_length=None):
+        """ Add many sentences to the model.
+
+        This is much faster than calling :func:`add_sentence` in a loop: n-grams
+        extraction and insertion are done at C level, by batch of sentences.
+
+        :param sentences: An iterable of sentences (lists of tokens, or ``str``). May be a generator.
+        :param freqs: An iterable with the number of times to add each sentence. One by default.
+        :param ngram_length: The length of n-grams that are stored. If None the
+          default value setup in __init__ is used.
+        """
+        self._check_trainable()
         if ngram_length is None:
             ngram_length = self.default_ngram_length
-        # We add sentence_start and sentence_end at both ends. We cast it to the type of sentence, so it
-        # works whether sentence is a str, tuple, or list.
-        token_list = type(sentence)(self.sentence_start) + sentence + type(sentence)(self.sentence_end)
-        for ngram in extract_ngrams(token_list, ngram_length):
-            self.fwd.add_ngram(ngram, freq)
-        for ngram in extract_ngrams(token_list[::-1], ngram_length):
-            self.bwd.add_ngram(ngram, freq)
+        if freqs is None:
+            freqs = itertools.repeat(1)
+        pairs = zip(sentences, freqs)
+        while True:
+            batch = list(itertools.islice(pairs, self.batch_size))
+            if not batch:
+                break
+            batch_sentences, batch_freqs = zip(*batch)
+            # checked here so that both tries stay consistent
+            if min(batch_freqs) <= 0:
+                raise ValueError("freq should be larger or equal to 1")
+            # sentences are encoded once for both tries
+            assert self.fwd.vocabulary is self.bwd.vocabulary, "the tries of a storage should share their vocabulary"
+            # sentence_start and sentence_end are added at both ends
+            ids, offsets = self.vocabulary.encode_sentences(batch_sentences, self.sentence_start, self.sentence_end)
+            self.fwd.add_encoded_sentences(ids, offsets, batch_freqs, ngram_length)
+            self.bwd.add_encoded_sentences(ids, offsets, batch_freqs, ngram_length, reverse=True)
+
+    def add_corpus(self, lines, preprocess=None, n_jobs=None, chunksize=1000, prune=0, prune_every=100000,
+                   report_every=0):
+        """ Train the model on a corpus, read, preprocessed and inserted in a pipeline.
+
+        A thread reads ``lines`` by chunks, a pool of processes preprocesses
+        the chunks (they are started once, and get ``preprocess`` by fork),
+        and the current thread inserts the sentences as soon as a chunk is
+        ready: reading, preprocessing and insertion overlap. Only a few chunks
+        per process are read ahead of the insertion. Without fork (on
+        Windows), or with ``n_jobs=1``, lines are preprocessed in the current
+        process (but still read by another thread).
+
+        :param lines: An iterable of lines (for instance a file), read lazily.
+        :param preprocess: A function giving the list of the sentences of a line.
+          It should be defined at the top level of a module, so that it can be
+          pickled. By default, a line is one sentence of space separated tokens.
+        :param n_jobs: The number of preprocessing processes (by default, the number of CPUs).
+        :param chunksize: The number of lines read and sent at once to a process.
+        :param prune: If larger than 0, :func:`prune` is called with it every ``prune_every`` lines.
+        :param report_every: If larger than 0, the throughput of each stage is
+          logged every ``report_every`` lines (and at the end).
+        :returns: A :class:`TrainingStats` with the numbers of lines and
+          sentences, and the time spent by each stage (in seconds):
+          ``read_time`` reading, ``preprocess_time`` preprocessing (summed
+          over the processes), ``wait_time`` inserter waiting for preprocessed
+          chunks, ``insert_time`` inserting (and pruning).
+        """
+        self._check_trainable()
+        if chunksize < 1:
+            raise ValueError("chunksize should be larger or equal to 1")
+        if preprocess is None:
+            preprocess = _split_line
+        if n_jobs is None:
+            n_jobs = multiprocessing.cpu_count()
+        parallel = n_jobs > 1 and "fork" in multiprocessing.get_all_start_methods()
+        ahead = 4 * n_jobs if parallel else 2
+        chunks = queue.Queue(ahead)
+        # Pool.imap reads its whole input at once: only let a few chunks be
+        # taken from the queue ahead of the ones that were inserted.
+        window = threading.Semaphore(ahead)
+        stopped = threading.Event()
+        read_time = 0.0
+        error = None
+
+        def read():
+            nonlocal read_time, error
+            items = iter(lines)
+            try:
+                while not stopped.is_set():
+                    start = time.perf_counter()
+                    chunk = list(itertools.islice(items, chunksize))
+                    read_time += time.perf_counter() - start
+                    if not chunk:
+                        break
+                    chunks.put(chunk)
+            except BaseException as e:
+                error = e
+            finally:
+                chunks.put(None)
+
+        def feed():
+            while True:
+                window.acquire()
+                chunk = chunks.get()
+                if chunk is None or stopped.is_set():
+                    return
+                yield chunk
+
+        n_lines = n_sentences = 0
+        preprocess_time = wait_time = insert_time = 0.0
+        next_prune, next_report = prune_every, report_every
+        started = time.perf_counter()
+
+        def stats():
+            return TrainingStats(n_lines, n_sentences, time.perf_counter() - started, read_time,
+                                 preprocess_time, wait_time, insert_time)
+
+        reader = threading.Thread(target=read, name="eleve-corpus-reader", daemon=True)
+        reader.start()
+        pool = None
+        try:
+            if parallel:
+                # with fork, initargs are inherited by the workers instead of being pickled
+                pool = multiprocessing.get_context("fork").Pool(n_jobs, _init_preprocess, (preprocess,))
+                results = pool.imap(_preprocess_chunk, feed())
+            else:
+                results = (_preprocess_chunk(chunk, preprocess) for chunk in feed())
+            while True:
+                start = time.perf_counter()
+                try:
+                    chunk_lines, sentences, busy = next(results)
+                except StopIteration:
+                    break
+                window.release()
+                wait_time += time.perf_counter() - start
+                preprocess_time += busy
+                start = time.perf_counter()
+                self.add_sentences(sentences)
+                n_lines += chunk_lines
+                n_sentences += len(sentences)
+                if prune > 0 and n_lines >= next_prune:
+                    self.prune(prune)
+                    next_prune = n_lines + prune_every
+                insert_time += time.perf_counter() - start
+                if report_every > 0 and n_lines >= next_report:
+                    _log_training(stats())
+                    next_report = n_lines + report_every
+        finally:
+            stopped.set()
+            window.release()
+            if pool is not None:
+                pool.terminate()
+            # the reader may be blocked on a full queue
+            while reader.is_alive():
+                try:
+                    chunks.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+        if error is not None:
+            raise error
+        result = stats()
+        if report_every > 0:
+            _log_training(result)
+        return result
 
     def clear(self):
         """ Clear the training data in the model, effectively resetting it.
         """
+        self._check_trainable()
         self.bwd.clear()
         self.fwd.clear()
 
     def prune(self, minus=1):
+        self._check_trainable()
         self.bwd.prune(minus)
         self.fwd.prune(minus)
 
-    def update_stats(self):
+    def merge(self, other):
+        """ Add the counts of another storage to this one, as if it had also
+        been trained on the sentences of ``other``: storages trained on
+        parts of a corpus (by several processes for instance, they can be
+        pickled) are merged into the storage of the whole corpus. Tokens are
+        mapped from the vocabulary of ``other`` to the one of this storage.
+        Statistics are updated by the next query, or :func:`update_stats`.
+
+        :param other: A storage with the same backend, that is not frozen.
+        """
+        self._check_trainable()
+        other._check_trainable()
+        if type(other.fwd) is not type(self.fwd):
+            raise TypeError("Can not merge a storage with %s tries into one with %s tries"
+                            % (type(other.fwd).__name__, type(self.fwd).__name__))
+        self.fwd.merge(other.fwd)
+        self.bwd.merge(other.bwd)
+
+    def update_stats(self, n_jobs=1):
         """ Update the entropies and normalization factors. This function is called automatically when you modify the model and then query it.
+
+        :param n_jobs: number of threads used. Both tries are processed at
+          the same time, each one split by subtrees of its root. Ignored with
+          the ``"hash"`` backend, whose tries are updated by one thread.
+        """
+        if n_jobs <= 1:
+            self.bwd.update_stats()
+            self.fwd.update_stats()
+            return
+        jobs = []
+        for trie in (self.bwd, self.fwd):
+            trie_jobs = trie._stats_jobs(n_jobs)
+            if trie_jobs is None:
+                trie.update_stats()
+            else:
+                jobs.extend(trie_jobs)
+        run_stats_jobs(jobs, n_jobs)
+
+    def freeze(self):
+        """ Returns a read-only copy of the storage, more compact and faster to
+        query (see :class:`eleve.cython_storage.FrozenTrie`).
         """
-        self.bwd.update_stats()
-        self.fwd.update_stats()
+        frozen = copy.copy(self)
+        frozen.fwd = self.fwd.freeze()
+        frozen.bwd = self.bwd.freeze()
+        return frozen
+
+    def save(self, path):
+        """ Save the whole training state of the storage, so that training can
+        be resumed later with :func:`load`.
+
+        The file is written next to ``path`` then renamed, so an existing
+        checkpoint is never left half-written.
+        """
+        self._check_trainable()
+        tmp_path = "%s.tmp" % path
+        with open(tmp_path, "wb") as f:
+            self._write_checkpoint(f)
+        os.replace(tmp_path, path)
+
+    def _write_checkpoint(self, f):
+        f.write(CHECKPOINT_HEADER.pack(CHECKPOINT_MAGIC, CHECKPOINT_VERSION, self.default_ngram_length))
+        self.fwd.save(f)
+        self.bwd.save(f)
+
+    @classmethod
+    def load(cls, path, backend="trie"):
+        """ Load a storage saved with :func:`save`. It can be queried, and
+        trained further.
+
+        :param backend: backend of the loaded storage (see :func:`__init__`),
+          that does not need to be the one of the saved storage.
+        """
+        with open(path, "rb") as f:
+            return cls._read_checkpoint(f, backend, path)
+
+    @classmethod
+    def _read_checkpoint(cls, f, backend, name):
+        magic, version, default_ngram_length = CHECKPOINT_HEADER.unpack(f.read(CHECKPOINT_HEADER.size))
+        if magic != CHECKPOINT_MAGIC:
+            raise ValueError("%s is not an eleve checkpoint" % name)
+        if version != CHECKPOINT_VERSION:
+            raise ValueError("Unsupported checkpoint version %d (expected %d)" % (version, CHECKPOINT_VERSION))
+        storage = cls(default_ngram_length, backend=backend)
+        storage.fwd = cls.backends[backend].load(f)
+        # both tries share one vocabulary again
+        storage.bwd = cls.backends[backend].load(f, storage.fwd.vocabulary)
+        return storage
+
+    def __reduce__(self):
+        # pickled one by one, the tries would not share their vocabulary anymore
+        if self.frozen:
+            raise TypeError("A frozen storage can not be pickled, use write_binary")
+        f = io.BytesIO()
+        self._write_checkpoint(f)
+        return (_unpickle_storage, (type(self), f.getvalue(), self.backend))
+
+    def __copy__(self):
+        # shares the tries, without going through __reduce__
+        storage = type(self).__new__(type(self))
+        storage.__dict__.update(self.__dict__)
+        return storage
+
+    def write_binary(self, path):
+        """ Write the trained model in a binary file, that can be opened
+        instantly with :func:`open_binary`. Tokens should be strings.
+        """
+        frozen = self.freeze()
+        with open(path, "wb") as f:
+            f.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, self.default_ngram_length))
+            frozen.fwd.write(f)
+            frozen.bwd.write(f)
+
+    @classmethod
+    def open_binary(cls, path):
+        """ Open a model written by :func:`write_binary`.
+
+        The file is memory-mapped and used in place: loading is almost
+        instantaneous, and processes that open the same file share the same
+        memory. The storage is read-only (see :func:`freeze`).
+        """
+        with open(path, "rb") as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, default_ngram_length = BINARY_HEADER.unpack_from(buffer)
+        if magic != BINARY_MAGIC:
+            raise ValueError("%s is not an eleve binary model" % path)
+        if version != BINARY_VERSION:
+            raise ValueError("Unsupported binary model version %d (expected %d)" % (version, BINARY_VERSION))
+        storage = cls.__new__(cls)
+        storage._default_ngram_length = default_ngram_length
+        # the backend the model was trained with is not known, nor needed
+        storage.backend = None
+        storage.fwd, offset = FrozenTrie.from_buffer(buffer, BINARY_HEADER.size)
+        storage.bwd, offset = FrozenTrie.from_buffer(buffer, offset, storage.fwd.vocabulary)
+        return storage
 
     def query_autonomy(self, ngram):
         """ Query the autonomy for a ngram.
@@ -386,21 +799,53 @@ class MemoryStorage:
         :param ngram: A list of tokens.
         :returns: A float, that can be NaN if it is not defined.
         """
-        result_fwd = self.fwd.query_autonomy(ngram)
-        result_bwd = self.bwd.query_autonomy(ngram[::-1])
-        # Notice that the above can be NaN. In which case it's propagated anyway.
+        # mean of the autonomies in both tries, NaN if either one is
+        return query_tries(self.fwd, self.bwd, ngram)[3]
+
+    def query_autonomy_many(self, ngrams):
+        """ Query the autonomies of many n-grams at once, without going back
+        to Python for each one.
+
+        :param ngrams: A list of n-grams (lists of tokens).
+        :returns: A numpy array of floats, that can be NaN if not defined.
+        """
+        ngrams = ngrams if isinstance(ngrams, list) else list(ngrams)
+        ids, lengths = self.fwd.vocabulary.encode_ngrams(ngrams)
+        if self.bwd.vocabulary is self.fwd.vocabulary:
+            bwd_ids = ids
+        else:
+            bwd_ids, _ = self.bwd.vocabulary.encode_ngrams(ngrams)
+        result_fwd = self.fwd.query_autonomy_many(ids, lengths)
+        result_bwd = self.bwd.query_autonomy_many(reverse_ngrams(bwd_ids, lengths), lengths)
         return (result_fwd + result_bwd) / 2
 
+    def query_count_many(self, ngrams):
+        """ Query the counts of many n-grams at once.
+
+        :param ngrams: A list of n-grams (lists of tokens).
+        :returns: A numpy array of integers.
+        """
+        return self.fwd.query_count_many(ngrams)
+
+    def autonomy_lattice(self, sentence, max_len):
+        """ Query the autonomies of all the n-grams of a sentence, up to
+        ``max_len`` tokens. The forward trie is walked once from each start,
+        and the backward trie once from each end.
+
+        :param sentence: A list of tokens, or a ``str`` (a token per character).
+        :param max_len: The maximum length of the n-grams.
+        :returns: A numpy array ``A`` of shape ``(len(sentence), max_len)``,
+          ``A[i, j - 1]`` being the autonomy of ``sentence[i:i + j]`` (NaN if not defined).
+        """
+        return lattice_tries(self.fwd, self.bwd, sentence, max_len)
+
     def query_ev(self, ngram):
         """ Query the entropy variation for a ngram.
 
         :param ngram: A list of tokens.
         :returns: A float, that can be NaN if it is not defined.
         """
-        result_fwd = self.fwd.query_ev(ngram)
-        result_bwd = self.bwd.query_ev(ngram[::-1])
-        # Notice that the above can be NaN. In which case it's propagated anyway.
-        return (result_fwd + result_bwd) / 2
+        return query_tries(self.fwd, self.bwd, ngram)[2]
 
     def query_count(self, ngram):
         """ Query the count for a ngram (the number of time it appeared in the training corpus).
@@ -416,10 +861,62 @@ class MemoryStorage:
         :param ngram: A list of tokens.
         :returns: A float, that can be NaN if it is not defined.
         """
-        entropy_fwd = self.fwd.query_entropy(ngram)
-        entropy_bwd = self.bwd.query_entropy(ngram[::-1])
-        # Notice that the above can be NaN. In which case it's propagated anyway.
-        return (entropy_fwd + entropy_bwd) / 2
+        return query_tries(self.fwd, self.bwd, ngram)[1]
+
+
+def _unpickle_storage(cls, data, backend):
+    return cls._read_checkpoint(io.BytesIO(data), backend, "pickled storage")
+
+
+# magic, version, default_ngram_length
+LEXICON_HEADER = struct.Struct("<8sII")
+LEXICON_MAGIC = b"ELEVELEX"
+LEXICON_VERSION = 1
+
+
+def open_lexicon(path):
+    """ Open a lexicon written by :func:`CSVStorage.write_binary`, memory-mapped.
+
+    :returns: A couple with the :class:`Lexicon` and the ``default_ngram_length``
+      of its storage, or None if ``path`` is not a binary lexicon.
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size < LEXICON_HEADER.size:
+            return None
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, default_ngram_length = LEXICON_HEADER.unpack_from(buffer)
+    if magic != LEXICON_MAGIC:
+        buffer.close()
+        return None
+    if version != LEXICON_VERSION:
+        raise ValueError("Unsupported lexicon version %d (expected %d)" % (version, LEXICON_VERSION))
+    lexicon, _ = Lexicon.from_buffer(buffer, LEXICON_HEADER.size)
+    return lexicon, default_ngram_length
+
+
+def read_lexicon(path, delim=""):
+    """ Read a lexicon written by :func:`CSVStorage.writeCSV` or :func:`CSVStorage.writePickle`.
+
+    :param delim: The separator of the tokens of an n-gram in a CSV file
+      (with ``""``, the tokens are the characters).
+    :returns: An iterator on triples (n-gram, autonomy, count).
+    """
+    with open(path, "rb") as f:
+        # pickle protocols 2 and above start with a PROTO opcode, never valid UTF-8
+        pickled = f.read(1) == b"\x80"
+    if pickled:
+        with open(path, "rb") as f:
+            data = pickle.load(f)
+        for ngram, (autonomy, count) in data.items():
+            yield ngram, autonomy, count
+        return
+    with open(path) as f:
+        for line in f:
+            fields = line.rstrip("\r\n").split("\t")
+            if len(fields) < 3:
+                continue
+            ngram = fields[0] if delim == "" else fields[0].split(delim)
+            yield ngram, float(fields[1]), int(fields[2])
 
 
 class CSVStorage:
@@ -427,6 +924,10 @@ class CSVStorage:
     This is a non-trainable storage.
     It relies on a CSV dump from a MemoryStorage and can only be used to
     perform segmentation and autonomy query
+
+    The lexicon is kept in a compact trie (:class:`eleve.cython_storage.Lexicon`).
+    It can be compiled once in a binary file with :func:`write_binary`, that
+    is then opened instantly (memory-mapped) by the constructor.
     """
     # Use PRIVATE_USE_AREA codes
     sentence_start = "\ue02b"  # in utf8 : b"\xee\x80\xab"
@@ -435,53 +936,270 @@ class CSVStorage:
 
     #  see http://www.fileformat.info/info/unicode/char/e02d/index.htm
 
+    # the model is never modified
+    generation = 0
+
     def __init__(self, path, delim=""):
-        self.data = {}
+        """ Open a lexicon.
+
+        :param path: A file written by :func:`writeCSV`, :func:`writePickle`
+          or :func:`write_binary`.
+        :param delim: The separator of the tokens of an n-gram in a CSV file
+          (with ``""``, the tokens are the characters).
+        """
         self.delim = delim
-        lmax = 0
-        with open(path) as f:
-            for line in f:
-                fields = line.strip().split("\t")
-                ng = tuple(fields[0]) if delim == '' else tuple(fields[0].split(delim))
-                self.data[ng] = (float(fields[1]), int(fields[2]))
-                if len(ng) > lmax:
-                    lmax = len(fields[0])
-        self._ngram_length = lmax + 1
-        print(lmax)
+        compiled = open_lexicon(path)
+        if compiled is not None:
+            self.lexicon, self._ngram_length = compiled
+        else:
+            self.lexicon = Lexicon.build(read_lexicon(path, delim))
+            # n-grams of the lexicon are at most default_ngram_length - 1 tokens long
+            self._ngram_length = self.lexicon.max_depth() + 1
+
+    def write_binary(self, path):
+        """ Write the lexicon in a binary file, that the constructor opens
+        without parsing it. Tokens should be strings.
+        """
+        with open(path, "wb") as f:
+            f.write(LEXICON_HEADER.pack(LEXICON_MAGIC, LEXICON_VERSION, self.default_ngram_length))
+            self.lexicon.write(f)
 
     def query_autonomy(self, ngram):
-        try:
-            return self.data[tuple(ngram)][0]
-        except:
-            return float("nan")
+        return self.lexicon.query_autonomy(ngram)
 
     def query_count(self, ngram):
-        try:
-            return self.data[tuple(ngram)][1]
-        except:
-            return 0
+        return self.lexicon.query_count(ngram)
+
+    def query_autonomy_many(self, ngrams):
+        """ Query the autonomies of many n-grams at once.
+
+        :returns: A numpy array of floats, that can be NaN if not defined.
+        """
+        return self.lexicon.query_autonomy_many(ngrams)
+
+    def query_count_many(self, ngrams):
+        """ Query the counts of many n-grams at once.
+
+        :returns: A numpy array of integers.
+        """
+        return self.lexicon.query_count_many(ngrams)
+
+    def autonomy_lattice(self, sentence, max_len):
+        """ Autonomies of all the n-grams of a sentence, up to ``max_len``
+        tokens (see :func:`MemoryStorage.autonomy_lattice`). All the n-grams
+        starting at a token are found by one walk in the lexicon.
+        """
+        return self.lexicon.autonomy_lattice(sentence, max_len)
+
+    def get_voc(self):
+        return self.lexicon.get_voc()
 
     @property
     def default_ngram_length(self):
         return self._ngram_length
 
     @staticmethod
-    def writeCSV(storage,voc,  path, delim=''):
+    def _rows(storage, voc):
+        """ Rows (n-gram, autonomy, count) of the lexicon of ``storage``
+        restricted to ``voc``, or of its whole lexicon if ``voc`` is None.
+        """
+        if voc is None:
+            yield from storage.iter_lexicon()
+            return
+        for w in voc:
+            wl = list(w)
+            e = storage.query_autonomy(wl)
+            if not math.isnan(e):
+                yield w, e, storage.query_count(wl)
+
+    @staticmethod
+    def writeCSV(storage, voc, path, delim=''):
+        """ Write the lexicon of a storage in a CSV file, one n-gram per line
+        with its autonomy and its count, separated by tabs.
+
+        :param voc: The n-grams to write, or None to stream all the n-grams
+          of the storage (see :func:`MemoryStorage.iter_lexicon`).
+        :param delim: The separator of the tokens of an n-gram.
+        """
         with open(path, "w") as f:
-            for w in voc:
-                wl = list(w)
-                e = storage.query_autonomy(wl)
-                if not math.isnan(e):
-                    f.write("\t".join([delim.join(w), str(e), str(storage.query_count(wl))]) + "\n")
+            for w, e, count in CSVStorage._rows(storage, voc):
+                f.write("\t".join([delim.join(w), str(e), str(count)]) + "\n")
 
     @staticmethod
     def writePickle(storage, voc, path):
+        """ Write the lexicon of a storage in a pickled dict, see :func:`writeCSV`.
+        """
         data = {}
-        for w in voc:
-            wl = list(w)
-            e = storage.query_autonomy(wl)
-            if not math.isnan(e):
-                data[w] = (e,storage.query_count(wl))
-                #f.write("\t".join([w, str(e), str(storage.query_count(wl))]) + "\n")
-        with open(path,"wb") as f:
-            pickle.dump(data,f)
+        for w, e, count in CSVStorage._rows(storage, voc):
+            data[w if voc is not None else tuple(w)] = (e, count)
+        with open(path, "wb") as f:
+            pickle.dump(data, f)
+
+    @staticmethod
+    def writeBinary(storage, voc, path):
+        """ Write the lexicon of a storage in a binary file, that
+        :class:`CSVStorage` opens instantly, see :func:`writeCSV`.
+        """
+        lexicon = Lexicon.build(CSVStorage._rows(storage, voc))
+        with open(path, "wb") as f:
+            f.write(LEXICON_HEADER.pack(LEXICON_MAGIC, LEXICON_VERSION, storage.default_ngram_length))
+            lexicon.write(f)
+
+
+CacheInfo = namedtuple("CacheInfo", "hits misses maxsize currsize")
+
+
+class CachedStorage:
+    """ Bounded cache in front of a storage, for :func:`query_autonomy` and
+    :func:`query_count`. Everything else is delegated to the storage, so it can
+    be given to a :class:`eleve.Segmenter` instead of the storage itself.
+
+    The cache is emptied as soon as the storage is modified (that is when its
+    ``generation`` changes).
+    """
+
+    def __init__(self, storage, maxsize=100000, policy="lru"):
+        """ Cache constructor.
+
+        :param storage: A storage with a ``generation`` attribute (:class:`MemoryStorage` or :class:`CSVStorage`).
+        :param maxsize: The maximum number of n-grams kept, for each kind of query.
+        :param policy: The eviction policy, ``"lru"`` (least recently used
+          n-grams are dropped first) or ``"fifo"`` (oldest n-grams are dropped
+          first, hits are a little cheaper).
+        """
+        assert isinstance(maxsize, int) and maxsize > 0
+        if policy not in ("lru", "fifo"):
+            raise ValueError("Unknown cache policy %r" % (policy,))
+        self.storage = storage
+        self.maxsize = maxsize
+        self.policy = policy
+        self._cached_autonomy = self._cache(storage.query_autonomy)
+        self._cached_count = self._cache(storage.query_count)
+        self._generation = storage.generation
+        # counters of the caches emptied since the last cache_clear
+        self._hits = 0
+        self._misses = 0
+
+    def __getattr__(self, name):
+        if name == "storage":  # not set yet (copy, pickle)
+            raise AttributeError(name)
+        return getattr(self.storage, name)
+
+    def _cache(self, query):
+        """ Cached version of ``query``, called with n-grams as tuples.
+        """
+        if self.policy == "lru":
+            return functools.lru_cache(self.maxsize)(query)
+        return _FifoCache(query, self.maxsize)
+
+    def _invalidate(self):
+        """ Empty the caches (the storage was modified), keeping their counters.
+        """
+        for cached in (self._cached_autonomy, self._cached_count):
+            info = cached.cache_info()
+            self._hits += info.hits
+            self._misses += info.misses
+            cached.cache_clear()
+        self._generation = self.storage.generation
+
+    def query_autonomy(self, ngram):
+        """ Query the autonomy for a ngram (see :func:`MemoryStorage.query_autonomy`).
+        """
+        if self.storage.generation != self._generation:
+            self._invalidate()
+        return self._cached_autonomy(tuple(ngram))
+
+    def query_count(self, ngram):
+        """ Query the count for a ngram (see :func:`MemoryStorage.query_count`).
+        """
+        if self.storage.generation != self._generation:
+            self._invalidate()
+        return self._cached_count(tuple(ngram))
+
+    def autonomy_lattice(self, sentence, max_len):
+        """ Autonomies of the n-grams of a sentence up to ``max_len`` tokens
+        (see :func:`MemoryStorage.autonomy_lattice`), each one queried
+        through the cache.
+        """
+        lattice = numpy.full((len(sentence), max_len), NaN)
+        for i in range(len(sentence)):
+            for j in range(1, min(max_len, len(sentence) - i) + 1):
+                lattice[i, j - 1] = self.query_autonomy(sentence[i : i + j])
+        return lattice
+
+    def warm(self, size=None):
+        """ Fill the cache with the most frequent n-grams of the storage. The
+        n-grams are streamed (by :func:`MemoryStorage.iter_lexicon` when the
+        storage has it, that gives the ones whose autonomy is defined), only
+        ``size`` of them are kept at once. Hit and miss counters are not changed.
+
+        :param size: The number of n-grams to add, ``maxsize`` by default.
+        """
+        size = min(size or self.maxsize, self.maxsize)
+        info = self.cache_info()
+        if hasattr(self.storage, "iter_lexicon"):
+            counted = ((ngram, count) for ngram, _, count in self.storage.iter_lexicon())
+        else:
+            counted = ((ngram, self.storage.query_count(ngram)) for ngram in self.storage.get_voc())
+        ngrams = [ngram for ngram, _ in heapq.nlargest(size, counted, key=lambda pair: pair[1])]
+        # the most frequent ones last, so that they are evicted last
+        for ngram in reversed(ngrams):
+            self.query_count(ngram)
+            self.query_autonomy(ngram)
+        self._hits -= self.cache_info().hits - info.hits
+        self._misses -= self.cache_info().misses - info.misses
+
+    def cache_info(self):
+        """ Hits and misses so far (both kinds of queries), maximum and current
+        number of n-grams cached (for each kind of query).
+        """
+        autonomy = self._cached_autonomy.cache_info()
+        count = self._cached_count.cache_info()
+        return CacheInfo(
+            self._hits + autonomy.hits + count.hits,
+            self._misses + autonomy.misses + count.misses,
+            self.maxsize,
+            max(autonomy.currsize, count.currsize),
+        )
+
+    def cache_clear(self):
+        """ Empty the cache and reset its counters.
+        """
+        self._cached_autonomy.cache_clear()
+        self._cached_count.cache_clear()
+        self._hits = 0
+        self._misses = 0
+
+
+class _FifoCache:
+    """ Cache of the results of a function (of one hashable argument), that
+    drops the oldest ones first. Same interface as :func:`functools.lru_cache`.
+    """
+
+    def __init__(self, function, maxsize):
+        self.function = function
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, key):
+        try:
+            value = self.data[key]
+        except KeyError:
+            self.misses += 1
+            value = self.data[key] = self.function(key)
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+            return value
+        self.hits += 1
+        return value
+
+    def cache_info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self.data))
+
+    def cache_clear(self):
+        self.data.clear()
+        self.hits = 0
+        self.misses = 0
+
@@ -1,9 +1,8 @@
-from typing import List
+from typing import List, Iterable, Iterator, Optional
 import unicodedata as ud
 
 from eleve import Segmenter
-from functools import lru_cache
-from multiprocessing import Pool
+from functools import lru_cache, partial
 
 def normalize(s: str) -> str:
     return ud.normalize("NFC", s)
@@ -57,7 +56,7 @@ def segment_with_preprocessing(seg: Segmenter, sent:str, bies:bool=True) -> str:
     for group in tokenize_by_unicode_category(sent):
         try:
             if isCJK(group[0]):
-                words = ["".join(w) for w in seg.segment(list(group))]
+                words = seg.segment(group)
                 for w in words:
                     if bies:
                         tokens.extend(add_bies(w))
@@ -75,30 +74,10 @@ def segment_with_preprocessing(seg: Segmenter, sent:str, bies:bool=True) -> str:
                 tokens.append(group)
     return " ".join(tokens)
 
-def segment_with_preprocessing_pool(seg: Segmenter, sentences:List[str], bies:bool=True) -> List[str]:
-    pool = Pool()
-    tokenized_sentences = pool.map(tokenize_by_unicode_category, sentences)
-    for sent in tokenized_sentences :
-        tokens = []
-        for group in sent:
-            try:
-                if isCJK(group[0]):
-                    words = ["".join(w) for w in seg.segment(list(group))]
-                    for w in words:
-                        if bies:
-                            tokens.extend(add_bies(w))
-                        else:
-                            tokens.append(w)
-                else:
-                    if bies:
-                        tokens.extend(add_bies(group))
-                    else:
-                        tokens.append(group)
-            except:
-                if bies:
-                    tokens.extend(add_bies(group))
-                else:
-                    tokens.append(group)
-        yield " ".join(tokens)
-    pool.terminate()
-    pool.close()
+def segment_with_preprocessing_pool(seg: Segmenter, sentences:Iterable[str], bies:bool=True,
+                                    n_jobs:Optional[int]=None, chunksize:int=1000) -> Iterator[str]:
+    """ :func:`segment_with_preprocessing` on many sentences, with several
+    processes (see :func:`eleve.segment.Segmenter.segment_many`). The results
+    are yielded in the order of ``sentences``.
+    """
+    return seg.segment_many(sentences, n_jobs, chunksize, segment=partial(segment_with_preprocessing, bies=bies))
@@ -6,10 +6,32 @@ segment sentences (regroup tokens that goes together).
 
 """
 import logging
-from math import isnan
+import multiprocessing
+import threading
+
+import numpy
+
+from eleve.cython_segment import viterbi, viterbi_nbest
 
 logger = logging.getLogger(__name__)
 
+# (segmenter, function) of a worker process of :func:`Segmenter.segment_many`
+_worker = None
+
+
+def _init_worker(segmenter, func):
+    global _worker
+    _worker = (segmenter, func)
+
+
+def _run_worker(item):
+    segmenter, func = _worker
+    return func(segmenter, item)
+
+
+def _segment(segmenter, sentence):
+    return segmenter.segment(sentence)
+
 
 class Segmenter:
     def __init__(self, storage, max_ngram_length=None):
@@ -39,97 +61,146 @@ class Segmenter:
                 )
             self.max_ngram_length = max_ngram_length
 
+    def _lattice(self, sentence, order):
+        """ Autonomies of the n-grams of ``sentence`` up to ``order`` tokens (see
+        :func:`eleve.memory.MemoryStorage.autonomy_lattice`). If the storage
+        has no ``autonomy_lattice`` method, they are queried one by one.
+        """
+        if hasattr(self.storage, "autonomy_lattice"):
+            lattice = self.storage.autonomy_lattice(sentence, order)
+        else:
+            query_autonomy = self.storage.query_autonomy
+            lattice = [
+                [query_autonomy(sentence[i : i + j]) if i + j <= len(sentence) else float("nan")
+                 for j in range(1, order + 1)]
+                for i in range(len(sentence))
+            ]
+        return numpy.ascontiguousarray(lattice, dtype=numpy.float64).reshape(len(sentence), order)
+
     def segment(self, sentence):
         """ Segment a sentence.
 
-        :param sentence: A list of tokens.
-        :returns: A list of sentence fragments. A sentence fragment is a list of tokens.
-        """
-        if len(sentence) > 1000:
-            logger.warning(
-                "The sentence you want to segment is HUGE. This will take a lot of memory."
-            )
-
-        # sentence = (
-        #     [self.storage.sentence_start] + sentence + [self.storage.sentence_end]
-        # )
-
-        # dynamic programming to segment the sentence
-        best_segmentation = [[]] * (len(sentence) + 1)
-        best_score = [0] + [float("-inf")] * len(sentence)
-
-        # best_score[1] -> autonomy of the first word
-        # best_score[2] -> sum of autonomy of the first two words, or autonomy of the first two
-        # ...
-        order = self.max_ngram_length
-        query_autonomy = self.storage.query_autonomy
-        for i in range(1, len(sentence) + 1):
-            for j in range(1, order + 1):
-                if i - j < 0:
-                    break
-                a = query_autonomy(sentence[i - j : i])
-                if isnan(a):
-                    a = -100.0
-                score = best_score[i - j] + a * j
-                if score > best_score[i]:
-                    best_score[i] = score
-                    best_segmentation[i] = best_segmentation[i - j] + [
-                        sentence[i - j : i]
-                    ]
-
-        # keep the best segmentation and remove the None
-        best_segmentation = best_segmentation[len(sentence)]
-        best_segmentation = list(filter(None, best_segmentation))
-        # best_segmentation.pop(0)
-        # best_segmentation.pop()
-
-        return best_segmentation
-
-    def segment_nbest(self, sentence, nbest=3):
-        """ Segment a sentence.
+        The best segmentation is the one that maximizes the sum of the autonomy
+        of its words, weighted by their lengths. It is computed by a compiled
+        dynamic programming (see :func:`eleve.cython_segment.viterbi`).
 
-        :param sentence: A list of tokens.
-        :returns: A list of sentence fragments. A sentence fragment is a list of tokens.
+        :param sentence: A list of tokens, or a ``str`` whose characters are the tokens.
+        :returns: A list of sentence fragments. A sentence fragment is a list of
+          tokens (a ``str`` if ``sentence`` is one).
         """
+        return [sentence[start:end] for start, end in self.segment_spans(sentence)]
 
-        from collections import namedtuple
+    def segment_spans(self, sentence):
+        """ Segment a sentence, giving the positions of the words rather than
+        the words (see :func:`segment`).
 
-        SegResult = namedtuple("SegResult", "score words")
-
-        if len(sentence) > 1000:
-            logger.warning(
-                "The sentence you want to segment is HUGE. This will take a lot of memory."
-            )
-
-        sentence = (
-            [self.storage.sentence_start] + sentence + [self.storage.sentence_end]
-        )
+        :param sentence: A list of tokens, or a ``str`` whose characters are the tokens.
+        :returns: A list of couples ``(start, end)``, word ``k`` being
+          ``sentence[start:end]`` for the ``k``-th couple.
+        """
+        bounds = viterbi(self._lattice(sentence, self.max_ngram_length))
+        return list(zip(bounds[:-1], bounds[1:]))
 
-        # dynamic programming to segment the sentence
-        # list of lists of SegResult
-        best_segmentations = [[SegResult(0.0, [])]] * (len(sentence) + 1)
-        best_score = [0] + [float("-inf")] * len(sentence)
+    def segment_batch(self, sentences):
+        """ Segment many sentences.
 
-        # best_score[1] -> autonomy of the first word
-        # best_score[2] -> sum of autonomy of the first two words, or autonomy of the first two
-        # ...
+        :param sentences: An iterable of sentences (lists of tokens, or ``str``).
+        :returns: A list with the segmentation of each sentence (see :func:`segment`).
+        """
+        lattice = self._lattice
         order = self.max_ngram_length
-        query_autonomy = self.storage.query_autonomy
-        for i in range(1, len(sentence) + 1):
-            segmentations_at_i = []
-            for j in range(1, order + 1):
-                if i - j < 0:
-                    break
-                a = query_autonomy(sentence[i - j : i])
-                if isnan(a):
-                    a = -100.0
-                else:
-                    a = a*j
-                segmentations_at_i.extend([SegResult(previous_best.score + a, previous_best.words + [sentence[i-j: i]]) for previous_best in best_segmentations[i-j] ])
-            best_segmentations[i] = sorted(segmentations_at_i, key=lambda x:x.score)[-nbest:]
-
-        #return [seg.words for seg in best_segmentations[-1][-nbest:]]
-        return [seg.words[1:-1] for seg in best_segmentations[-1][-nbest:]]
+        segmentations = []
+        for sentence in sentences:
+            bounds = viterbi(lattice(sentence, order))
+            segmentations.append([sentence[bounds[k] : bounds[k + 1]] for k in range(len(bounds) - 1)])
+        return segmentations
+
+    def segment_many(self, sentences, n_jobs=None, chunksize=1000, segment=None):
+        """ Segment many sentences with several processes.
+
+        The worker processes are started once, and get the segmenter (and its
+        storage) by fork: the model is shared with them, it is never pickled.
+        The first item is processed before the workers are started, so that
+        statistics that are lazily updated are computed only once. Without
+        fork (on Windows), or with ``n_jobs=1``, everything is done in the
+        current process.
+
+        :param sentences: An iterable of sentences (lists of tokens, or
+          ``str``), read lazily.
+        :param n_jobs: The number of processes (by default, the number of CPUs).
+        :param chunksize: The number of sentences sent at once to a process.
+        :param segment: A function ``segment(segmenter, sentence)`` used
+          instead of :func:`segment`, to preprocess the sentences for instance
+          (see :func:`eleve.preprocessing.chinese.segment_with_preprocessing`).
+          It should be defined at the top level of a module, so that it can be pickled.
+        :returns: An iterator on the segmentations (see :func:`segment`), or
+          on the results of ``segment``, in the order of ``sentences``.
+        """
+        return self._map(segment or _segment, sentences, n_jobs, chunksize)
+
+    def _map(self, func, items, n_jobs, chunksize):
+        """ Apply ``func(segmenter, item)`` to each item, see :func:`segment_many`.
+        """
+        items = iter(items)
+        try:
+            first = next(items)
+        except StopIteration:
+            return
+        yield func(self, first)
+        if n_jobs is None:
+            n_jobs = multiprocessing.cpu_count()
+        if n_jobs <= 1 or "fork" not in multiprocessing.get_all_start_methods():
+            for item in items:
+                yield func(self, item)
+            return
+        # Pool.imap reads its whole input at once: only let a few chunks per
+        # worker be read ahead of the results that were yielded.
+        window = threading.Semaphore(4 * n_jobs * chunksize)
+        stopped = False
+
+        def feed():
+            for item in items:
+                window.acquire()
+                if stopped:
+                    return
+                yield item
+
+        # with fork, initargs are inherited by the workers instead of being pickled
+        context = multiprocessing.get_context("fork")
+        with context.Pool(n_jobs, _init_worker, (self, func)) as pool:
+            try:
+                for result in pool.imap(_run_worker, feed(), chunksize):
+                    window.release()
+                    yield result
+            finally:
+                stopped = True
+                window.release()
+
+    def segment_nbest(self, sentence, nbest=3, with_scores=False):
+        """ Segment a sentence, giving the ``nbest`` best segmentations.
+
+        They are computed by a compiled k-best dynamic programming (see
+        :func:`eleve.cython_segment.viterbi_nbest`), on the sentence with its
+        start and end tokens. The first and last words are then removed.
+
+        :param sentence: A list of tokens, or a ``str`` whose characters are the tokens.
+        :param nbest: The number of segmentations.
+        :param with_scores: If True, give the score of each segmentation too.
+        :returns: A list of segmentations, from the worst to the best one (or
+          of couples (score, segmentation) if ``with_scores``). A
+          segmentation is a list of sentence fragments, that are lists of
+          tokens (``str`` if ``sentence`` is one).
+        """
+        if isinstance(sentence, str):
+            sentence = self.storage.sentence_start + sentence + self.storage.sentence_end
+        else:
+            sentence = [self.storage.sentence_start] + sentence + [self.storage.sentence_end]
+        results = viterbi_nbest(self._lattice(sentence, self.max_ngram_length), nbest)
+        segmentations = []
+        for score, bounds in results:
+            words = [sentence[bounds[k] : bounds[k + 1]] for k in range(1, len(bounds) - 2)]
+            segmentations.append((score, words) if with_scores else words)
+        return segmentations
 
     @staticmethod
     def tokenInWord(w):
@@ -38,4 +38,4 @@ if __name__ == "__main__":
         print(i)
         #segment_file(storage, CORPUS, Path(f"/tmp/text-{i}.txt"), bies=False)
         storage.prune(50)
-        CSVStorage.writeCSV(storage, storage.get_voc(),f"/tmp/lex-{i}.csv", ' ')
+        CSVStorage.writeCSV(storage, None, f"/tmp/lex-{i}.csv", ' ')
@@ -23,6 +23,7 @@ setup(
     #packages=["eleve"],
     packages=find_packages(),
     scripts=["scripts/eleve-train", "scripts/eleve-chinese"],
+    install_requires=["numpy"],
     classifiers=[
         "Programming Language :: Python",
         "Development Status :: 5 - Production/Stable",
@@ -35,7 +36,10 @@ setup(
         "Programming Language :: Cython",
         "Topic :: Scientific/Engineering",
     ],
-    ext_modules=cythonize(["./eleve/cython_storage.pyx"],
+    ext_modules=cythonize(["./eleve/cython_storage.pyx",
+                           Extension("eleve.cython_segment", ["./eleve/cython_segment.pyx"],
+                                     # scores should be rounded exactly as in Python (no fused multiply-add)
+                                     extra_compile_args=[] if os.name == "nt" else ["-ffp-contract=off"])],
                           compiler_directives={'language_level' : "3"},
                           annotate=True),
 )
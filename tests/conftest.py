@@ -144,3 +144,14 @@ def storage(request):
     else:
         raise ValueError("Invalid `storage` fixture param, got: %s" % backend)
     return storage
+
+
+## Corpus fixtures
+
+
+@pytest.fixture
+def pku_lines():
+    """ First 200 lines of the PKU test corpus, without their spaces
+    """
+    with open("benchmark/fixtures/pku_test.utf8") as f:
+        return [line.replace(" ", "").strip() for line in f][:200]
@@ -1,9 +1,18 @@
 import pytest
-from eleve import Segmenter
+import numpy
+from eleve import Segmenter, MemoryStorage, CachedStorage
+from eleve.cython_segment import viterbi, viterbi_nbest
 
 from conftest import parametrize_storage
 
 
+@pytest.fixture
+def pku_sentences(pku_lines):
+    """ Lines of the PKU test corpus, as lists of characters
+    """
+    return [list(line) for line in pku_lines]
+
+
 @parametrize_storage(default_ngram_length=3)
 def test_segmentation_basic(storage):
     storage.add_sentence("je vous parle de hot dog".split())
@@ -71,3 +80,137 @@ def test_zh_segmentation(storage_class, ref_class=PyMemoryStorage):
     for u in unsegmented:
         assert segmenter_test.segment(u) == segmenter_ref.segment(u)
 """
+
+
+class QueryOnly:
+    """ Storage without autonomy_lattice, queried one n-gram at a time """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.default_ngram_length = storage.default_ngram_length
+        self.sentence_start = storage.sentence_start
+        self.sentence_end = storage.sentence_end
+
+    def query_autonomy(self, ngram):
+        return self.storage.query_autonomy(ngram)
+
+
+def test_segmentation_lattice(pku_sentences):
+    storage = MemoryStorage(4)
+    storage.add_sentences(pku_sentences)
+    for segmenter, ref in (
+        (Segmenter(storage), Segmenter(QueryOnly(storage))),
+        (Segmenter(storage.freeze()), Segmenter(QueryOnly(storage))),
+    ):
+        for sentence in pku_sentences[:50] + [[], ["?"]]:
+            assert segmenter.segment(sentence) == ref.segment(sentence)
+            assert segmenter.segment_nbest(sentence, 3) == ref.segment_nbest(sentence, 3)
+
+
+def test_segment_cached(pku_sentences):
+    storage = MemoryStorage(4)
+    storage.add_sentences(pku_sentences)
+    segmenter = Segmenter(CachedStorage(storage))
+    ref = Segmenter(storage)
+    for sentence in pku_sentences[:50]:
+        assert segmenter.segment(sentence) == ref.segment(sentence)
+    info = segmenter.storage.cache_info()
+    assert info.hits > 0 and info.misses > 0
+
+
+def test_segment_batch(pku_sentences):
+    storage = MemoryStorage(4)
+    storage.add_sentences(pku_sentences)
+    segmenter = Segmenter(storage)
+    assert segmenter.segment_batch(iter(pku_sentences[:50])) == [segmenter.segment(s) for s in pku_sentences[:50]]
+    # a long sentence is not a problem anymore
+    long_sentence = [token for sentence in pku_sentences for token in sentence]
+    assert sum(segmenter.segment(long_sentence), []) == long_sentence
+
+
+def test_segment_str(pku_lines):
+    for backend in ("trie", "hash"):
+        storage = MemoryStorage(4, backend=backend)
+        storage.add_sentences(pku_lines)
+        ref = MemoryStorage(4, backend=backend)
+        ref.add_sentences(list(line) for line in pku_lines)
+        assert storage.get_voc() == ref.get_voc()
+        segmenter = Segmenter(storage)
+        ref_segmenter = Segmenter(ref)
+        for line in pku_lines[:50] + ["", "?", "\U0002a6a5\U0010fffd"]:
+            words = segmenter.segment(line)
+            assert words == ["".join(w) for w in ref_segmenter.segment(list(line))]
+            assert [line[start:end] for start, end in segmenter.segment_spans(line)] == words
+            assert segmenter.segment_nbest(line, 3) == [
+                ["".join(w) for w in words] for words in ref_segmenter.segment_nbest(list(line), 3)
+            ]
+        assert segmenter.segment_batch(pku_lines[:10]) == [segmenter.segment(line) for line in pku_lines[:10]]
+    # querying unknown characters does not add them
+    size = len(storage.vocabulary)
+    segmenter.segment("\u2603\U0001f600")
+    assert len(storage.vocabulary) == size
+
+
+def test_segment_many(pku_lines, pku_sentences):
+    storage = MemoryStorage(4)
+    storage.add_sentences(pku_sentences)
+    segmenter = Segmenter(storage)
+    expected = [segmenter.segment(s) for s in pku_sentences]
+    assert list(segmenter.segment_many(iter(pku_sentences), n_jobs=2, chunksize=7)) == expected
+    assert list(segmenter.segment_many(pku_sentences, n_jobs=1)) == expected
+    assert list(segmenter.segment_many([], n_jobs=2)) == []
+    # stopping early does not hang
+    for i, words in enumerate(segmenter.segment_many(iter(pku_sentences), n_jobs=2, chunksize=1)):
+        if i == 10:
+            break
+    assert words == expected[10]
+    # str sentences, and another segmentation function
+    assert (list(segmenter.segment_many(pku_lines[:50], n_jobs=2, segment=_count_words))
+            == [len(w) for w in expected[:50]])
+
+
+def _count_words(segmenter, sentence):
+    return len(segmenter.segment(sentence))
+
+
+def test_viterbi():
+    nan = float("nan")
+    lattice = numpy.array([[1.0, 2.0], [nan, nan], [0.5, nan]])
+    assert viterbi(lattice) == [0, 2, 3]
+    lattice = numpy.array([[1.0, 0.0], [1.0, nan], [0.5, nan]])
+    assert viterbi(lattice) == [0, 1, 2, 3]
+    assert viterbi(numpy.zeros((0, 3))) == [0]
+
+
+def test_viterbi_nbest():
+    """ Best scores are the ones of an exhaustive search """
+    numpy.random.seed(42)
+    lattice = numpy.random.normal(size=(7, 3))
+    lattice[numpy.random.random(size=lattice.shape) < 0.2] = numpy.nan
+    lattice[5, 2] = lattice[6, 1] = lattice[6, 2] = numpy.nan
+
+    def all_segmentations(start):
+        if start == len(lattice):
+            yield 0.0
+        for j in range(1, min(3, len(lattice) - start) + 1):
+            a = lattice[start, j - 1]
+            a = -100.0 if numpy.isnan(a) else a * j
+            for score in all_segmentations(start + j):
+                yield a + score
+
+    expected = sorted(all_segmentations(0))[-10:]
+    results = viterbi_nbest(lattice, 10)
+    assert numpy.allclose([score for score, _ in results], expected)
+    assert results[-1][1] == viterbi(lattice)
+    with pytest.raises(ValueError):
+        viterbi_nbest(lattice, 0)
+
+
+def test_segment_nbest_scores(pku_sentences):
+    storage = MemoryStorage(4)
+    storage.add_sentences(pku_sentences)
+    segmenter = Segmenter(storage)
+    results = segmenter.segment_nbest(pku_sentences[0], 5, with_scores=True)
+    assert [words for _, words in results] == segmenter.segment_nbest(pku_sentences[0], 5)
+    scores = [score for score, _ in results]
+    assert scores == sorted(scores) and len(scores) == 5
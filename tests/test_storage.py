@@ -1,12 +1,23 @@
 import pytest
+import pickle
 import re
 
-from eleve import PyMemoryStorage
+from eleve import MemoryStorage, CachedStorage, CSVStorage
+from eleve.memory import MemoryTrie, extract_ngrams
+from eleve.cython_storage import Lexicon
 
-from utils import float_equal, compare_node
+from utils import float_equal, compare_node, compare_storages
 from conftest import parametrize_storage
 
 
+@pytest.fixture
+def btree_sentences():
+    """ Sentences of the btree.txt fixture, as lists of words
+    """
+    with open("tests/fixtures/btree.txt") as f:
+        return [re.findall(r"\w+", line) for line in f.read().split("\n")]
+
+
 @parametrize_storage(create_dir=None, default_ngram_length=5)
 def test_basic(storage):
     """
@@ -159,20 +170,413 @@ def test_add_sentence_negativ_freq(storage):
 
 
 @parametrize_storage(default_ngram_length=[2, 4])
-def test_storage_random(storage, ref_class=PyMemoryStorage):
+def test_storage_random(storage, btree_sentences, ref_class=MemoryStorage):
     ref = ref_class(default_ngram_length=storage.default_ngram_length)
     ref.clear()
     storage.clear()
 
-    testfile = open("tests/fixtures/btree.txt").read().split("\n")
-    sentences = (re.findall(r"\w+", sentence) for sentence in testfile)
-    for sentence in sentences:
+    for sentence in btree_sentences:
         ref.add_sentence(sentence)
         storage.add_sentence(sentence)
 
     # compare of each ngram of each sentence
-    for sentence in sentences:
+    for sentence in btree_sentences:
         for start in range(len(sentence)):
-            for length in range(ngram_length):
+            for length in range(1, storage.default_ngram_length + 1):
                 ngram = sentence[start : start + length]
                 compare_node(ngram, ref, storage)
+
+
+def test_add_sentences(btree_sentences):
+    """ Compare the bulk insertion against the python reference tries
+    """
+    freqs = [1 + i % 3 for i in range(len(btree_sentences))]
+    storage = MemoryStorage(4)
+    storage.add_sentences(iter(btree_sentences), iter(freqs))
+    terminals = [storage.sentence_start, storage.sentence_end]
+    ref_fwd, ref_bwd = MemoryTrie(terminals), MemoryTrie(terminals)
+    for sentence, freq in zip(btree_sentences, freqs):
+        if not sentence:
+            continue
+        token_list = [storage.sentence_start] + sentence + [storage.sentence_end]
+        for ngram in extract_ngrams(token_list, 4):
+            ref_fwd.add_ngram(ngram, freq)
+        for ngram in extract_ngrams(token_list[::-1], 4):
+            ref_bwd.add_ngram(ngram, freq)
+    storage.update_stats()
+    for ngram in storage.get_voc():
+        compare_node(ngram, ref_fwd, storage.fwd)
+        compare_node(ngram[::-1], ref_bwd, storage.bwd)
+    with pytest.raises(ValueError):
+        storage.add_sentences([["le", "chat"]], [0])
+
+
+def test_freeze():
+    storage = MemoryStorage(3)
+    storage.add_sentence("le petit chat".split())
+    storage.add_sentence("le petit chien".split())
+    storage.add_sentence("pour le petit".split(), freq=2)
+    frozen = storage.freeze()
+    assert frozen.query_count(["le", "petit"]) == 4
+    assert frozen.query_count(["le", "chien"]) == 0
+    compare_storages(storage, frozen, storage.get_voc() + [["le", "inconnu"], []])
+    # computed in the same precision: exactly equal
+    for ngram in storage.get_voc():
+        for trie, frozen_trie in ((storage.fwd, frozen.fwd), (storage.bwd, frozen.bwd)):
+            for query in ("query_ev", "query_autonomy"):
+                value, expected = getattr(frozen_trie, query)(ngram), getattr(trie, query)(ngram)
+                assert value == expected or (value != value and expected != expected)
+
+
+def test_binary(tmp_path):
+    storage = MemoryStorage(3)
+    storage.add_sentence("le petit chat".split())
+    storage.add_sentence("le petit chien".split())
+    storage.add_sentence("pour le petit".split(), freq=2)
+    path = str(tmp_path / "model.bin")
+    storage.write_binary(path)
+    opened = MemoryStorage.open_binary(path)
+    assert opened.default_ngram_length == 3
+    compare_storages(storage, opened, storage.get_voc() + [["le", "inconnu"], []])
+    # read-only
+    assert opened.frozen and not storage.frozen
+    for modify in (lambda: opened.add_sentence(["le", "chat"]), lambda: opened.add_corpus(["le chat"]),
+                   opened.clear, opened.prune, lambda: opened.merge(storage), lambda: storage.merge(opened),
+                   lambda: opened.save(str(tmp_path / "model.ckp"))):
+        with pytest.raises(TypeError, match="frozen"):
+            modify()
+    assert opened.query_count(["le", "petit"]) == 4
+    # unknown version
+    with open(path, "r+b") as f:
+        f.seek(8)
+        f.write(b"\xff")
+    with pytest.raises(ValueError):
+        MemoryStorage.open_binary(path)
+
+
+def test_save_load(tmp_path, btree_sentences):
+    """ Resuming a training from a checkpoint is the same as training at once
+    """
+    storage = MemoryStorage(4)
+    storage.add_sentences(btree_sentences)
+    path = str(tmp_path / "model.ckp")
+    half = MemoryStorage(4)
+    half.add_sentences(btree_sentences[: len(btree_sentences) // 2])
+    half.save(path)
+    resumed = MemoryStorage.load(path)
+    assert resumed.default_ngram_length == 4
+    resumed.add_sentences(btree_sentences[len(btree_sentences) // 2 :])
+    compare_storages(storage, resumed)
+
+
+def test_hash_backend(tmp_path, btree_sentences):
+    """ Both backends give the same results, and load each other's checkpoints
+    """
+    storage, hashed = MemoryStorage(4), MemoryStorage(4, backend="hash")
+    storage.add_sentences(btree_sentences)
+    hashed.add_sentences(btree_sentences)
+    compare_storages(storage, hashed)
+    path = str(tmp_path / "model.ckp")
+    storage.save(path)
+    loaded = MemoryStorage.load(path, backend="hash")
+    assert loaded.backend == "hash"
+    compare_storages(storage, loaded)
+    with pytest.raises(ValueError):
+        MemoryStorage(4, backend="btree")
+
+
+def test_vocabulary(tmp_path):
+    """ Both tries share one vocabulary, that queries do not modify
+    """
+    storage = MemoryStorage(3)
+    storage.add_sentence("le petit chat".split())
+    storage.add_sentence("le gros chien".split())
+    assert storage.fwd.vocabulary is storage.bwd.vocabulary
+    size = len(storage.vocabulary)
+    assert storage.query_autonomy(["le", "inconnu"]) != storage.query_autonomy(["le", "inconnu"])
+    storage.query_autonomy_many([["inconnu", "chat"]])
+    storage.autonomy_lattice(["un", "inconnu"], 2)
+    assert len(storage.vocabulary) == size and "inconnu" not in storage.vocabulary
+    path = str(tmp_path / "model.ckp")
+    storage.save(path)
+    loaded = MemoryStorage.load(path)
+    assert loaded.fwd.vocabulary is loaded.bwd.vocabulary
+    path = str(tmp_path / "model.bin")
+    storage.write_binary(path)
+    opened = MemoryStorage.open_binary(path)
+    assert opened.fwd.vocabulary is opened.bwd.vocabulary
+    compare_storages(storage, loaded)
+    compare_storages(storage, opened)
+
+
+def test_pickle():
+    """ A pickled storage keeps one vocabulary for both tries, and can be trained further
+    """
+    for backend in ("trie", "hash"):
+        storage = MemoryStorage(3, backend=backend)
+        storage.add_sentence("le petit chat".split())
+        copy = pickle.loads(pickle.dumps(storage))
+        assert copy.fwd.vocabulary is copy.bwd.vocabulary
+        for trained in (storage, copy):
+            trained.add_sentence("le gros chien".split())
+            trained.add_sentence("un gros chat".split())
+        assert copy.query_autonomy(["gros"]) == copy.query_autonomy(["gros"])
+        compare_storages(storage, copy)
+
+
+def test_str_sentences(tmp_path):
+    """ A str is a sentence of characters, encoded by code point
+    """
+    numpy = pytest.importorskip("numpy")
+    storage, ref = MemoryStorage(3), MemoryStorage(3)
+    for sentence in ["le chat", "le chien\U0002a6a5", "chat\U0010fffd"]:
+        storage.add_sentence(sentence)
+        ref.add_sentence(list(sentence))
+    assert storage.vocabulary.tokens == ref.vocabulary.tokens
+    assert storage.vocabulary.lookup("ch\u2603") == ref.vocabulary.lookup(["c", "h", "\u2603"])
+    for ngram in ["ch", "e c", "n\U0002a6a5", "t\U0010fffd", "x"]:
+        for measure in ["query_count", "query_entropy", "query_ev", "query_autonomy"]:
+            assert float_equal(getattr(storage, measure)(ngram), getattr(ref, measure)(list(ngram)))
+    assert numpy.array_equal(storage.query_autonomy_many(["ch", "le", "x"]),
+                             ref.query_autonomy_many([["c", "h"], ["l", "e"], ["x"]]), equal_nan=True)
+    lattice = ref.autonomy_lattice(list("le chat"), 2)
+    assert numpy.array_equal(storage.autonomy_lattice("le chat", 2), lattice, equal_nan=True)
+    path = str(tmp_path / "model.bin")
+    storage.write_binary(path)
+    assert numpy.array_equal(MemoryStorage.open_binary(path).autonomy_lattice("le chat", 2), lattice, equal_nan=True)
+
+
+def test_parallel_update_stats(btree_sentences):
+    storage, parallel_storage = MemoryStorage(4), MemoryStorage(4)
+    storage.add_sentences(btree_sentences)
+    parallel_storage.add_sentences(btree_sentences)
+    storage.update_stats()
+    parallel_storage.update_stats(n_jobs=4)
+    compare_storages(storage, parallel_storage)
+
+
+def test_incremental(btree_sentences):
+    storage = MemoryStorage(4)
+    storage.add_sentences(btree_sentences)
+    storage.update_stats()
+    incremental = MemoryStorage(4, incremental=True)
+    for sentence in btree_sentences:
+        incremental.add_sentence(sentence)
+        incremental.query_autonomy(sentence[:2])
+    compare_storages(storage, incremental)
+
+
+def test_cached_storage(btree_sentences):
+    storage = MemoryStorage(4)
+    storage.add_sentences(btree_sentences[:20])
+    cached = CachedStorage(storage, maxsize=50)
+    voc = storage.get_voc()
+    for ngram in voc + voc[:10]:
+        assert float_equal(cached.query_autonomy(ngram), storage.query_autonomy(ngram))
+    info = cached.cache_info()
+    assert info.hits == 0 and info.misses == len(voc) + 10 and info.currsize == 50
+    for ngram in voc[-10:]:
+        cached.query_autonomy(ngram)
+    assert cached.cache_info().hits == 10
+    # invalidated by training
+    storage.add_sentences(btree_sentences[20:])
+    for ngram in voc[-10:]:
+        assert float_equal(cached.query_autonomy(ngram), storage.query_autonomy(ngram))
+    assert cached.cache_info().hits == 10
+    # warmed with the most frequent n-grams
+    cached.cache_clear()
+    cached.warm()
+    assert cached.cache_info() == (0, 0, 50, 50)
+    most_frequent = max(storage.iter_lexicon(), key=lambda row: row[2])[0]
+    assert cached.query_count(most_frequent) == storage.query_count(most_frequent)
+    assert cached.cache_info().hits == 1
+    assert cached.default_ngram_length == 4
+
+
+def test_query_many(tmp_path, btree_sentences):
+    numpy = pytest.importorskip("numpy")
+    storage = MemoryStorage(4)
+    storage.add_sentences(btree_sentences)
+    queries = storage.get_voc() + [["unknown"], ["le", "unknown"]]
+    autonomies = numpy.array([storage.query_autonomy(n) for n in queries])
+    counts = numpy.array([storage.query_count(n) for n in queries])
+    assert numpy.allclose(storage.query_autonomy_many(queries), autonomies, equal_nan=True)
+    assert numpy.array_equal(storage.query_count_many(queries), counts)
+    CSVStorage.writeCSV(storage, [tuple(n) for n in storage.get_voc()], str(tmp_path / "voc.csv"), delim=" ")
+    csv_storage = CSVStorage(str(tmp_path / "voc.csv"), delim=" ")
+    known = ~numpy.isnan(autonomies)
+    assert numpy.allclose(csv_storage.query_autonomy_many(queries), numpy.where(known, autonomies, numpy.nan), equal_nan=True)
+    assert numpy.array_equal(csv_storage.query_count_many(queries), numpy.where(known, counts, 0))
+
+
+def test_csv_storage(tmp_path, pku_lines):
+    numpy = pytest.importorskip("numpy")
+    storage = MemoryStorage(4)
+    storage.add_sentences(pku_lines)
+    voc = ["".join(ngram) for ngram in storage.get_voc() if len(ngram) < 4]
+    CSVStorage.writeCSV(storage, voc, str(tmp_path / "voc.csv"))
+    CSVStorage.writePickle(storage, voc, str(tmp_path / "voc.pkl"))
+    csv_storage = CSVStorage(str(tmp_path / "voc.csv"))
+    csv_storage.write_binary(str(tmp_path / "voc.bin"))
+    queries = voc[:500] + ["\u2603", pku_lines[0][:2] + "\u2603"]
+    expected = [storage.query_autonomy(ngram) for ngram in queries]
+    for tested in (csv_storage, CSVStorage(str(tmp_path / "voc.pkl")), CSVStorage(str(tmp_path / "voc.bin"))):
+        assert tested.default_ngram_length == 4
+        assert sorted(map("".join, tested.get_voc())) == sorted(v for v in voc if storage.query_autonomy(v) == storage.query_autonomy(v))
+        assert numpy.allclose([tested.query_autonomy(ngram) for ngram in queries], expected, equal_nan=True)
+        assert numpy.allclose(tested.query_autonomy_many(queries), expected, equal_nan=True)
+        word = next(v for v in voc if len(v) == 2 and storage.query_autonomy(v) == storage.query_autonomy(v))
+        assert tested.query_count(list(word)) == storage.query_count(word) > 0
+        assert tested.query_count("\u2603") == 0
+        for line in pku_lines[:20]:
+            lattice = [[tested.query_autonomy(line[i : i + j]) if i + j <= len(line) else numpy.nan
+                        for j in range(1, 4)] for i in range(len(line))]
+            assert numpy.allclose(tested.autonomy_lattice(line, 3), numpy.reshape(lattice, (len(line), 3)), equal_nan=True)
+    # the n-gram length of the storage is kept in the binary file, even without its longest n-grams
+    CSVStorage.writeBinary(storage, [v for v in voc if len(v) < 3], str(tmp_path / "short.bin"))
+    assert CSVStorage(str(tmp_path / "short.bin")).default_ngram_length == 4
+    assert CSVStorage(str(tmp_path / "voc.csv")).default_ngram_length == 4
+
+
+def test_iter_lexicon(tmp_path, btree_sentences):
+    for backend in ("trie", "hash"):
+        storage = MemoryStorage(4, backend=backend)
+        storage.add_sentences(btree_sentences)
+        markers = {storage.sentence_start, storage.sentence_end}
+        for tested in (storage, storage.freeze()):
+            for min_count, max_length in ((1, None), (2, 2)):
+                expected = {}
+                for ngram in storage.get_voc():
+                    autonomy = storage.query_autonomy(ngram)
+                    count = storage.query_count(ngram)
+                    if (autonomy == autonomy and count >= min_count and not markers & set(ngram)
+                            and len(ngram) <= (max_length or 3)):
+                        expected[tuple(ngram)] = (autonomy, count)
+                rows = list(tested.iter_lexicon(min_count, max_length))
+                assert len(rows) == len(expected)
+                for ngram, autonomy, count in rows:
+                    assert float_equal(expected[tuple(ngram)][0], autonomy)
+                    assert expected[tuple(ngram)][1] == count
+    CSVStorage.writeCSV(storage, None, str(tmp_path / "voc.csv"), delim=" ")
+    CSVStorage.writePickle(storage, None, str(tmp_path / "voc.pkl"))
+    CSVStorage.writeBinary(storage, None, str(tmp_path / "voc.bin"))
+    voc = sorted(tuple(ngram) for ngram, _, _ in storage.iter_lexicon())
+    for name in ("voc.csv", "voc.pkl", "voc.bin"):
+        lexicon = CSVStorage(str(tmp_path / name), delim=" ")
+        assert sorted(map(tuple, lexicon.get_voc())) == voc
+        for ngram in voc[:100]:
+            assert float_equal(lexicon.query_autonomy(ngram), storage.query_autonomy(ngram))
+
+
+def _words(line):
+    return [re.findall(r"\w+", line)]
+
+
+def test_add_corpus(btree_sentences):
+    lines = [" ".join(sentence) for sentence in btree_sentences]
+    expected = MemoryStorage(4)
+    expected.add_sentences(sentence for sentence in btree_sentences if sentence)
+    for n_jobs in (1, 2):
+        storage = MemoryStorage(4)
+        stats = storage.add_corpus(lines, _words, n_jobs=n_jobs, chunksize=7)
+        assert stats.lines == len(lines)
+        assert stats.sentences == sum(1 for sentence in btree_sentences if sentence)
+        compare_storages(expected, storage)
+    # errors of the reader are raised by the inserter
+    def failing():
+        yield "a b c"
+        raise IOError("broken corpus")
+    with pytest.raises(IOError):
+        MemoryStorage(3).add_corpus(failing(), n_jobs=2)
+
+
+def test_merge(btree_sentences):
+    for backend in ("trie", "hash"):
+        expected = MemoryStorage(4, backend=backend)
+        expected.add_sentences(btree_sentences)
+        # shards with their own vocabularies, numbered in other orders
+        shards = []
+        for k in range(3):
+            shard = MemoryStorage(4, backend=backend)
+            shard.add_sentences(btree_sentences[k::3][::-1])
+            shards.append(pickle.loads(pickle.dumps(shard)))
+        storage = shards[0]
+        storage.update_stats()
+        for shard in shards[1:]:
+            storage.merge(shard)
+        assert sorted(map(tuple, storage.get_voc())) == sorted(map(tuple, expected.get_voc()))
+        compare_storages(expected, storage)
+    with pytest.raises(TypeError):
+        MemoryStorage(4).merge(MemoryStorage(4, backend="hash"))
+
+
+def test_top_autonomous(btree_sentences):
+    for backend in ("trie", "hash"):
+        storage = MemoryStorage(4, backend=backend)
+        storage.add_sentences(btree_sentences)
+        markers = {storage.sentence_start, storage.sentence_end}
+        for tested in (storage, storage.freeze()):
+            for k, min_count, lengths in ((10, 1, None), (25, 2, [2, 3]), (100000, 1, [1])):
+                # queried one by one, in the order of the walk
+                rows = [(ngram, storage.query_autonomy(ngram), storage.query_count(ngram))
+                        for ngram in storage.get_voc()
+                        if not markers & set(ngram) and len(ngram) in (lengths or (1, 2, 3))]
+                rows = [row for row in rows if row[1] == row[1] and row[2] >= min_count]
+                rows.sort(key=lambda row: -row[1])
+                top = tested.top_autonomous(k, min_count, lengths)
+                assert [(ngram, count) for ngram, _, count in top] == [(ngram, count) for ngram, _, count in rows[:k]]
+                for (_, autonomy, _), (_, expected, _) in zip(top, rows):
+                    assert float_equal(autonomy, expected)
+    assert storage.top_autonomous(0) == []
+    with pytest.raises(ValueError):
+        storage.top_autonomous(10, lengths=[0, 1])
+
+
+def test_autonomy_lattice(btree_sentences):
+    storage = MemoryStorage(4)
+    incremental = MemoryStorage(4, incremental=True)
+    storage.add_sentences(btree_sentences)
+    incremental.add_sentences(btree_sentences)
+    for tested in (storage, storage.freeze(), incremental):
+        for sentence in btree_sentences[:10] + [["unknown", "le", "unknown"], []]:
+            lattice = tested.autonomy_lattice(sentence, 3)
+            assert lattice.shape == (len(sentence), 3)
+            for i in range(len(sentence)):
+                for j in range(1, 4):
+                    expected = storage.query_autonomy(sentence[i : i + j]) if i + j <= len(sentence) else float("nan")
+                    assert float_equal(lattice[i, j - 1], expected)
+
+
+def test_concurrent_queries(btree_sentences):
+    """ Threads query a dirty storage at once: statistics are updated once, and
+    no query sees them half updated """
+    from concurrent.futures import ThreadPoolExecutor
+    reference, storage = MemoryStorage(4), MemoryStorage(4)
+    reference.add_sentences(btree_sentences)
+    storage.add_sentences(btree_sentences)
+    voc = reference.get_voc()
+    expected = [reference.query_autonomy(ngram) for ngram in voc]
+    with ThreadPoolExecutor(4) as pool:
+        results = list(pool.map(lambda ngrams: list(storage.query_autonomy_many(ngrams)), [voc] * 8))
+    for autonomies in results:
+        assert all(float_equal(a, b) for a, b in zip(autonomies, expected))
+    # single queries and lattices of each trie, walked without the GIL
+    hashed = MemoryStorage(4, backend="hash")
+    hashed.add_sentences(btree_sentences)
+    for trie in (storage.fwd, storage.freeze().fwd, hashed.bwd):
+        expected = [trie.query_autonomy(ngram) for ngram in voc]
+        with ThreadPoolExecutor(4) as pool:
+            results = list(pool.map(lambda ngrams: [trie.query_autonomy(ngram) for ngram in ngrams], [voc] * 4))
+        assert all(str(autonomies) == str(expected) for autonomies in results)
+        expected = [trie.autonomy_lattice(sentence, 3).tolist() for sentence in btree_sentences]
+        with ThreadPoolExecutor(4) as pool:
+            results = list(pool.map(lambda sentence: trie.autonomy_lattice(sentence, 3).tolist(), btree_sentences))
+        assert str(results) == str(expected)
+    lexicon = Lexicon.build(storage.iter_lexicon())
+    expected = lexicon.query_autonomy_many(voc).tolist()
+    with ThreadPoolExecutor(4) as pool:
+        results = list(pool.map(lambda ngrams: lexicon.query_autonomy_many(ngrams).tolist(), [voc] * 4))
+    assert all(str(autonomies) == str(expected) for autonomies in results)
+    # unknown tokens are not added to the vocabulary by queries
+    assert storage.query_count(["not", "in", "the", "corpus"]) == 0
+    assert storage.fwd.encode_ngrams([["corpus"]])[0][0, 0] == -1
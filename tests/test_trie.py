@@ -1,7 +1,10 @@
+import io
+import pickle
 import pytest
 from math import isnan
 
 from eleve.memory import MemoryTrie
+from eleve.cython_storage import CythonTrie, HashTrie, Vocabulary
 
 from utils import float_equal, compare_node, generate_random_ngrams
 from conftest import parametrize_trie
@@ -195,3 +198,224 @@ def test_versus_ref_on_random(trie, reference_class=MemoryTrie):
         if i % (len(ngrams) // 10) == 0:  # check 10 times
             compare_nodes(ngrams, ref_trie, trie)
     compare_nodes(ngrams, ref_trie, trie)
+
+
+def test_freeze():
+    """ A frozen trie gives the same results than the trie it comes from
+    """
+    trie = CythonTrie()
+    ref_trie = MemoryTrie()
+    ngrams = generate_random_ngrams(nb=100, size=5)
+    for n in ngrams:
+        trie.add_ngram(n)
+        ref_trie.add_ngram(n)
+    frozen = trie.freeze()
+    compare_nodes(ngrams, trie, frozen)
+    ref_trie.update_stats()
+    assert len(frozen.normalization) == len(ref_trie.normalization)
+    for (mean, stdev), (ref_mean, ref_stdev) in zip(frozen.normalization, ref_trie.normalization):
+        assert float_equal(mean, ref_mean) and float_equal(stdev, ref_stdev)
+    assert sorted(frozen.get_voc()) == sorted(trie.get_voc())
+
+
+def test_save_load():
+    """ Save and reload a trie, then go on training it
+    """
+    trie = CythonTrie(terminals=[RAT])
+    ngrams = generate_random_ngrams(nb=100, size=5)
+    for n in ngrams[:50]:
+        trie.add_ngram(n)
+    f = io.BytesIO()
+    trie.save(f)
+    f.seek(0)
+    loaded = CythonTrie.load(f)
+    compare_nodes(ngrams[:50], trie, loaded)
+    for n in ngrams[50:]:
+        trie.add_ngram(n)
+        loaded.add_ngram(n)
+    compare_nodes(ngrams, trie, loaded)
+    # statistics are kept
+    trie.update_stats()
+    f = io.BytesIO()
+    trie.save(f)
+    f.seek(0)
+    assert CythonTrie.load(f).freeze().normalization == trie.freeze().normalization
+    # and it can be pickled
+    compare_nodes(ngrams, trie, pickle.loads(pickle.dumps(trie)))
+
+
+def test_incremental():
+    """ An incremental trie is always up to date, even when queried while trained
+    """
+    trie = CythonTrie(terminals=[RAT], incremental=True)
+    ref_trie = MemoryTrie(terminals=[RAT])
+    ngrams = generate_random_ngrams(nb=200, size=5)
+    for i, n in enumerate(ngrams):
+        trie.add_ngram(n, freq=1 + i % 3)
+        ref_trie.add_ngram(n, freq=1 + i % 3)
+        if i % (len(ngrams) // 10) == 0:  # check 10 times
+            compare_nodes(ngrams[: i + 1], ref_trie, trie)
+    compare_nodes(ngrams, ref_trie, trie)
+    # statistics are rebuilt after a reload
+    f = io.BytesIO()
+    trie.save(f)
+    f.seek(0)
+    loaded = CythonTrie.load(f)
+    assert loaded.incremental
+    loaded.add_ngram(ngrams[0])
+    ref_trie.add_ngram(ngrams[0])
+    compare_nodes(ngrams, ref_trie, loaded)
+
+
+@pytest.mark.parametrize("n_jobs", [2, 3])
+def test_parallel_update_stats(n_jobs):
+    """ Statistics computed by many threads are the same
+    """
+    ngrams = generate_random_ngrams(nb=500, size=5)
+    trie, parallel_trie = CythonTrie(terminals=[RAT]), CythonTrie(terminals=[RAT])
+    for n in ngrams:
+        trie.add_ngram(n)
+        parallel_trie.add_ngram(n)
+    trie.update_stats()
+    parallel_trie.update_stats(n_jobs=n_jobs)
+    compare_nodes(ngrams, trie, parallel_trie)
+    for (mean, stdev), (ref_mean, ref_stdev) in zip(parallel_trie.freeze().normalization, trie.freeze().normalization):
+        assert float_equal(mean, ref_mean) and float_equal(stdev, ref_stdev)
+
+
+def test_precomputed_autonomy():
+    """ Autonomies stored by update_stats are the z-scores of the entropy variations
+    """
+    ngrams = generate_random_ngrams(nb=200, size=5)
+    trie = CythonTrie(terminals=[RAT])
+    for n in ngrams[:100]:
+        trie.add_ngram(n)
+    trie.update_stats()
+    for n in ngrams[100:]:
+        trie.add_ngram(n)  # autonomies are outdated until the next query
+    normalization = trie.freeze().normalization
+    for n in ngrams:
+        for i in range(1, len(n) + 1):
+            mean, stdev = normalization[i - 1]
+            expected = trie.query_autonomy(n[:i], z_score=False) / stdev if stdev else float("nan")
+            assert float_equal(trie.query_autonomy(n[:i]), expected)
+    assert isnan(trie.query_autonomy([]))
+    assert isnan(trie.query_autonomy([LE, 420001337]))
+
+
+def test_query_many():
+    """ Batch queries give the same results than one query per n-gram
+    """
+    numpy = pytest.importorskip("numpy")
+    trie = CythonTrie(terminals=[RAT])
+    ngrams = generate_random_ngrams(nb=100, size=5)
+    for n in ngrams:
+        trie.add_ngram(n)
+    queries = [n[:i] for n in ngrams for i in range(len(n) + 1)] + [[LE, 420001337], [420001337]]
+    counts = numpy.array([trie.query_count(n) for n in queries])
+    autonomies = numpy.array([trie.query_autonomy(n) for n in queries])
+    for tested in (trie, trie.freeze()):
+        assert numpy.array_equal(tested.query_count_many(queries), counts)
+        assert numpy.allclose(tested.query_autonomy_many(queries), autonomies, equal_nan=True)
+        ids, lengths = tested.encode_ngrams(queries)
+        assert numpy.array_equal(tested.query_count_many(ids, lengths), counts)
+    assert len(trie.query_autonomy_many([])) == 0
+
+
+def test_node_reuse():
+    """ Nodes of pruned subtrees are reused, a cleared trie can be trained again,
+    and counts do not overflow 32 bits
+    """
+    trie = CythonTrie()
+    ref_trie = MemoryTrie()
+    ngrams = generate_random_ngrams(nb=100, size=5)
+    for n in ngrams:
+        trie.add_ngram(n)
+    trie.prune(1)
+    trie.clear()
+    assert trie.query_count([]) == 0 and trie.get_voc() == []
+    for n in ngrams:
+        trie.add_ngram(n)
+        ref_trie.add_ngram(n)
+    trie.update_stats()
+    compare_nodes(ngrams, ref_trie, trie)
+    trie.add_ngram([LE], 2 ** 31 - 1)
+    trie.add_ngram([LE], 2 ** 31 - 1)
+    assert trie.query_count([LE]) >= 2 ** 32 - 2
+
+
+def test_large_fanout():
+    """ Nodes with many children (indexed by a hash map) and with few children
+    (sorted arrays) give the same results, also after pruning
+    """
+    import random
+    random.seed(3)
+    trie = CythonTrie()
+    ref_trie = MemoryTrie()
+    ngrams = [[random.randrange(300), random.randrange(3), random.randrange(100)] for _ in range(3000)]
+    for n in ngrams:
+        trie.add_ngram(n)
+        ref_trie.add_ngram(n)
+    trie.update_stats()
+    compare_nodes(ngrams, ref_trie, trie)
+    counts = {}
+    for n in ngrams:
+        for i in range(1, 4):
+            counts[tuple(n[:i])] = counts.get(tuple(n[:i]), 0) + 1
+    trie.prune(8)
+    for ngram, count in counts.items():
+        assert trie.query_count(list(ngram)) == max(count - 8, 0)
+    assert sorted(map(tuple, trie.get_voc())) == sorted(n for n, c in counts.items() if c > 8)
+
+
+def test_hash_trie():
+    """ A trie stored in a hash table gives the same results as the reference,
+    also after pruning, and its checkpoints are the ones of CythonTrie
+    """
+    trie = HashTrie(terminals=[RAT])
+    ref_trie = MemoryTrie(terminals=[RAT])
+    ngrams = generate_random_ngrams(nb=200, size=5)
+    for n in ngrams:
+        trie.add_ngram(n)
+        ref_trie.add_ngram(n)
+    trie.update_stats()
+    compare_nodes(ngrams, ref_trie, trie)
+    compare_nodes(ngrams, trie, trie.freeze())
+    f = io.BytesIO()
+    trie.save(f)
+    f.seek(0)
+    loaded = CythonTrie.load(f)
+    compare_nodes(ngrams, trie, loaded)
+    compare_nodes(ngrams, trie, pickle.loads(pickle.dumps(trie)))
+    # same pruning as CythonTrie, leaves left have no entropy
+    trie.prune(1)
+    loaded.prune(1)
+    assert sorted(trie.get_voc()) == sorted(loaded.get_voc())
+    compare_nodes(ngrams, loaded, trie)
+    trie.clear()
+    assert trie.query_count([]) == 0 and trie.get_voc() == []
+    with pytest.raises(ValueError):
+        HashTrie(incremental=True)
+
+
+def test_shared_vocabulary():
+    """ Tries can share a vocabulary, that queries do not modify, and a trie
+    loaded into another vocabulary gets its ids remapped
+    """
+    vocabulary = Vocabulary()
+    trie, backward = CythonTrie(vocabulary=vocabulary), HashTrie(vocabulary=vocabulary)
+    ngrams = generate_random_ngrams(nb=100, size=5)
+    for n in ngrams:
+        trie.add_ngram(n)
+        backward.add_ngram(n[::-1])
+    assert len(vocabulary) == len(set(tok for n in ngrams for tok in n))
+    trie.query_autonomy([LE, 420001337])
+    backward.query_count([420001337])
+    assert 420001337 not in vocabulary and vocabulary.lookup([420001337]) == [-1]
+    trie.update_stats()
+    f = io.BytesIO()
+    trie.save(f)
+    f.seek(0)
+    loaded = CythonTrie.load(f, Vocabulary([420001337]))
+    assert loaded.vocabulary.tokens[0] == 420001337
+    compare_nodes(ngrams, trie, loaded)
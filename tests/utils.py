@@ -37,3 +37,13 @@ def compare_node(ngram, ref_trie, test_trie):
                 measure,
                 ngram,
             )
+
+
+def compare_storages(ref_storage, test_storage, ngrams=None):
+    """ Fails if the results of any measure is different for any ngram (the
+    vocabulary of ``ref_storage`` by default)
+    """
+    if ngrams is None:
+        ngrams = ref_storage.get_voc()
+    for ngram in ngrams:
+        compare_node(ngram, ref_storage, test_storage)